@@ -0,0 +1,65 @@
+from collections import OrderedDict
+
+
+class BlockCache:
+    """
+    LRU cache of BlocksData rows (number, timestamp, hash) bounded by BLOCK_CACHE_SIZE.
+    On a miss, the surrounding range of prefetch_size blocks (mostly ahead, as the
+    callers walk blocks forward) is loaded from BlocksData in a single query.
+    """
+
+    def __init__(self, config, storage):
+        self.config = config
+        self.storage = storage
+        self.max_size = self.config.get_block_cache_size()
+        self.prefetch_size = min(1000, self.max_size)
+        self.prefetch_behind = self.prefetch_size // 10
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+
+    def put(self, block_data):
+        self.blocks[block_data["number"]] = block_data
+        self.blocks.move_to_end(block_data["number"])
+        while len(self.blocks) > self.max_size:
+            self.blocks.popitem(last=False)
+
+    def prefetch(self, block_number):
+        from_block = max(0, block_number - self.prefetch_behind)
+        to_block = from_block + self.prefetch_size - 1
+        requested = None
+        for block_data in self.storage.get_blocks_data(from_block, to_block):
+            # The requested block is put last, so that it is the most recently used
+            if block_data["number"] == block_number:
+                requested = block_data
+            else:
+                self.put(block_data)
+                self.prefetched += 1
+        return requested
+
+    def get(self, block_number):
+        """
+        Returns the block data, or None if the block is not in BlocksData.
+        """
+        block_data = self.blocks.get(block_number)
+        if block_data is not None:
+            self.hits += 1
+            self.blocks.move_to_end(block_number)
+            return block_data
+
+        self.misses += 1
+        if self.max_size == 0:
+            return self.storage.get_block_data(block_number)
+        block_data = self.prefetch(block_number)
+        if block_data is not None:
+            self.put(block_data)
+        return block_data
+
+    def get_stats(self):
+        return {
+            "size": len(self.blocks),
+            "hits": self.hits,
+            "misses": self.misses,
+            "prefetched": self.prefetched,
+        }
@@ -20,11 +20,110 @@ class Config:
             raise ValueError("Invalid chain")
 
     def get_rpc(self):
-        return os.getenv("RPC")
+        return self.get_rpcs()[0]
+
+    def get_rpcs(self):
+        return [rpc.strip() for rpc in os.getenv("RPC").split(",") if rpc.strip()]
+
+    def get_http_connect_timeout(self):
+        return float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+
+    def get_http_read_timeout(self):
+        return float(os.getenv("HTTP_READ_TIMEOUT", "120"))
+
+    def get_http_max_per_host(self):
+        return int(os.getenv("HTTP_MAX_PER_HOST", "16"))
+
+    def get_rpc_cu_per_second(self):
+        return int(os.getenv("RPC_CU_PER_SECOND", "0"))
+
+    def get_rpc_bucket_file(self):
+        return os.getenv("RPC_BUCKET_FILE", f"/tmp/rpc_bucket_{self.get_chain()}")
 
     def get_debug(self):
         return os.getenv("DEBUG") == "true"
 
+    def get_state_history(self):
+        return os.getenv("STATE_HISTORY") == "true"
+
+    def get_blocks_batch_size(self):
+        return int(os.getenv("BLOCKS_BATCH_SIZE", "1000"))
+
+    def get_blocks_sparse(self):
+        return os.getenv("BLOCKS_SPARSE") == "true"
+
+    def get_blocks_max_in_flight(self):
+        return int(os.getenv("BLOCKS_MAX_IN_FLIGHT", "4"))
+
+    def get_block_cache_size(self):
+        return int(os.getenv("BLOCK_CACHE_SIZE", "100000"))
+
+    def get_timestamps_file(self):
+        return os.getenv("TIMESTAMPS_FILE", "")
+
+    def get_logs_fetcher(self):
+        return os.getenv("LOGS_FETCHER", "threads")
+
+    def get_logs_max_in_flight(self):
+        return int(os.getenv("LOGS_MAX_IN_FLIGHT", "16"))
+
+    def get_logs_scan_mode(self):
+        return os.getenv("LOGS_SCAN_MODE", "addresses")
+
+    def get_decode_workers(self):
+        return int(os.getenv("DECODE_WORKERS", "0"))
+
+    def get_events_pipeline_depth(self):
+        return int(os.getenv("EVENTS_PIPELINE_DEPTH", "0"))
+
+    def get_follow_head(self):
+        return os.getenv("FOLLOW_HEAD") == "true"
+
+    def get_head_confirmations(self):
+        return int(os.getenv("HEAD_CONFIRMATIONS", "2"))
+
+    def get_logs_cache_dir(self):
+        return os.getenv("LOGS_CACHE_DIR", "")
+
+    def get_logs_stream_batch_size(self):
+        return int(os.getenv("LOGS_STREAM_BATCH_SIZE", "0"))
+
+    def get_events_daemon(self):
+        return os.getenv("EVENTS_DAEMON") == "true"
+
+    def get_events_poll_interval(self):
+        return int(os.getenv("EVENTS_POLL_INTERVAL", "12"))
+
+    def get_fake_rpc_mode(self):
+        return os.getenv("FAKE_RPC_MODE", "replay")
+
+    def get_fake_rpc_upstream(self):
+        return os.getenv("FAKE_RPC_UPSTREAM") or self.get_rpc()
+
+    def get_fake_rpc_port(self):
+        return int(os.getenv("FAKE_RPC_PORT", "8545"))
+
+    def get_fake_rpc_fixtures_dir(self):
+        return os.getenv("FAKE_RPC_FIXTURES_DIR", "fixtures")
+
+    def get_fake_rpc_latency(self):
+        return float(os.getenv("FAKE_RPC_LATENCY", "0"))
+
+    def get_fake_rpc_max_results(self):
+        return int(os.getenv("FAKE_RPC_MAX_RESULTS", "10000"))
+
+    def get_fake_rpc_max_batch_size(self):
+        return int(os.getenv("FAKE_RPC_MAX_BATCH_SIZE", "0"))
+
+    def get_fake_rpc_error_rate(self):
+        return float(os.getenv("FAKE_RPC_ERROR_RATE", "0"))
+
+    def get_fake_rpc_rate_limit_rate(self):
+        return float(os.getenv("FAKE_RPC_RATE_LIMIT_RATE", "0"))
+
+    def get_prices_max_workers(self):
+        return int(os.getenv("PRICES_MAX_WORKERS", "4"))
+
     def get_chain(self):
         return os.getenv("CHAIN")
 
@@ -84,3 +183,6 @@ class Config:
 
     def get_events_module_name(self):
         return MODULES_NAMES["Events"]
+
+    def get_effective_stakes_module_name(self):
+        return MODULES_NAMES["EffectiveStakes"]
@@ -88,6 +88,7 @@ MODULES_NAMES = {
     "Points": "points",
     "State": "state",
     "Events": "events",
+    "EffectiveStakes": "effective_stakes",
 }
 
 
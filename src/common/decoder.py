@@ -0,0 +1,109 @@
+import json
+from functools import lru_cache
+
+from eth_abi.decoding import ContextFramesBytesIO
+from eth_abi.registry import registry
+from eth_utils import event_signature_to_log_topic
+from web3 import Web3
+
+from .constants import ABIS
+
+
+@lru_cache(maxsize=None)
+def to_checksum_address(address):
+    return Web3.to_checksum_address(address)
+
+
+def collapse_type(abi_input):
+    if abi_input["type"].startswith("tuple"):
+        return (
+            "("
+            + ",".join(
+                collapse_type(component) for component in abi_input["components"]
+            )
+            + ")"
+            + abi_input["type"][len("tuple") :]
+        )
+    return abi_input["type"]
+
+
+class LogDecoder:
+    """
+    Decodes raw logs of the given (ABI name, event name) pairs with a topic0 dispatch
+    table of eth_abi decoders built once, into the records web3's process_log returns
+    (event, address, blockNumber, logIndex, transactionHash, args).
+    """
+
+    def __init__(self, events):
+        self.event_specs = tuple(tuple(event) for event in events)
+        self.events = {}
+        for abi_name, event_name in events:
+            abi_event = next(
+                item
+                for item in json.loads(ABIS[abi_name])
+                if item["type"] == "event" and item["name"] == event_name
+            )
+            types = [collapse_type(abi_input) for abi_input in abi_event["inputs"]]
+            topic = event_signature_to_log_topic(f"{event_name}({','.join(types)})")
+
+            indexed, data = [], []
+            for abi_input, abi_type in zip(abi_event["inputs"], types):
+                if abi_input["indexed"]:
+                    indexed.append(
+                        (abi_input["name"], abi_type, registry.get_decoder(abi_type))
+                    )
+                else:
+                    data.append((abi_input["name"], abi_type))
+
+            self.events[topic] = (
+                event_name,
+                indexed,
+                [name for name, _ in data],
+                [abi_type for _, abi_type in data],
+                registry.get_tuple_decoder(*[abi_type for _, abi_type in data]),
+            )
+
+    def decode_value(self, abi_type, value):
+        if abi_type == "address":
+            return to_checksum_address(value)
+        return value
+
+    def decode_log(self, raw_log):
+        topics = raw_log["topics"]
+        event = self.events.get(bytes(topics[0])) if len(topics) != 0 else None
+        if event is None:
+            raise ValueError("Unknown event signature")
+        event_name, indexed, data_names, data_types, data_decoder = event
+
+        args = {}
+        for (name, abi_type, decoder), topic in zip(indexed, topics[1:]):
+            args[name] = self.decode_value(
+                abi_type, decoder(ContextFramesBytesIO(bytes(topic)))
+            )
+        if len(data_names) != 0:
+            values = data_decoder(ContextFramesBytesIO(bytes(raw_log["data"])))
+            for name, abi_type, value in zip(data_names, data_types, values):
+                args[name] = self.decode_value(abi_type, value)
+
+        return {
+            "event": event_name,
+            "address": to_checksum_address(raw_log["address"]),
+            "blockNumber": raw_log["blockNumber"],
+            "logIndex": raw_log["logIndex"],
+            "transactionHash": raw_log["transactionHash"],
+            "args": args,
+        }
+
+    def decode_logs(self, raw_logs):
+        return [self.decode_log(raw_log) for raw_log in raw_logs]
+
+
+# Decoders of a process pool worker, built on its first batch
+worker_decoders = {}
+
+
+def decode_batch(event_specs, raw_logs):
+    decoder = worker_decoders.get(event_specs)
+    if decoder is None:
+        decoder = worker_decoders[event_specs] = LogDecoder(event_specs)
+    return decoder.decode_logs(raw_logs)
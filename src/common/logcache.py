@@ -0,0 +1,273 @@
+import gzip
+import heapq
+import json
+import os
+
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.datastructures import AttributeDict
+
+
+HEX_FIELDS = ["data", "transactionHash", "blockHash"]
+
+
+def serialize_log(log):
+    serialized = dict(log)
+    serialized["topics"] = [Web3.to_hex(topic) for topic in log["topics"]]
+    for field in HEX_FIELDS:
+        if field in serialized:
+            serialized[field] = Web3.to_hex(serialized[field])
+    return serialized
+
+
+def deserialize_log(serialized):
+    serialized["topics"] = [HexBytes(topic) for topic in serialized["topics"]]
+    for field in HEX_FIELDS:
+        if field in serialized:
+            serialized[field] = HexBytes(serialized[field])
+    return AttributeDict(serialized)
+
+
+class LogCache:
+    """
+    Append-only on-disk cache of finalized eth_getLogs results. Each response is
+    written once into a gzip-compressed JSONL segment, and an index file keeps the
+    segment's block range, topics and addresses. A request is served per address:
+    the block range of each requested address is covered by the segments with the
+    same topics and that address, and only the gaps left are fetched.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.debug = self.config.get_debug()
+        self.path = os.path.join(
+            self.config.get_logs_cache_dir(), self.config.get_chain()
+        )
+        self.segments_path = os.path.join(self.path, "segments")
+        self.index_path = os.path.join(self.path, "index.jsonl")
+        os.makedirs(self.segments_path, exist_ok=True)
+
+        self.index = {}
+        self.segments_count = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as index_file:
+                for line in index_file:
+                    # A partially written last line is skipped
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.add_to_index(entry)
+
+    @staticmethod
+    def get_topics_key(topics):
+        return json.dumps(
+            [
+                (
+                    None
+                    if topic is None
+                    else (
+                        [Web3.to_hex(t) for t in topic]
+                        if isinstance(topic, list)
+                        else Web3.to_hex(topic)
+                    )
+                )
+                for topic in topics
+            ]
+        )
+
+    @staticmethod
+    def get_addresses_key(addresses):
+        if addresses is None:
+            return None
+        return sorted(address.lower() for address in addresses)
+
+    def add_to_index(self, entry):
+        entry["address_set"] = (
+            set(entry["addresses"]) if entry["addresses"] is not None else None
+        )
+        self.index.setdefault(entry["topics"], []).append(entry)
+        self.segments_count += 1
+
+    def find_segments(self, addresses, topics, from_block, to_block):
+        """
+        Covers the request per address with the cached segments, stitching adjacent
+        or overlapping ones. Returns the (segment, address set, from block, to block)
+        parts to read, and the (addresses, from block, to block) gaps left to fetch,
+        where the addresses are None for an address-less request.
+        """
+        entries = [
+            entry
+            for entry in self.index.get(self.get_topics_key(topics), [])
+            if entry["from_block"] <= to_block and entry["to_block"] >= from_block
+        ]
+        any_address_entries = [
+            entry for entry in entries if entry["address_set"] is None
+        ]
+        # The addresses covered by the same segments share their parts and gaps
+        if addresses is None:
+            groups = {(): None}
+        else:
+            address_entries = {
+                address: [] for address in self.get_address_set(addresses)
+            }
+            for i, entry in enumerate(entries):
+                if entry["address_set"] is None:
+                    continue
+                for address in entry["address_set"] & address_entries.keys():
+                    address_entries[address].append(i)
+            groups = {}
+            for address, indexes in address_entries.items():
+                groups.setdefault(tuple(indexes), set()).add(address)
+
+        parts = {}
+        gaps = {}
+        for indexes, address_set in groups.items():
+            covered, missing = self.cover(
+                [entries[i] for i in indexes] + any_address_entries,
+                from_block,
+                to_block,
+            )
+            for entry, part_from_block, part_to_block in covered:
+                key = (entry["file"], part_from_block, part_to_block)
+                if key not in parts:
+                    parts[key] = (entry, set(), part_from_block, part_to_block)
+                if address_set is None:
+                    parts[key] = (entry, None, part_from_block, part_to_block)
+                else:
+                    parts[key][1].update(address_set)
+            for gap in missing:
+                if address_set is not None:
+                    gaps.setdefault(gap, set()).update(address_set)
+                else:
+                    gaps[gap] = None
+
+        return list(parts.values()), [
+            (
+                (
+                    [address for address in addresses if address.lower() in address_set]
+                    if address_set is not None
+                    else None
+                ),
+                gap_from_block,
+                gap_to_block,
+            )
+            for (gap_from_block, gap_to_block), address_set in sorted(gaps.items())
+        ]
+
+    @staticmethod
+    def cover(entries, from_block, to_block):
+        """
+        Splits the range into the parts read from the given segments, each time from
+        the one reaching the furthest, and the gaps none of them covers.
+        """
+        covered, missing = [], []
+        block_number = from_block
+        while block_number <= to_block:
+            entry = max(
+                (
+                    entry
+                    for entry in entries
+                    if entry["from_block"] <= block_number <= entry["to_block"]
+                ),
+                key=lambda entry: entry["to_block"],
+                default=None,
+            )
+            if entry is not None:
+                part_to_block = min(to_block, entry["to_block"])
+                covered.append((entry, block_number, part_to_block))
+            else:
+                part_to_block = min(
+                    [to_block]
+                    + [
+                        entry["from_block"] - 1
+                        for entry in entries
+                        if entry["from_block"] > block_number
+                    ]
+                )
+                missing.append((block_number, part_to_block))
+            block_number = part_to_block + 1
+        return covered, missing
+
+    def get_address_set(self, addresses):
+        if addresses is None:
+            return None
+        return set(self.get_addresses_key(addresses))
+
+    def get(self, addresses, topics, from_block, to_block):
+        """
+        Returns an iterator over the cached logs of the request in block order, or
+        None if some of it is not cached.
+        """
+        parts, gaps = self.find_segments(addresses, topics, from_block, to_block)
+        if len(gaps) != 0:
+            return None
+        return self.read_segments(parts)
+
+    def read_segments(self, parts):
+        """
+        Merges the logs of the given (segment, address set, from block, to block)
+        parts in block order.
+        """
+        if self.debug and len(parts) != 0:
+            print(f"  Log cache hit for {len(parts)} segment parts")
+        return heapq.merge(
+            *[
+                self.read_segment(entry, address_set, part_from_block, part_to_block)
+                for entry, address_set, part_from_block, part_to_block in parts
+            ],
+            key=lambda log: (log["blockNumber"], log["logIndex"]),
+        )
+
+    def read_segment(self, entry, address_set, from_block, to_block):
+        with gzip.open(
+            os.path.join(self.segments_path, entry["file"]), "rt"
+        ) as segment:
+            for line in segment:
+                log = json.loads(line)
+                if not from_block <= log["blockNumber"] <= to_block:
+                    continue
+                if (
+                    address_set is not None
+                    and log["address"].lower() not in address_set
+                ):
+                    continue
+                yield deserialize_log(log)
+
+    def put(self, addresses, topics, from_block, to_block, logs):
+        for _ in self.put_stream(addresses, topics, from_block, to_block, logs):
+            pass
+
+    def put_stream(
+        self, addresses, topics, from_block, to_block, logs, is_complete=None
+    ):
+        """
+        Writes the logs into a new segment while passing them through. The segment is
+        only indexed once the logs are exhausted, and is discarded if is_complete()
+        then says some of the range failed to fetch, so an interrupted or partial
+        stream leaves nothing behind.
+        """
+        file_name = (
+            f"{from_block}-{to_block}-{self.segments_count}-{os.getpid()}.jsonl.gz"
+        )
+        file_path = os.path.join(self.segments_path, file_name)
+        with gzip.open(file_path + ".tmp", "wt") as segment:
+            for log in logs:
+                segment.write(json.dumps(serialize_log(log)) + "\n")
+                yield log
+        if is_complete is not None and not is_complete():
+            print(f"  Not caching blocks {from_block}-{to_block}: the fetch failed")
+            os.remove(file_path + ".tmp")
+            return
+        os.replace(file_path + ".tmp", file_path)
+
+        entry = {
+            "file": file_name,
+            "from_block": from_block,
+            "to_block": to_block,
+            "topics": self.get_topics_key(topics),
+            "addresses": self.get_addresses_key(addresses),
+        }
+        with open(self.index_path, "a") as index_file:
+            index_file.write(json.dumps(entry) + "\n")
+        self.add_to_index(entry)
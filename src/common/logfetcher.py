@@ -0,0 +1,475 @@
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+
+import aiohttp
+from web3 import Web3
+from web3._utils.method_formatters import log_entry_formatter
+from web3.datastructures import AttributeDict
+
+from .scheduler import METHOD_COSTS
+
+
+# Substrings of provider errors meaning the range has to be split
+# (e.g. "query returned more than 10000 results", "Log response size exceeded")
+TOO_MANY_RESULTS_ERRORS = [
+    "more than",
+    "too many results",
+    "response size",
+    "block range",
+    "range is too large",
+    "timeout",
+    "timed out",
+]
+
+# Substrings of provider errors meaning the requests have to slow down
+RATE_LIMIT_ERRORS = [
+    "rate limit",
+    "too many requests",
+    "request limit",
+    "capacity",
+]
+# HTTP and JSON-RPC codes of rate limiting (-32005 is also Infura's "more than
+# 10000 results", which is told apart by its message)
+RATE_LIMIT_STATUS = 429
+RATE_LIMIT_CODES = [429, -32005]
+
+
+class TooManyResultsError(Exception):
+    pass
+
+
+class RateLimitError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def classify_error(error):
+    """
+    Returns the exception for a JSON-RPC error object: rate limits first, so that
+    "rate limit exceeded" is never mistaken for an oversized range.
+    """
+    message = str(error.get("message", error))
+    lower_message = message.lower()
+    if any(pattern in lower_message for pattern in RATE_LIMIT_ERRORS):
+        return RateLimitError(message)
+    if any(pattern in lower_message for pattern in TOO_MANY_RESULTS_ERRORS):
+        return TooManyResultsError(message)
+    if error.get("code") in RATE_LIMIT_CODES:
+        return RateLimitError(message)
+    return Exception(f"eth_getLogs error: {message}")
+
+
+def get_retry_after(headers):
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class LogFetcher:
+    """
+    asyncio-based eth_getLogs fetcher keeping many requests in flight over one pooled
+    HTTP session. The requests go to the RPC pool's endpoints by their health score,
+    failing over to the next one and hedging slow ones like the pool does, and are
+    recorded in the endpoints' stats. The sub-chunk size is adapted per address
+    group: it grows while the requests return few logs quickly and shrinks on
+    big/slow responses or "too many results" errors.
+    """
+
+    def __init__(self, config, rpc_pool):
+        self.config = config
+        self.rpc_pool = rpc_pool
+        self.scheduler = self.rpc_pool.scheduler
+        self.debug = self.config.get_debug()
+        self.max_in_flight = self.config.get_logs_max_in_flight()
+        self.initial_chunk_size = 5000
+        self.min_chunk_size = 1
+        self.max_chunk_size = 500000
+        self.target_logs = 5000
+        self.target_latency = 5
+        self.max_attempts = 5
+        self.max_rate_limits = 10
+        self.rate_limits = 0
+        self.request_timeout = 60
+        self.chunk_sizes = {}
+        self.metrics = deque(maxlen=10000)
+        # Fetched chunks waiting for an earlier one, and yielded chunks waiting for
+        # the consumer, are bounded to keep the memory use flat
+        self.max_buffered = 2 * self.max_in_flight
+        self.session = None
+        self.request_id = 0
+        # The loop keeps running between the consumer's reads, so the requests stay
+        # in flight while the previous logs are decoded and stored
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def get_chunk_size(self, group):
+        return self.chunk_sizes.get(group, self.initial_chunk_size)
+
+    def update_chunk_size(self, group, chunk_size, logs_count, latency):
+        if logs_count > self.target_logs or latency > self.target_latency:
+            new_chunk_size = max(self.min_chunk_size, chunk_size // 2)
+        elif logs_count < self.target_logs // 2 and latency < self.target_latency / 2:
+            new_chunk_size = min(self.max_chunk_size, chunk_size * 2)
+        else:
+            new_chunk_size = chunk_size
+        self.chunk_sizes[group] = new_chunk_size
+
+    def shrink_chunk_size(self, group, chunk_size):
+        self.chunk_sizes[group] = max(self.min_chunk_size, chunk_size // 2)
+
+    @staticmethod
+    def format_topics(topics):
+        if topics is None:
+            return None
+        return [
+            (
+                None
+                if topic is None
+                else (
+                    [Web3.to_hex(t) for t in topic]
+                    if isinstance(topic, list)
+                    else Web3.to_hex(topic)
+                )
+            )
+            for topic in topics
+        ]
+
+    async def get_session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+                headers={"Content-Type": "application/json"},
+            )
+        return self.session
+
+    async def post(self, endpoint, payload, priority):
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.scheduler.acquire, METHOD_COSTS["eth_getLogs"], priority
+        )
+        session = await self.get_session()
+        start = time.monotonic()
+        try:
+            async with session.post(endpoint.url, json=payload) as response:
+                if response.status == RATE_LIMIT_STATUS:
+                    raise RateLimitError(
+                        f"HTTP {response.status}", get_retry_after(response.headers)
+                    )
+                if response.status == 413:
+                    raise TooManyResultsError(f"HTTP {response.status}")
+                response.raise_for_status()
+                data = await response.json(content_type=None)
+            if "error" in data:
+                raise classify_error(data["error"])
+        except TooManyResultsError:
+            # Oversized ranges are answered, not failures of the endpoint
+            endpoint.record(True, time.monotonic() - start)
+            raise
+        except Exception:
+            endpoint.record(False, time.monotonic() - start)
+            raise
+        endpoint.record(True, time.monotonic() - start)
+        return [AttributeDict(log_entry_formatter(log)) for log in data["result"]]
+
+    async def send(self, endpoints, payload, priority):
+        """
+        Posts to the first endpoint, and also to the second one once the first is
+        slower than its hedge timeout. The first answer wins.
+        """
+        tasks = {asyncio.create_task(self.post(endpoints[0], payload, priority))}
+        try:
+            if len(endpoints) > 1:
+                done, _ = await asyncio.wait(
+                    tasks, timeout=self.rpc_pool.get_hedge_timeout(endpoints[0])
+                )
+                if len(done) == 0:
+                    if self.debug:
+                        print(f"  Hedging slow eth_getLogs to {endpoints[1].url}")
+                    self.rpc_pool.hedges += 1
+                    tasks.add(
+                        asyncio.create_task(self.post(endpoints[1], payload, priority))
+                    )
+            error = None
+            for task in asyncio.as_completed(tasks):
+                try:
+                    return await task
+                except Exception as e:
+                    error = e
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def request_logs(self, addresses, topics, from_block, to_block, priority):
+        self.request_id += 1
+        filter_params = {
+            "fromBlock": hex(from_block),
+            "toBlock": hex(to_block),
+            "topics": self.format_topics(topics),
+        }
+        if addresses is not None:
+            filter_params["address"] = addresses
+        payload = {
+            "jsonrpc": "2.0",
+            "id": self.request_id,
+            "method": "eth_getLogs",
+            "params": [filter_params],
+        }
+
+        # Oversized ranges, timeouts and rate limits are handled by the caller, other
+        # errors fail over to the next endpoint
+        endpoints = self.rpc_pool.get_endpoints()
+        error = None
+        for i in range(len(endpoints)):
+            try:
+                return await self.send(endpoints[i:], payload, priority)
+            except (TooManyResultsError, RateLimitError, asyncio.TimeoutError):
+                raise
+            except Exception as e:
+                error = e
+                if self.debug:
+                    print(f"  eth_getLogs to {endpoints[i].url} failed: {e}")
+        raise error
+
+    async def fetch_chunk(
+        self, addresses, topics, chunk, group, priority, call_metrics
+    ):
+        from_block, to_block, attempt = chunk
+        start = time.monotonic()
+        logs, error = None, None
+        try:
+            logs = await self.request_logs(
+                addresses, topics, from_block, to_block, priority
+            )
+        except (TooManyResultsError, asyncio.TimeoutError) as e:
+            error = TooManyResultsError(str(e) or "timeout")
+        except Exception as e:
+            error = e
+        latency = time.monotonic() - start
+
+        metric = {
+            "group": group,
+            "from_block": from_block,
+            "to_block": to_block,
+            "logs": len(logs) if logs is not None else None,
+            "latency": latency,
+            "error": str(error) if error is not None else None,
+            "rate_limited": isinstance(error, RateLimitError),
+        }
+        self.metrics.append(metric)
+        call_metrics.append(metric)
+        if self.debug:
+            print(f"    eth_getLogs chunk metrics: {metric}")
+        return chunk, logs, error, latency
+
+    async def fetch(
+        self, addresses, topics, from_block, to_block, group, priority, call_metrics
+    ):
+        """
+        Yields the logs of the range chunk by chunk in block order, as soon as all the
+        chunks before them are fetched.
+        """
+        retries = deque()
+        tasks = set()
+        # Chunks waiting out their backoff before they are retried
+        delayed = set()
+        cursor = from_block
+        # Reorder buffer: fetched chunks by their first block, until they are next
+        fetched_chunks = {}
+        next_block = from_block
+
+        try:
+            while cursor <= to_block or retries or tasks or delayed:
+                while len(tasks) < self.max_in_flight and (
+                    retries
+                    or (
+                        cursor <= to_block
+                        and len(tasks) + len(fetched_chunks) < self.max_buffered
+                    )
+                ):
+                    if retries:
+                        chunk = retries.popleft()
+                    else:
+                        chunk_to_block = min(
+                            to_block, cursor + self.get_chunk_size(group) - 1
+                        )
+                        chunk = (cursor, chunk_to_block, 0)
+                        cursor = chunk_to_block + 1
+                    tasks.add(
+                        asyncio.create_task(
+                            self.fetch_chunk(
+                                addresses, topics, chunk, group, priority, call_metrics
+                            )
+                        )
+                    )
+
+                done, _ = await asyncio.wait(
+                    tasks | delayed, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task in delayed:
+                        delayed.remove(task)
+                        retries.append(task.result())
+                        continue
+                    tasks.remove(task)
+                    (
+                        (chunk_from_block, chunk_to_block, attempt),
+                        logs,
+                        error,
+                        latency,
+                    ) = task.result()
+                    chunk_size = chunk_to_block - chunk_from_block + 1
+
+                    if error is None:
+                        self.rate_limits = 0
+                        fetched_chunks[chunk_from_block] = (chunk_to_block, logs)
+                        self.update_chunk_size(group, chunk_size, len(logs), latency)
+                    elif (
+                        isinstance(error, RateLimitError)
+                        and self.rate_limits < self.max_rate_limits
+                    ):
+                        # The whole scheduler backs off, the range is retried as is
+                        self.rate_limits += 1
+                        self.scheduler.penalize(
+                            error.retry_after or min(60, 2 ** (self.rate_limits - 1))
+                        )
+                        retries.append((chunk_from_block, chunk_to_block, attempt))
+                    elif isinstance(error, TooManyResultsError) and chunk_size > 1:
+                        self.shrink_chunk_size(group, chunk_size)
+                        mid_block = (chunk_from_block + chunk_to_block) // 2
+                        retries.appendleft((mid_block + 1, chunk_to_block, 0))
+                        retries.appendleft((chunk_from_block, mid_block, 0))
+                    elif attempt + 1 < self.max_attempts:
+                        # The other chunks keep flowing during the backoff
+                        delayed.add(
+                            asyncio.create_task(
+                                self.delay(
+                                    2**attempt,
+                                    (chunk_from_block, chunk_to_block, attempt + 1),
+                                )
+                            )
+                        )
+                    else:
+                        raise Exception(
+                            f"Failed to get logs for blocks {chunk_from_block}-{chunk_to_block}: {error}"
+                        )
+
+                while next_block in fetched_chunks:
+                    chunk_to_block, logs = fetched_chunks.pop(next_block)
+                    next_block = chunk_to_block + 1
+                    yield sorted(
+                        logs, key=lambda log: (log["blockNumber"], log["logIndex"])
+                    )
+        finally:
+            for task in tasks | delayed:
+                task.cancel()
+
+    @staticmethod
+    async def delay(seconds, chunk):
+        await asyncio.sleep(seconds)
+        return chunk
+
+    @staticmethod
+    async def put(output, item):
+        # The queue is bounded and polled, so that a consumer gone away can cancel it
+        while True:
+            try:
+                output.put_nowait(item)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.01)
+
+    async def produce(self, chunks, output):
+        """
+        Feeds the fetched chunks into the output queue, then None, or the exception.
+        """
+        try:
+            async for logs in chunks:
+                await self.put(output, logs)
+            await self.put(output, None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self.put(output, e)
+        finally:
+            await chunks.aclose()
+
+    def get_logs(
+        self, addresses, topics, from_block, to_block, group="default", priority=None
+    ):
+        """
+        Yields the logs of the range in block order, while the fetcher keeps up to
+        max_in_flight requests of it running in the background.
+        """
+        call_metrics = []
+        output = queue.Queue(maxsize=self.max_buffered)
+        future = asyncio.run_coroutine_threadsafe(
+            self.produce(
+                self.fetch(
+                    addresses,
+                    topics,
+                    from_block,
+                    to_block,
+                    group,
+                    priority,
+                    call_metrics,
+                ),
+                output,
+            ),
+            self.loop,
+        )
+        try:
+            while True:
+                logs = output.get()
+                if logs is None:
+                    break
+                if isinstance(logs, Exception):
+                    raise logs
+                yield from logs
+        finally:
+            future.cancel()
+
+        summary = self.get_metrics_summary(call_metrics)
+        print(
+            f"  eth_getLogs {from_block}-{to_block} ({group}): "
+            f"{summary['logs']} logs in {summary['requests']} requests, "
+            f"{summary['errors']} errors ({summary['rate_limited']} rate limited), "
+            f"avg latency {summary['avg_latency']:.2f}s, "
+            f"chunk size {self.get_chunk_size(group)}"
+        )
+
+    def get_metrics_summary(self, metrics=None):
+        """
+        Summarizes the given chunk metrics (all the recent ones by default).
+        """
+        if metrics is None:
+            metrics = self.metrics
+        requests = len(metrics)
+        return {
+            "requests": requests,
+            "errors": len([metric for metric in metrics if metric["error"]]),
+            "rate_limited": len(
+                [metric for metric in metrics if metric["rate_limited"]]
+            ),
+            "logs": sum(metric["logs"] or 0 for metric in metrics),
+            "avg_latency": (
+                sum(metric["latency"] for metric in metrics) / requests
+                if requests
+                else 0
+            ),
+            "chunk_sizes": dict(self.chunk_sizes),
+        }
+
+    def close(self):
+        if self.session is not None:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+            self.session = None
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -0,0 +1,84 @@
+def normalize_hash(block_hash):
+    if isinstance(block_hash, bytes):
+        return block_hash.hex().lower()
+    block_hash = block_hash.strip().lower()
+    if block_hash.startswith("0x") or block_hash.startswith("\\x"):
+        return block_hash[2:]
+    return block_hash
+
+
+class ReorgGuard:
+    """
+    Detects reorgs of the not yet finalized blocks ingested in the head-following mode
+    by comparing BlocksData hashes with the chain, and rolls back the blocks, the event
+    logs and their timepoints above the fork point so that they are re-ingested.
+    """
+
+    def __init__(self, config, w3_wrapper, storage):
+        self.config = config
+        self.w3_wrapper = w3_wrapper
+        self.storage = storage
+        self.debug = self.config.get_debug()
+
+    def get_chain_hashes(self, block_numbers):
+        if len(block_numbers) == 0:
+            return {}
+        json = [
+            {
+                "method": "eth_getBlockByNumber",
+                "params": [hex(block_number), False],
+                "id": i,
+                "jsonrpc": "2.0",
+            }
+            for i, block_number in enumerate(block_numbers)
+        ]
+        hashes = {}
+        for response_data in self.w3_wrapper.rpc_pool.request(json, hedge=True):
+            block_data = response_data.get("result")
+            if block_data is not None:
+                hashes[int(block_data["number"], 16)] = block_data["hash"]
+        return hashes
+
+    def find_fork_block(self):
+        """
+        Returns the first stored non-finalized block whose hash differs from the chain,
+        or None if the stored blocks are still canonical.
+        """
+        last_block = self.storage.get_processed_timepoint(
+            self.config.get_blocks_module_name()
+        )
+        if last_block is None:
+            return None
+        from_block = self.w3_wrapper.get_finalized_block() + 1
+        if from_block > last_block:
+            return None
+
+        stored_hashes = self.storage.get_block_hashes(from_block, last_block)
+        chain_hashes = self.get_chain_hashes(sorted(stored_hashes.keys()))
+        for block_number in sorted(stored_hashes.keys()):
+            chain_hash = chain_hashes.get(block_number)
+            if chain_hash is None or normalize_hash(chain_hash) != normalize_hash(
+                stored_hashes[block_number]
+            ):
+                return block_number
+        return None
+
+    def check(self):
+        fork_block = self.find_fork_block()
+        if fork_block is None:
+            if self.debug:
+                print("[ReorgGuard] No reorg detected.")
+            return None
+
+        print(
+            f"[ReorgGuard] Reorg detected at block {fork_block}, rolling back blocks and logs above {fork_block - 1}..."
+        )
+        self.storage.rollback_above_block(
+            fork_block - 1,
+            [
+                self.config.get_blocks_module_name(),
+                self.config.get_events_module_name(),
+            ],
+        )
+        self.storage.commit()
+        return fork_block
@@ -0,0 +1,230 @@
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+
+from web3.providers.base import JSONBaseProvider
+
+from .logfetcher import RateLimitError, classify_error
+from .scheduler import RpcScheduler
+from .transport import Transport
+
+
+# Methods worth sending to a second endpoint when the first one is slow
+HEDGED_METHODS = ["eth_getLogs"]
+
+# JSON-RPC errors of a busy or broken endpoint, retried on the next one
+SERVER_ERROR_CODES = [-32603]
+SERVER_ERRORS = ["internal error", "temporarily unavailable", "try again"]
+
+
+class RetryableResponseError(Exception):
+    """
+    A JSON-RPC response with a rate limit or server error in its body, kept so that
+    it is returned as is once the attempts are exhausted.
+    """
+
+    def __init__(self, message, data):
+        super().__init__(message)
+        self.data = data
+
+
+def get_retryable_error(data):
+    """
+    Returns the first rate limit or server error of a response (or batch), if any.
+    """
+    for response in data if isinstance(data, list) else [data]:
+        error = response.get("error") if isinstance(response, dict) else None
+        if error is None:
+            continue
+        if not isinstance(error, dict):
+            error = {"message": str(error)}
+        if isinstance(classify_error(error), RateLimitError):
+            return error, True
+        message = str(error.get("message", "")).lower()
+        if error.get("code") in SERVER_ERROR_CODES or any(
+            pattern in message for pattern in SERVER_ERRORS
+        ):
+            return error, False
+    return None, False
+
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url
+        self.latencies = deque(maxlen=100)
+        self.results = deque(maxlen=100)
+        self.requests = 0
+        self.errors = 0
+
+    def record(self, success, latency):
+        self.requests += 1
+        if success:
+            self.latencies.append(latency)
+        else:
+            self.errors += 1
+        self.results.append(success)
+
+    def get_error_rate(self):
+        if len(self.results) == 0:
+            return 0
+        return self.results.count(False) / len(self.results)
+
+    def get_latency_percentile(self, percentile):
+        if len(self.latencies) == 0:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile))]
+
+    def get_score(self):
+        """
+        Lower is better: the median latency inflated by the recent error rate,
+        endpoints without samples yet are tried first.
+        """
+        median_latency = self.get_latency_percentile(0.5) or 0
+        error_rate = self.get_error_rate()
+        return median_latency * (1 + 10 * error_rate) + 10 * error_rate
+
+
+class RpcPool:
+    """
+    JSON-RPC transport over several endpoints (comma-separated RPC). Each request
+    goes to the endpoint with the best latency/error score and is retried on the
+    next one on failure. Hedged requests are also sent to a second endpoint when the
+    first one is slower than its usual latency percentile, and the first answer wins.
+    """
+
+    def __init__(self, config, transport=None, endpoints=None):
+        self.config = config
+        self.transport = transport or Transport(self.config)
+        self.debug = self.config.get_debug()
+        self.endpoints = [
+            Endpoint(url) for url in (endpoints or self.config.get_rpcs())
+        ]
+        self.max_attempts = 5
+        self.backoff = 0.5
+        self.hedge_percentile = 0.9
+        self.min_hedge_samples = 10
+        self.default_hedge_timeout = 5
+        self.hedges = 0
+        self.scheduler = RpcScheduler(self.config)
+        self.executor = ThreadPoolExecutor(max_workers=32)
+
+    def get_endpoints(self):
+        return sorted(self.endpoints, key=lambda endpoint: endpoint.get_score())
+
+    def get_hedge_timeout(self, endpoint):
+        if len(endpoint.latencies) < self.min_hedge_samples:
+            return self.default_hedge_timeout
+        return endpoint.get_latency_percentile(self.hedge_percentile)
+
+    def post(self, endpoint, payload, cost, priority):
+        self.scheduler.acquire(cost, priority)
+        start = time.monotonic()
+        try:
+            response = self.transport.post(
+                endpoint.url,
+                data=payload,
+                headers={"Content-Type": "application/json"},
+            )
+            if response.status_code == 429:
+                retry_after = response.headers.get("Retry-After")
+                self.scheduler.penalize(
+                    float(retry_after)
+                    if retry_after is not None and retry_after.isdigit()
+                    else None
+                )
+            response.raise_for_status()
+            data = response.json()
+            error, rate_limited = get_retryable_error(data)
+            if error is not None:
+                if rate_limited:
+                    self.scheduler.penalize()
+                raise RetryableResponseError(f"JSON-RPC error: {error}", data)
+        except Exception as e:
+            endpoint.record(False, time.monotonic() - start)
+            if self.debug:
+                print(f"  RPC request to {endpoint.url} failed: {e}")
+            raise
+        endpoint.record(True, time.monotonic() - start)
+        return data
+
+    def send(self, endpoints, payload, hedge, cost, priority):
+        primary = endpoints[0]
+        if not hedge or len(endpoints) < 2:
+            return self.post(primary, payload, cost, priority)
+
+        futures = {
+            self.executor.submit(self.post, primary, payload, cost, priority): primary
+        }
+        done, _ = wait(futures.keys(), timeout=self.get_hedge_timeout(primary))
+        if len(done) == 0:
+            if self.debug:
+                print(f"  Hedging slow RPC request to {endpoints[1].url}")
+            self.hedges += 1
+            hedged = endpoints[1]
+            futures[
+                self.executor.submit(self.post, hedged, payload, cost, priority)
+            ] = hedged
+
+        error = None
+        for future in as_completed(futures.keys()):
+            try:
+                return future.result()
+            except Exception as e:
+                error = e
+        raise error
+
+    def request(self, payload, hedge=False, priority=None):
+        """
+        Sends a JSON-RPC request or batch (a JSON-serializable object or encoded
+        bytes) and returns the decoded response, retrying at the request level.
+        """
+        cost = self.scheduler.get_cost(payload)
+        if not isinstance(payload, (bytes, str)):
+            payload = json.dumps(payload)
+
+        error = None
+        for attempt in range(self.max_attempts):
+            try:
+                return self.send(self.get_endpoints(), payload, hedge, cost, priority)
+            except Exception as e:
+                error = e
+            if attempt + 1 < self.max_attempts:
+                time.sleep(self.backoff * 2**attempt)
+        # The caller (web3) raises the JSON-RPC error of the last response itself
+        if isinstance(error, RetryableResponseError):
+            return error.data
+        raise Exception(
+            f"RPC request failed after {self.max_attempts} attempts: {error}"
+        )
+
+    def get_stats(self):
+        return {
+            "hedges": self.hedges,
+            "transport": self.transport.get_stats(),
+            "scheduler": self.scheduler.get_stats(),
+            "endpoints": [
+                {
+                    "url": endpoint.url,
+                    "requests": endpoint.requests,
+                    "errors": endpoint.errors,
+                    "p50_latency": endpoint.get_latency_percentile(0.5),
+                    "p90_latency": endpoint.get_latency_percentile(0.9),
+                    "score": endpoint.get_score(),
+                }
+                for endpoint in self.endpoints
+            ],
+        }
+
+
+class PooledHTTPProvider(JSONBaseProvider):
+    def __init__(self, rpc_pool):
+        super().__init__()
+        self.rpc_pool = rpc_pool
+
+    def make_request(self, method, params):
+        return self.rpc_pool.request(
+            self.encode_rpc_request(method, params),
+            hedge=method in HEDGED_METHODS,
+        )
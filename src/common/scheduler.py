@@ -0,0 +1,195 @@
+import fcntl
+import heapq
+import itertools
+import json
+import os
+import struct
+import threading
+import time
+
+
+# Lower runs first: requests near the head go before historical backfill
+PRIORITIES = {
+    "head": 0,
+    "backfill": 1,
+}
+
+# Compute units per method (as priced by the usual providers)
+METHOD_COSTS = {
+    "eth_getLogs": 75,
+    "eth_getBlockByNumber": 16,
+    "eth_call": 26,
+    "eth_blockNumber": 10,
+    "eth_chainId": 0,
+    "eth_getFilterChanges": 20,
+    "eth_newBlockFilter": 20,
+}
+DEFAULT_METHOD_COST = 20
+
+# tokens, last refill time, pause end
+BUCKET_STATE = struct.Struct("ddd")
+
+
+class SharedBucket:
+    """
+    Token bucket state (tokens, last refill time, pause end) kept in a small file
+    under an exclusive lock, so that all the scripts using the same file share one
+    budget. Times are wall clock, as they are compared across processes.
+    """
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def read(self, now):
+        data = os.pread(self.fd, BUCKET_STATE.size, 0)
+        if len(data) < BUCKET_STATE.size:
+            return self.capacity, now, 0
+        return BUCKET_STATE.unpack(data)
+
+    def write(self, tokens, updated, paused_until):
+        os.pwrite(self.fd, BUCKET_STATE.pack(tokens, updated, paused_until), 0)
+
+    def update(self, update):
+        """
+        Calls update(tokens, updated, paused_until, now) under the lock and stores
+        the state it returns along with its result, which is returned.
+        """
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            now = time.time()
+            tokens, updated, paused_until = self.read(now)
+            (tokens, updated, paused_until), result = update(
+                tokens, updated, paused_until, now
+            )
+            self.write(tokens, updated, paused_until)
+            return result
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class RpcScheduler:
+    """
+    Token bucket of compute units per second shared by all the RPC calls of the
+    scripts using the same RPC_BUCKET_FILE (per process without it). Waiting requests
+    of a process are served by priority class, then in arrival order, and a 429
+    response pauses the whole bucket. A rate of 0 disables throttling but keeps the
+    429 pauses.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.rate = self.config.get_rpc_cu_per_second()
+        self.capacity = self.rate
+        self.bucket_file = self.config.get_rpc_bucket_file()
+        self.bucket = (
+            SharedBucket(self.bucket_file, self.capacity) if self.bucket_file else None
+        )
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.paused_until = 0
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.counter = itertools.count()
+        self.max_queue_depth = 0
+        self.throttle_time = 0
+        self.throttled_requests = 0
+
+    @staticmethod
+    def get_cost(payload):
+        if isinstance(payload, (bytes, str)):
+            payload = json.loads(payload)
+        requests = payload if isinstance(payload, list) else [payload]
+        return sum(
+            METHOD_COSTS.get(request.get("method"), DEFAULT_METHOD_COST)
+            for request in requests
+        )
+
+    def update_bucket(self, update):
+        if self.bucket is not None:
+            return self.bucket.update(update)
+        (self.tokens, self.updated, self.paused_until), result = update(
+            self.tokens, self.updated, self.paused_until, time.time()
+        )
+        return result
+
+    def take(self, cost):
+        """
+        Takes the cost from the bucket if possible. Returns 0 on success, or the time
+        to wait before trying again.
+        """
+
+        def update(tokens, updated, paused_until, now):
+            tokens = min(self.capacity, tokens + max(0, now - updated) * self.rate)
+            # Costs above the bucket capacity go through on a full bucket
+            needed = min(cost, self.capacity)
+            if now >= paused_until and tokens >= needed:
+                return (tokens - cost, now, paused_until), 0
+            return (tokens, now, paused_until), max(
+                paused_until - now, (needed - tokens) / self.rate, 0.001
+            )
+
+        return self.update_bucket(update)
+
+    def get_pause(self):
+        def update(tokens, updated, paused_until, now):
+            return (tokens, updated, paused_until), paused_until - now
+
+        return self.update_bucket(update)
+
+    def acquire(self, cost, priority=None):
+        """
+        Waits until the cost can be taken from the bucket. The priority class of the
+        call ("head" or "backfill", the default) orders it among the waiting calls of
+        the process.
+        """
+        if self.rate <= 0:
+            delay = self.get_pause()
+            if delay > 0:
+                time.sleep(delay)
+                self.throttle_time += delay
+                self.throttled_requests += 1
+            return
+        ticket = (PRIORITIES[priority or "backfill"], next(self.counter))
+        start = time.monotonic()
+
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            self.max_queue_depth = max(self.max_queue_depth, len(self.waiting))
+            while True:
+                delay = None
+                if self.waiting[0] == ticket:
+                    delay = self.take(cost)
+                    if delay == 0:
+                        heapq.heappop(self.waiting)
+                        break
+                # The others wait until the head of the queue is served
+                self.condition.wait(timeout=delay)
+            self.condition.notify_all()
+
+        throttle_time = time.monotonic() - start
+        if throttle_time > 0.001:
+            self.throttle_time += throttle_time
+            self.throttled_requests += 1
+
+    def penalize(self, retry_after=None):
+        def update(tokens, updated, paused_until, now):
+            return (0, now, max(paused_until, now + (retry_after or 1))), None
+
+        with self.condition:
+            self.update_bucket(update)
+            self.condition.notify_all()
+
+    def get_stats(self):
+        return {
+            "rate": self.rate,
+            "shared": self.bucket is not None,
+            "queue_depth": len(self.waiting),
+            "max_queue_depth": self.max_queue_depth,
+            "throttle_time": self.throttle_time,
+            "throttled_requests": self.throttled_requests,
+        }
@@ -4,6 +4,7 @@ class State:
         self.w3_wrapper = w3_wrapper
         self.storage = storage
         self.name = self.config.get_state_module_name()
+        self.effective_stakes_name = self.config.get_effective_stakes_module_name()
         self.debug = self.config.get_debug()
 
     def get_logs(self, block_number):
@@ -53,7 +54,8 @@ class State:
                 "operator": log["args"]["who"],
                 "network": log["args"]["where"],
                 "status": True,
-            }
+            },
+            log["blockNumber"],
         )
 
     def process_operator_network_opt_in_service_log_opt_out(self, log):
@@ -66,7 +68,8 @@ class State:
                 "operator": log["args"]["who"],
                 "network": log["args"]["where"],
                 "status": False,
-            }
+            },
+            log["blockNumber"],
         )
 
     def process_operator_vault_opt_in_service_log_opt_in(self, log):
@@ -79,7 +82,8 @@ class State:
                 "operator": log["args"]["who"],
                 "vault": log["args"]["where"],
                 "status": True,
-            }
+            },
+            log["blockNumber"],
         )
 
     def process_operator_vault_opt_in_service_log_opt_out(self, log):
@@ -92,7 +96,8 @@ class State:
                 "operator": log["args"]["who"],
                 "vault": log["args"]["where"],
                 "status": False,
-            }
+            },
+            log["blockNumber"],
         )
 
     def process_vault_log_deposit(self, log):
@@ -112,7 +117,8 @@ class State:
                 + log["args"]["shares"],
                 "activeStake": vault_global_state["activeStake"]
                 + log["args"]["amount"],
-            }
+            },
+            log["blockNumber"],
         )
         self.storage.save_vault_user_state(
             {
@@ -137,7 +143,8 @@ class State:
                 - log["args"]["burnedShares"],
                 "activeStake": vault_global_state["activeStake"]
                 - log["args"]["amount"],
-            }
+            },
+            log["blockNumber"],
         )
         vault_user_state = self.storage.get_vault_user_state(
             log["address"], log["args"]["withdrawer"]
@@ -239,7 +246,8 @@ class State:
                     "vault": log["address"],
                     "activeShares": vault_global_state["activeShares"],
                     "activeStake": activeStake_ - activeSlashed,
-                }
+                },
+                log["blockNumber"],
             )
             self.storage.save_vault_global_withdrawals_state(
                 {
@@ -278,7 +286,8 @@ class State:
                     "vault": log["address"],
                     "activeShares": vault_global_state["activeShares"],
                     "activeStake": activeStake_ - activeSlashed,
-                }
+                },
+                log["blockNumber"],
             )
             self.storage.save_vault_global_withdrawals_state(
                 {
@@ -342,7 +351,8 @@ class State:
                 "network": log["args"]["network"],
                 "identifier": log["args"]["identifier"],
                 "maxNetworkLimit": log["args"]["amount"],
-            }
+            },
+            log["blockNumber"],
         )
         if global_vars["delegator_type"] == 0:
             delegator_network_state = self.storage.get_delegator0_network_state(
@@ -360,7 +370,8 @@ class State:
                     "totalOperatorNetworkShares": delegator_network_state[
                         "totalOperatorNetworkShares"
                     ],
-                }
+                },
+                log["blockNumber"],
             )
         elif global_vars["delegator_type"] == 1:
             delegator_network_state = self.storage.get_delegator1_network_state(
@@ -375,7 +386,8 @@ class State:
                         log["args"]["amount"],
                         delegator_network_state["networkLimit"],
                     ),
-                }
+                },
+                log["blockNumber"],
             )
         elif global_vars["delegator_type"] == 2:
             delegator_network_state = self.storage.get_delegator2_network_state(
@@ -390,7 +402,8 @@ class State:
                         log["args"]["amount"],
                         delegator_network_state["networkLimit"],
                     ),
-                }
+                },
+                log["blockNumber"],
             )
         elif global_vars["delegator_type"] == 3:
             pass
@@ -414,7 +427,8 @@ class State:
                     "totalOperatorNetworkShares": delegator_network_state[
                         "totalOperatorNetworkShares"
                     ],
-                }
+                },
+                log["blockNumber"],
             )
         elif global_vars["delegator_type"] == 1:
             delegator_network_state = self.storage.get_delegator1_network_state(
@@ -426,7 +440,8 @@ class State:
                     "network": log["args"]["network"],
                     "identifier": log["args"]["identifier"],
                     "networkLimit": log["args"]["amount"],
-                }
+                },
+                log["blockNumber"],
             )
         elif global_vars["delegator_type"] == 2:
             delegator_network_state = self.storage.get_delegator2_network_state(
@@ -438,7 +453,8 @@ class State:
                     "network": log["args"]["network"],
                     "identifier": log["args"]["identifier"],
                     "networkLimit": log["args"]["amount"],
-                }
+                },
+                log["blockNumber"],
             )
         else:
             raise Exception("Unsupported delegator type")
@@ -463,7 +479,8 @@ class State:
                     "identifier": log["args"]["identifier"],
                     "operator": log["args"]["operator"],
                     "operatorNetworkShares": log["args"]["shares"],
-                }
+                },
+                log["blockNumber"],
             )
             delegator_network_state = self.storage.get_delegator0_network_state(
                 log["address"], log["args"]["network"], log["args"]["identifier"]
@@ -479,7 +496,8 @@ class State:
                     ]
                     - delegator_operator_network_state["operatorNetworkShares"]
                     + log["args"]["shares"],
-                }
+                },
+                log["blockNumber"],
             )
         else:
             raise Exception("Unsupported delegator type")
@@ -496,7 +514,8 @@ class State:
                     "identifier": log["args"]["identifier"],
                     "operator": log["args"]["operator"],
                     "operatorNetworkLimit": log["args"]["amount"],
-                }
+                },
+                log["blockNumber"],
             )
         else:
             raise Exception("Unsupported delegator type")
@@ -545,6 +564,53 @@ class State:
         elif log["event"] == "SetOperatorNetworkLimit":
             self.process_delegator_log_set_operator_network_limit(log)
 
+    def get_effective_stake_scope(self, log):
+        """
+        Return the (vault, network, identifier, operator) filter of the EffectiveStake
+        rows affected by the log (None - any), or None if the log doesn't affect stakes.
+        """
+        if log["event"] in ["OptIn", "OptOut"]:
+            if (
+                log["address"]
+                == self.w3_wrapper.addresses.operator_network_opt_in_service.address
+            ):
+                return (None, log["args"]["where"], None, log["args"]["who"])
+            return (log["args"]["where"], None, None, log["args"]["who"])
+        elif log["event"] in ["Deposit", "Withdraw", "OnSlash"]:
+            return (log["address"], None, None, None)
+        elif log["event"] in [
+            "SetMaxNetworkLimit",
+            "SetNetworkLimit",
+            "SetOperatorNetworkShares",
+            "SetOperatorNetworkLimit",
+        ]:
+            global_vars = self.storage.get_global_vars(log["address"])
+            return (
+                global_vars["vault"],
+                log["args"]["network"],
+                log["args"]["identifier"],
+                None,
+            )
+        return None
+
+    def ensure_effective_stakes(self):
+        last_processed_block = self.storage.get_processed_timepoint(self.name)
+        if last_processed_block is None:
+            return
+        if (
+            self.storage.get_processed_timepoint(self.effective_stakes_name)
+            == last_processed_block
+        ):
+            return
+        print(
+            f"[State] Rebuilding EffectiveStake at block_number={last_processed_block}"
+        )
+        self.storage.rebuild_effective_stakes()
+        self.storage.save_processed_timepoint(
+            self.effective_stakes_name, last_processed_block
+        )
+        self.storage.commit()
+
     def process_block(self, block_number):
         if self.debug:
             print(f"[State] process_block called for block_number={block_number}")
@@ -554,10 +620,20 @@ class State:
                 f"[State] Processing {len(logs)} logs for block_number={block_number}"
             )
 
+        scopes = set()
         for log in logs:
             self.process_log(log)
+            scope = self.get_effective_stake_scope(log)
+            if scope is not None:
+                scopes.add(scope)
+
+        if self.debug:
+            print(f"[State] Refreshing {len(scopes)} EffectiveStake scopes")
+        for vault, network, identifier, operator in scopes:
+            self.storage.refresh_effective_stakes(vault, network, identifier, operator)
 
         if self.debug:
             print(f"[State] Saving processed timepoint for block_number={block_number}")
         self.storage.save_processed_timepoint(self.name, block_number)
+        self.storage.save_processed_timepoint(self.effective_stakes_name, block_number)
         self.storage.commit()
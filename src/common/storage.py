@@ -1,3 +1,4 @@
+import io
 import psycopg2
 from psycopg2.extras import execute_values
 from decimal import *
@@ -26,9 +27,97 @@ def numeric_to_int(db_value) -> int:
     return int(db_value)
 
 
+EVENT_LOG_TABLES = [
+    "OperatorNetworkOptInServiceOptInLogs",
+    "OperatorNetworkOptInServiceOptOutLogs",
+    "OperatorVaultOptInServiceOptInLogs",
+    "OperatorVaultOptInServiceOptOutLogs",
+    "VaultDepositLogs",
+    "VaultWithdrawLogs",
+    "VaultOnSlashLogs",
+    "VaultTransferLogs",
+    "DelegatorSetMaxNetworkLimitLogs",
+    "DelegatorSetNetworkLimitLogs",
+    "DelegatorSetOperatorNetworkSharesLogs",
+    "DelegatorSetOperatorNetworkLimitLogs",
+]
+
+
+# State tables that may be versioned by block ranges (see Storage.save_state_history).
+# valid_from_block/valid_to_block are inclusive, valid_to_block IS NULL for the current version.
+STATE_HISTORY_TABLES = {
+    "OperatorNetworkOptInServiceState": {
+        "keys": {"operator": "CHAR(42)", "network": "CHAR(42)"},
+        "values": {"status": "BOOLEAN"},
+    },
+    "OperatorVaultOptInServiceState": {
+        "keys": {"operator": "CHAR(42)", "vault": "CHAR(42)"},
+        "values": {"status": "BOOLEAN"},
+    },
+    "VaultGlobalState": {
+        "keys": {"vault": "CHAR(42)"},
+        "values": {"activeShares": "NUMERIC(78,0)", "activeStake": "NUMERIC(78,0)"},
+    },
+    "DelegatorNetworkState": {
+        "keys": {
+            "delegator": "CHAR(42)",
+            "network": "CHAR(42)",
+            "identifier": "NUMERIC(78,0)",
+        },
+        "values": {"maxNetworkLimit": "NUMERIC(78,0)"},
+    },
+    "Delegator0NetworkState": {
+        "keys": {
+            "delegator": "CHAR(42)",
+            "network": "CHAR(42)",
+            "identifier": "NUMERIC(78,0)",
+        },
+        "values": {
+            "networkLimit": "NUMERIC(78,0)",
+            "totalOperatorNetworkShares": "NUMERIC(78,0)",
+        },
+    },
+    "Delegator0OperatorNetworkState": {
+        "keys": {
+            "delegator": "CHAR(42)",
+            "network": "CHAR(42)",
+            "identifier": "NUMERIC(78,0)",
+            "operator": "CHAR(42)",
+        },
+        "values": {"operatorNetworkShares": "NUMERIC(78,0)"},
+    },
+    "Delegator1NetworkState": {
+        "keys": {
+            "delegator": "CHAR(42)",
+            "network": "CHAR(42)",
+            "identifier": "NUMERIC(78,0)",
+        },
+        "values": {"networkLimit": "NUMERIC(78,0)"},
+    },
+    "Delegator1OperatorNetworkState": {
+        "keys": {
+            "delegator": "CHAR(42)",
+            "network": "CHAR(42)",
+            "identifier": "NUMERIC(78,0)",
+            "operator": "CHAR(42)",
+        },
+        "values": {"operatorNetworkLimit": "NUMERIC(78,0)"},
+    },
+    "Delegator2NetworkState": {
+        "keys": {
+            "delegator": "CHAR(42)",
+            "network": "CHAR(42)",
+            "identifier": "NUMERIC(78,0)",
+        },
+        "values": {"networkLimit": "NUMERIC(78,0)"},
+    },
+}
+
+
 class Storage:
     def __init__(self, config, test=False, copy=False, init=False):
         self.config = config
+        self.state_history = self.config.get_state_history()
 
         if test and copy:
             test_data = self.config.get_storage_data(test=True)
@@ -531,6 +620,39 @@ class Storage:
             """
         )
 
+        # State history (versioned copies of the state tables)
+        for table, columns in STATE_HISTORY_TABLES.items():
+            keys = ", ".join(columns["keys"])
+            definitions = ",\n".join(
+                f"                {name} {type_}"
+                for name, type_ in {**columns["keys"], **columns["values"]}.items()
+            )
+            self.cursor.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {table}History (
+{definitions},
+                    valid_from_block BIGINT,
+                    valid_to_block BIGINT,
+                    PRIMARY KEY ({keys}, valid_from_block)
+                );
+                """
+            )
+
+        # EffectiveStake (denormalized stake per network, maintained by State)
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS EffectiveStake (
+                network CHAR(42),
+                identifier NUMERIC(78,0),
+                operator CHAR(42),
+                vault CHAR(42),
+                collateral CHAR(42),
+                stake NUMERIC(78,0),
+                PRIMARY KEY (network, identifier, vault, operator)
+            );
+            """
+        )
+
         # Points
         self.cursor.execute(
             """
@@ -913,6 +1035,27 @@ class Storage:
                 """
             )
 
+            self.cursor.execute(
+                """
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_effectivestake_vault
+                ON EffectiveStake(vault);
+                """
+            )
+            self.cursor.execute(
+                """
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_effectivestake_operator
+                ON EffectiveStake(operator);
+                """
+            )
+
+            for table in STATE_HISTORY_TABLES:
+                self.cursor.execute(
+                    f"""
+                    CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_{table.lower()}history_range
+                    ON {table}History USING GIST (int8range(valid_from_block, valid_to_block, '[]'));
+                    """
+                )
+
             self.cursor.execute(
                 """
                 CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_networkopvaultpoints_operator
@@ -987,9 +1130,70 @@ class Storage:
     def commit(self):
         self.connection.commit()
 
+    def rollback(self):
+        self.connection.rollback()
+
     def close(self):
         self.connection.close()
 
+    # -------------------------------------------------------------------------
+    # Bulk ingestion
+    # -------------------------------------------------------------------------
+    def copy_rows(
+        self,
+        table: str,
+        columns: list,
+        rows: list,
+        conflict_columns: list,
+        update_columns: list = None,
+    ):
+        """
+        COPY rows into the temporary {table}Staging table and move them into the table
+        with a single INSERT ... SELECT ... ON CONFLICT DO NOTHING, or DO UPDATE of
+        update_columns when given.
+        The staging table is private to the transaction (dropped on commit), so
+        concurrent scripts never lock each other on it.
+        Nothing is committed here, so the rows land together with the caller's timepoint.
+        """
+        if len(rows) == 0:
+            return
+        staging_table = f"{table}Staging"
+        columns_str = ", ".join(columns)
+
+        self.cursor.execute(
+            f"""
+            CREATE TEMP TABLE IF NOT EXISTS {staging_table} (LIKE {table})
+            ON COMMIT DROP
+            """
+        )
+
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write(
+                "\t".join("\\N" if value is None else str(value) for value in row)
+                + "\n"
+            )
+        buffer.seek(0)
+        self.cursor.copy_expert(
+            f"COPY {staging_table} ({columns_str}) FROM STDIN", buffer
+        )
+
+        conflict_action = (
+            "DO UPDATE SET "
+            + ", ".join(f"{column} = EXCLUDED.{column}" for column in update_columns)
+            if update_columns
+            else "DO NOTHING"
+        )
+        self.cursor.execute(
+            f"""
+            INSERT INTO {table} ({columns_str})
+            SELECT {columns_str} FROM {staging_table}
+            ON CONFLICT ({", ".join(conflict_columns)})
+            {conflict_action}
+            """
+        )
+        self.cursor.execute(f"DELETE FROM {staging_table}")
+
     # -------------------------------------------------------------------------
     # Drop State Data
     # -------------------------------------------------------------------------
@@ -1006,6 +1210,9 @@ class Storage:
         self.cursor.execute("DROP TABLE IF EXISTS Delegator1NetworkState;")
         self.cursor.execute("DROP TABLE IF EXISTS Delegator1OperatorNetworkState;")
         self.cursor.execute("DROP TABLE IF EXISTS Delegator2NetworkState;")
+        for table in STATE_HISTORY_TABLES:
+            self.cursor.execute(f"DROP TABLE IF EXISTS {table}History;")
+        self.cursor.execute("DROP TABLE IF EXISTS EffectiveStake;")
 
         self.cursor.execute(
             """
@@ -1013,6 +1220,12 @@ class Storage:
             """,
             (self.config.get_state_module_name(),),
         )
+        self.cursor.execute(
+            """
+            DELETE FROM ProcessedTimepoints WHERE name=%s
+            """,
+            (self.config.get_effective_stakes_module_name(),),
+        )
         self.commit()
 
     # -------------------------------------------------------------------------
@@ -1034,6 +1247,18 @@ class Storage:
             (block["number"], block["timestamp"], block["hash"]),
         )
 
+    def save_blocks_data(self, blocks: list):
+        """
+        Bulk upsert into BlocksData
+        """
+        self.copy_rows(
+            "BlocksData",
+            ["number", "timestamp", "hash"],
+            [(block["number"], block["timestamp"], block["hash"]) for block in blocks],
+            ["number"],
+            update_columns=["timestamp", "hash"],
+        )
+
     def get_block_data(self, block_number: int):
         self.cursor.execute(
             "SELECT timestamp, hash FROM BlocksData WHERE number=%s",
@@ -1056,6 +1281,91 @@ class Storage:
         row = self.cursor.fetchone()
         return row[0] if row else None
 
+    def get_first_block_number_after_timestamp(self, timestamp: int):
+        self.cursor.execute(
+            "SELECT MIN(number) FROM BlocksData WHERE timestamp>%s",
+            (timestamp,),
+        )
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+
+    def get_blocks_data(self, from_block: int, to_block: int):
+        self.cursor.execute(
+            """
+            SELECT number, timestamp, hash FROM BlocksData
+            WHERE number BETWEEN %s AND %s
+            """,
+            (from_block, to_block),
+        )
+        return [
+            {"number": r[0], "timestamp": r[1], "hash": r[2]}
+            for r in self.cursor.fetchall()
+        ]
+
+    def get_blocks_timestamps(self, from_block: int, to_block: int):
+        self.cursor.execute(
+            """
+            SELECT number, timestamp FROM BlocksData
+            WHERE number BETWEEN %s AND %s
+            ORDER BY number
+            """,
+            (from_block, to_block),
+        )
+        return self.cursor.fetchall()
+
+    def get_blocks_by_timestamp_range(self, from_timestamp: int, to_timestamp: int):
+        """
+        (number, timestamp) rows of the blocks in the time range and of the last
+        block before it, ordered by timestamp
+        """
+        self.cursor.execute(
+            """
+            SELECT number, timestamp FROM (
+                SELECT number, timestamp FROM BlocksData
+                WHERE timestamp BETWEEN %s AND %s
+                UNION ALL
+                (
+                    SELECT number, timestamp FROM BlocksData
+                    WHERE timestamp < %s
+                    ORDER BY timestamp DESC, number DESC
+                    LIMIT 1
+                )
+            ) AS blocks
+            ORDER BY timestamp, number
+            """,
+            (from_timestamp, to_timestamp, from_timestamp),
+        )
+        return self.cursor.fetchall()
+
+    def get_block_hashes(self, from_block: int, to_block: int):
+        self.cursor.execute(
+            "SELECT number, hash FROM BlocksData WHERE number BETWEEN %s AND %s",
+            (from_block, to_block),
+        )
+        return {r[0]: r[1] for r in self.cursor.fetchall()}
+
+    # -------------------------------------------------------------------------
+    # Reorg rollback
+    # -------------------------------------------------------------------------
+    def rollback_above_block(self, block_number: int, names: list):
+        """
+        Delete the blocks and event logs above block_number and move the given
+        modules' timepoints back to it (used by ReorgGuard, not committed here).
+        """
+        self.cursor.execute("DELETE FROM BlocksData WHERE number > %s", (block_number,))
+        for table in EVENT_LOG_TABLES:
+            self.cursor.execute(
+                f"DELETE FROM {table} WHERE block_number > %s", (block_number,)
+            )
+        self.cursor.execute(
+            """
+            UPDATE ProcessedTimepoints
+            SET timepoint = %s
+            WHERE name = ANY(%s) AND timepoint > %s
+            """,
+            (block_number, names, block_number),
+        )
+
     # -------------------------------------------------------------------------
     # ProcessedTimepoints
     # -------------------------------------------------------------------------
@@ -1315,6 +1625,34 @@ class Storage:
             ),
         )
 
+    def save_prices(self, prices: list):
+        """
+        Bulk upsert into Prices, the last price of a (collateral, block_number) wins
+        """
+        rows = {
+            (price_data["collateral"], price_data["block_number"]): int_to_numeric(
+                price_data["price"]
+            )
+            for price_data in prices
+        }
+        if len(rows) == 0:
+            return
+        execute_values(
+            self.cursor,
+            """
+            INSERT INTO Prices (collateral, block_number, price)
+            VALUES %s
+            ON CONFLICT (collateral, block_number)
+            DO UPDATE SET
+                price = EXCLUDED.price
+            """,
+            [
+                (collateral, block_number, price)
+                for (collateral, block_number), price in rows.items()
+            ],
+            page_size=10000,
+        )
+
     def get_price(self, collateral: str, block_number: int):
         """
         Return the *latest* price at or before block_number
@@ -1361,37 +1699,47 @@ class Storage:
             for r in rows
         ]
 
+    def get_state_change_block_numbers(self, from_block: int, to_block: int):
+        """
+        Ascending numbers of the blocks between from_block and to_block with a log
+        processed by the state or with a price, i.e. the only blocks after which the
+        points rates can change.
+        """
+        tables = EVENT_LOG_TABLES + ["Prices"]
+        self.cursor.execute(
+            " UNION ".join(
+                f"SELECT block_number FROM {table} WHERE block_number BETWEEN %s AND %s"
+                for table in tables
+            )
+            + " ORDER BY block_number",
+            (from_block, to_block) * len(tables),
+        )
+        return [r[0] for r in self.cursor.fetchall()]
+
     # -------------------------------------------------------------------------
     # OperatorNetworkOptInService logs
     # -------------------------------------------------------------------------
     def save_operator_network_opt_in_service_logs(self, logs: list):
+        rows = {"OptIn": [], "OptOut": []}
         for log in logs:
-            block_num = log["blockNumber"]
-            log_index = log["logIndex"]
-            who = log["args"]["who"]
-            where_ = log["args"]["where"]
-
-            if log["event"] == "OptIn":
-                self.cursor.execute(
-                    """
-                    INSERT INTO OperatorNetworkOptInServiceOptInLogs (block_number, log_index, who, where_)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (block_number, log_index)
-                    DO NOTHING
-                    """,
-                    (block_num, log_index, who, where_),
-                )
-            elif log["event"] == "OptOut":
-                self.cursor.execute(
-                    """
-                    INSERT INTO OperatorNetworkOptInServiceOptOutLogs (block_number, log_index, who, where_)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (block_number, log_index)
-                    DO NOTHING
-                    """,
-                    (block_num, log_index, who, where_),
+            if log["event"] in rows:
+                rows[log["event"]].append(
+                    (
+                        log["blockNumber"],
+                        log["logIndex"],
+                        log["args"]["who"],
+                        log["args"]["where"],
+                    )
                 )
 
+        for event, event_rows in rows.items():
+            self.copy_rows(
+                f"OperatorNetworkOptInService{event}Logs",
+                ["block_number", "log_index", "who", "where_"],
+                event_rows,
+                ["block_number", "log_index"],
+            )
+
     def get_operator_network_opt_in_service_logs(self, from_block: int, to_block: int):
         self.cursor.execute(
             """
@@ -1424,33 +1772,26 @@ class Storage:
     # OperatorVaultOptInService logs
     # -------------------------------------------------------------------------
     def save_operator_vault_opt_in_service_logs(self, logs: list):
+        rows = {"OptIn": [], "OptOut": []}
         for log in logs:
-            block_num = log["blockNumber"]
-            log_index = log["logIndex"]
-            who = log["args"]["who"]
-            where_ = log["args"]["where"]
-
-            if log["event"] == "OptIn":
-                self.cursor.execute(
-                    """
-                    INSERT INTO OperatorVaultOptInServiceOptInLogs (block_number, log_index, who, where_)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (block_number, log_index)
-                    DO NOTHING
-                    """,
-                    (block_num, log_index, who, where_),
-                )
-            elif log["event"] == "OptOut":
-                self.cursor.execute(
-                    """
-                    INSERT INTO OperatorVaultOptInServiceOptOutLogs (block_number, log_index, who, where_)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (block_number, log_index)
-                    DO NOTHING
-                    """,
-                    (block_num, log_index, who, where_),
+            if log["event"] in rows:
+                rows[log["event"]].append(
+                    (
+                        log["blockNumber"],
+                        log["logIndex"],
+                        log["args"]["who"],
+                        log["args"]["where"],
+                    )
                 )
 
+        for event, event_rows in rows.items():
+            self.copy_rows(
+                f"OperatorVaultOptInService{event}Logs",
+                ["block_number", "log_index", "who", "where_"],
+                event_rows,
+                ["block_number", "log_index"],
+            )
+
     def get_operator_vault_opt_in_service_logs(self, from_block: int, to_block: int):
         self.cursor.execute(
             """
@@ -1483,117 +1824,113 @@ class Storage:
     # Vault Logs
     # -------------------------------------------------------------------------
     def save_vault_logs(self, logs: list):
+        deposit_rows = []
+        withdraw_rows = []
+        onslash_rows = []
+        transfer_rows = []
         for log in logs:
             block_num = log["blockNumber"]
             log_index = log["logIndex"]
             vault = log["address"]
 
             if log["event"] == "Deposit":
-                self.cursor.execute(
-                    """
-                    INSERT INTO VaultDepositLogs (
-                        block_number,
-                        log_index,
-                        vault,
-                        depositor,
-                        onBehalfOf,
-                        amount,
-                        shares
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (block_number, log_index, vault)
-                    DO NOTHING
-                    """,
+                deposit_rows.append(
                     (
                         block_num,
                         log_index,
                         vault,
                         log["args"]["depositor"],
                         log["args"]["onBehalfOf"],
-                        int_to_numeric(log["args"]["amount"]),
-                        int_to_numeric(log["args"]["shares"]),
-                    ),
+                        log["args"]["amount"],
+                        log["args"]["shares"],
+                    )
                 )
-
             elif log["event"] == "Withdraw":
-                self.cursor.execute(
-                    """
-                    INSERT INTO VaultWithdrawLogs (
-                        block_number,
-                        log_index,
-                        vault,
-                        withdrawer,
-                        claimer,
-                        amount,
-                        burnedShares,
-                        mintedShares
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (block_number, log_index, vault)
-                    DO NOTHING
-                    """,
+                withdraw_rows.append(
                     (
                         block_num,
                         log_index,
                         vault,
                         log["args"]["withdrawer"],
                         log["args"]["claimer"],
-                        int_to_numeric(log["args"]["amount"]),
-                        int_to_numeric(log["args"]["burnedShares"]),
-                        int_to_numeric(log["args"]["mintedShares"]),
-                    ),
+                        log["args"]["amount"],
+                        log["args"]["burnedShares"],
+                        log["args"]["mintedShares"],
+                    )
                 )
-
             elif log["event"] == "OnSlash":
-                self.cursor.execute(
-                    """
-                    INSERT INTO VaultOnSlashLogs (
-                        block_number,
-                        log_index,
-                        vault,
-                        amount,
-                        captureTimestamp,
-                        slashedAmount
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (block_number, log_index, vault)
-                    DO NOTHING
-                    """,
+                onslash_rows.append(
                     (
                         block_num,
                         log_index,
                         vault,
-                        int_to_numeric(log["args"]["amount"]),
+                        log["args"]["amount"],
                         log["args"]["captureTimestamp"],
-                        int_to_numeric(log["args"]["slashedAmount"]),
-                    ),
+                        log["args"]["slashedAmount"],
+                    )
                 )
-
             elif log["event"] == "Transfer":
-                self.cursor.execute(
-                    """
-                    INSERT INTO VaultTransferLogs (
-                        block_number,
-                        log_index,
-                        vault,
-                        from_,
-                        to_,
-                        value
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (block_number, log_index, vault)
-                    DO NOTHING
-                    """,
+                transfer_rows.append(
                     (
                         block_num,
                         log_index,
                         vault,
                         log["args"]["from"],
                         log["args"]["to"],
-                        int_to_numeric(log["args"]["value"]),
-                    ),
+                        log["args"]["value"],
+                    )
                 )
 
+        conflict_columns = ["block_number", "log_index", "vault"]
+        self.copy_rows(
+            "VaultDepositLogs",
+            [
+                "block_number",
+                "log_index",
+                "vault",
+                "depositor",
+                "onBehalfOf",
+                "amount",
+                "shares",
+            ],
+            deposit_rows,
+            conflict_columns,
+        )
+        self.copy_rows(
+            "VaultWithdrawLogs",
+            [
+                "block_number",
+                "log_index",
+                "vault",
+                "withdrawer",
+                "claimer",
+                "amount",
+                "burnedShares",
+                "mintedShares",
+            ],
+            withdraw_rows,
+            conflict_columns,
+        )
+        self.copy_rows(
+            "VaultOnSlashLogs",
+            [
+                "block_number",
+                "log_index",
+                "vault",
+                "amount",
+                "captureTimestamp",
+                "slashedAmount",
+            ],
+            onslash_rows,
+            conflict_columns,
+        )
+        self.copy_rows(
+            "VaultTransferLogs",
+            ["block_number", "log_index", "vault", "from_", "to_", "value"],
+            transfer_rows,
+            conflict_columns,
+        )
+
     def get_vault_logs(self, from_block: int, to_block: int):
         """
         Return the combined deposit, withdraw, onSlash, transfer logs between from_block and to_block.
@@ -1737,126 +2074,65 @@ class Storage:
     # -------------------------------------------------------------------------
     def save_delegator_logs(self, logs: list):
         """
-        Similar upsert logic for delegator logs (SetMaxNetworkLimit, etc.).
+        Similar bulk ingestion for delegator logs (SetMaxNetworkLimit, etc.).
         We replace the subnetwork-identifier logic with numeric columns in Postgres.
         """
+        rows = {
+            "SetMaxNetworkLimit": [],
+            "SetNetworkLimit": [],
+            "SetOperatorNetworkShares": [],
+            "SetOperatorNetworkLimit": [],
+        }
         for log in logs:
-            block_num = log["blockNumber"]
-            log_index = log["logIndex"]
-            delegator = log["address"]
+            if log["event"] not in rows:
+                continue
             subnetwork_hex = log["args"]["subnetwork"].hex()
-            network_str = Helpers.get_network(subnetwork_hex)
-            identifier_int = Helpers.get_identifier(subnetwork_hex)
-            amount_int = log["args"].get("amount", 0)
-
-            if log["event"] == "SetMaxNetworkLimit":
-                self.cursor.execute(
-                    """
-                    INSERT INTO DelegatorSetMaxNetworkLimitLogs (
-                        block_number,
-                        log_index,
-                        delegator,
-                        network,
-                        identifier,
-                        amount
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (block_number, log_index, delegator)
-                    DO NOTHING
-                    """,
-                    (
-                        block_num,
-                        log_index,
-                        delegator,
-                        network_str,
-                        int_to_numeric(identifier_int),
-                        int_to_numeric(amount_int),
-                    ),
-                )
-
-            elif log["event"] == "SetNetworkLimit":
-                self.cursor.execute(
-                    """
-                    INSERT INTO DelegatorSetNetworkLimitLogs (
-                        block_number,
-                        log_index,
-                        delegator,
-                        network,
-                        identifier,
-                        amount
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (block_number, log_index, delegator)
-                    DO NOTHING
-                    """,
-                    (
-                        block_num,
-                        log_index,
-                        delegator,
-                        network_str,
-                        int_to_numeric(identifier_int),
-                        int_to_numeric(amount_int),
-                    ),
-                )
+            row = (
+                log["blockNumber"],
+                log["logIndex"],
+                log["address"],
+                Helpers.get_network(subnetwork_hex),
+                Helpers.get_identifier(subnetwork_hex),
+            )
 
+            if log["event"] in ("SetMaxNetworkLimit", "SetNetworkLimit"):
+                rows[log["event"]].append(row + (log["args"].get("amount", 0),))
             elif log["event"] == "SetOperatorNetworkShares":
-                operator = log["args"]["operator"]
-                shares_int = log["args"].get("shares", 0)
-                self.cursor.execute(
-                    """
-                    INSERT INTO DelegatorSetOperatorNetworkSharesLogs (
-                        block_number,
-                        log_index,
-                        delegator,
-                        network,
-                        identifier,
-                        operator,
-                        shares
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (block_number, log_index, delegator)
-                    DO NOTHING
-                    """,
-                    (
-                        block_num,
-                        log_index,
-                        delegator,
-                        network_str,
-                        int_to_numeric(identifier_int),
-                        operator,
-                        int_to_numeric(shares_int),
-                    ),
+                rows[log["event"]].append(
+                    row + (log["args"]["operator"], log["args"].get("shares", 0))
                 )
-
             elif log["event"] == "SetOperatorNetworkLimit":
-                operator = log["args"]["operator"]
-                amount_int = log["args"].get("amount", 0)
-                self.cursor.execute(
-                    """
-                    INSERT INTO DelegatorSetOperatorNetworkLimitLogs (
-                        block_number,
-                        log_index,
-                        delegator,
-                        network,
-                        identifier,
-                        operator,
-                        amount
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (block_number, log_index, delegator)
-                    DO NOTHING
-                    """,
-                    (
-                        block_num,
-                        log_index,
-                        delegator,
-                        network_str,
-                        int_to_numeric(identifier_int),
-                        operator,
-                        int_to_numeric(amount_int),
-                    ),
+                rows[log["event"]].append(
+                    row + (log["args"]["operator"], log["args"].get("amount", 0))
                 )
 
+        columns = ["block_number", "log_index", "delegator", "network", "identifier"]
+        conflict_columns = ["block_number", "log_index", "delegator"]
+        self.copy_rows(
+            "DelegatorSetMaxNetworkLimitLogs",
+            columns + ["amount"],
+            rows["SetMaxNetworkLimit"],
+            conflict_columns,
+        )
+        self.copy_rows(
+            "DelegatorSetNetworkLimitLogs",
+            columns + ["amount"],
+            rows["SetNetworkLimit"],
+            conflict_columns,
+        )
+        self.copy_rows(
+            "DelegatorSetOperatorNetworkSharesLogs",
+            columns + ["operator", "shares"],
+            rows["SetOperatorNetworkShares"],
+            conflict_columns,
+        )
+        self.copy_rows(
+            "DelegatorSetOperatorNetworkLimitLogs",
+            columns + ["operator", "amount"],
+            rows["SetOperatorNetworkLimit"],
+            conflict_columns,
+        )
+
     def get_delegator_logs(self, from_block: int, to_block: int):
         """
         Return all four delegator logs between from_block and to_block.
@@ -1996,13 +2272,55 @@ class Storage:
             + set_operator_network_limit_logs
         )
 
+    # -------------------------------------------------------------------------
+    # State history
+    # -------------------------------------------------------------------------
+    def save_state_history(self, table: str, values: tuple, block_number: int):
+        """
+        Close the open version of a state row and open a new one at block_number.
+        `values` holds the key columns followed by the value columns of the table.
+        """
+        columns = STATE_HISTORY_TABLES[table]
+        keys = list(columns["keys"])
+        names = keys + list(columns["values"])
+        key_filter = " AND ".join(f"{key}=%s" for key in keys)
+        placeholders = ", ".join(["%s"] * len(names))
+        updates = ", ".join(f"{name} = EXCLUDED.{name}" for name in columns["values"])
+
+        self.cursor.execute(
+            f"""
+            UPDATE {table}History
+            SET valid_to_block = %s
+            WHERE {key_filter}
+                AND valid_to_block IS NULL
+                AND valid_from_block < %s
+            """,
+            (block_number - 1, *values[: len(keys)], block_number),
+        )
+        self.cursor.execute(
+            f"""
+            INSERT INTO {table}History ({", ".join(names)}, valid_from_block, valid_to_block)
+            VALUES ({placeholders}, %s, NULL)
+            ON CONFLICT ({", ".join(keys)}, valid_from_block)
+            DO UPDATE SET {updates}
+            """,
+            (*values, block_number),
+        )
+
     # -------------------------------------------------------------------------
     # OperatorNetworkOptInServiceState
     # -------------------------------------------------------------------------
-    def save_operator_network_opt_in_service_state(self, state: dict):
+    def save_operator_network_opt_in_service_state(
+        self, state: dict, block_number: int = None
+    ):
         """
         Upsert operator, network, status (as boolean).
         """
+        values = (
+            state["operator"],
+            state["network"],
+            True if state["status"] else False,
+        )
         self.cursor.execute(
             """
             INSERT INTO OperatorNetworkOptInServiceState (
@@ -2015,17 +2333,24 @@ class Storage:
             DO UPDATE SET
                 status = EXCLUDED.status
             """,
-            (
-                state["operator"],
-                state["network"],
-                True if state["status"] else False,
-            ),
+            values,
         )
+        if block_number is not None and self.state_history:
+            self.save_state_history(
+                "OperatorNetworkOptInServiceState", values, block_number
+            )
 
     # -------------------------------------------------------------------------
     # OperatorVaultOptInServiceState
     # -------------------------------------------------------------------------
-    def save_operator_vault_opt_in_service_state(self, state: dict):
+    def save_operator_vault_opt_in_service_state(
+        self, state: dict, block_number: int = None
+    ):
+        values = (
+            state["operator"],
+            state["vault"],
+            True if state["status"] else False,
+        )
         self.cursor.execute(
             """
             INSERT INTO OperatorVaultOptInServiceState (
@@ -2038,17 +2363,22 @@ class Storage:
             DO UPDATE SET
                 status = EXCLUDED.status
             """,
-            (
-                state["operator"],
-                state["vault"],
-                True if state["status"] else False,
-            ),
+            values,
         )
+        if block_number is not None and self.state_history:
+            self.save_state_history(
+                "OperatorVaultOptInServiceState", values, block_number
+            )
 
     # -------------------------------------------------------------------------
     # VaultGlobalState
     # -------------------------------------------------------------------------
-    def save_vault_global_state(self, state: dict):
+    def save_vault_global_state(self, state: dict, block_number: int = None):
+        values = (
+            state["vault"],
+            int_to_numeric(state["activeShares"]),
+            int_to_numeric(state["activeStake"]),
+        )
         self.cursor.execute(
             """
             INSERT INTO VaultGlobalState (
@@ -2062,12 +2392,10 @@ class Storage:
                 activeShares = EXCLUDED.activeShares,
                 activeStake = EXCLUDED.activeStake
             """,
-            (
-                state["vault"],
-                int_to_numeric(state["activeShares"]),
-                int_to_numeric(state["activeStake"]),
-            ),
+            values,
         )
+        if block_number is not None and self.state_history:
+            self.save_state_history("VaultGlobalState", values, block_number)
 
     def get_vault_global_state(self, vault_address: str):
         self.cursor.execute(
@@ -2210,7 +2538,13 @@ class Storage:
     # -------------------------------------------------------------------------
     # DelegatorNetworkState
     # -------------------------------------------------------------------------
-    def save_delegator_network_state(self, state: dict):
+    def save_delegator_network_state(self, state: dict, block_number: int = None):
+        values = (
+            state["delegator"],
+            state["network"],
+            int_to_numeric(state["identifier"]),
+            int_to_numeric(state["maxNetworkLimit"]),
+        )
         self.cursor.execute(
             """
             INSERT INTO DelegatorNetworkState (
@@ -2224,18 +2558,22 @@ class Storage:
             DO UPDATE SET
                 maxNetworkLimit = EXCLUDED.maxNetworkLimit
             """,
-            (
-                state["delegator"],
-                state["network"],
-                int_to_numeric(state["identifier"]),
-                int_to_numeric(state["maxNetworkLimit"]),
-            ),
+            values,
         )
+        if block_number is not None and self.state_history:
+            self.save_state_history("DelegatorNetworkState", values, block_number)
 
     # -------------------------------------------------------------------------
     # Delegator0NetworkState
     # -------------------------------------------------------------------------
-    def save_delegator0_network_state(self, state: dict):
+    def save_delegator0_network_state(self, state: dict, block_number: int = None):
+        values = (
+            state["delegator"],
+            state["network"],
+            int_to_numeric(state["identifier"]),
+            int_to_numeric(state["networkLimit"]),
+            int_to_numeric(state["totalOperatorNetworkShares"]),
+        )
         self.cursor.execute(
             """
             INSERT INTO Delegator0NetworkState (
@@ -2251,14 +2589,10 @@ class Storage:
                 networkLimit = EXCLUDED.networkLimit,
                 totalOperatorNetworkShares = EXCLUDED.totalOperatorNetworkShares
             """,
-            (
-                state["delegator"],
-                state["network"],
-                int_to_numeric(state["identifier"]),
-                int_to_numeric(state["networkLimit"]),
-                int_to_numeric(state["totalOperatorNetworkShares"]),
-            ),
+            values,
         )
+        if block_number is not None and self.state_history:
+            self.save_state_history("Delegator0NetworkState", values, block_number)
 
     def get_delegator0_network_state(
         self, delegator_address: str, network: str, identifier: int
@@ -2280,7 +2614,16 @@ class Storage:
         else:
             return {"networkLimit": 0, "totalOperatorNetworkShares": 0}
 
-    def save_delegator0_operator_network_state(self, state: dict):
+    def save_delegator0_operator_network_state(
+        self, state: dict, block_number: int = None
+    ):
+        values = (
+            state["delegator"],
+            state["network"],
+            int_to_numeric(state["identifier"]),
+            state["operator"],
+            int_to_numeric(state["operatorNetworkShares"]),
+        )
         self.cursor.execute(
             """
             INSERT INTO Delegator0OperatorNetworkState (
@@ -2295,14 +2638,12 @@ class Storage:
             DO UPDATE SET
                 operatorNetworkShares = EXCLUDED.operatorNetworkShares
             """,
-            (
-                state["delegator"],
-                state["network"],
-                int_to_numeric(state["identifier"]),
-                state["operator"],
-                int_to_numeric(state["operatorNetworkShares"]),
-            ),
+            values,
         )
+        if block_number is not None and self.state_history:
+            self.save_state_history(
+                "Delegator0OperatorNetworkState", values, block_number
+            )
 
     def get_delegator0_operator_network_state(
         self,
@@ -2328,7 +2669,13 @@ class Storage:
     # -------------------------------------------------------------------------
     # Delegator1NetworkState
     # -------------------------------------------------------------------------
-    def save_delegator1_network_state(self, state: dict):
+    def save_delegator1_network_state(self, state: dict, block_number: int = None):
+        values = (
+            state["delegator"],
+            state["network"],
+            int_to_numeric(state["identifier"]),
+            int_to_numeric(state["networkLimit"]),
+        )
         self.cursor.execute(
             """
             INSERT INTO Delegator1NetworkState (
@@ -2342,13 +2689,10 @@ class Storage:
             DO UPDATE SET
                 networkLimit = EXCLUDED.networkLimit
             """,
-            (
-                state["delegator"],
-                state["network"],
-                int_to_numeric(state["identifier"]),
-                int_to_numeric(state["networkLimit"]),
-            ),
+            values,
         )
+        if block_number is not None and self.state_history:
+            self.save_state_history("Delegator1NetworkState", values, block_number)
 
     def get_delegator1_network_state(
         self, delegator_address: str, network: str, identifier: int
@@ -2367,7 +2711,16 @@ class Storage:
         else:
             return {"networkLimit": 0}
 
-    def save_delegator1_operator_network_state(self, state: dict):
+    def save_delegator1_operator_network_state(
+        self, state: dict, block_number: int = None
+    ):
+        values = (
+            state["delegator"],
+            state["network"],
+            int_to_numeric(state["identifier"]),
+            state["operator"],
+            int_to_numeric(state["operatorNetworkLimit"]),
+        )
         self.cursor.execute(
             """
             INSERT INTO Delegator1OperatorNetworkState (
@@ -2382,19 +2735,23 @@ class Storage:
             DO UPDATE SET
                 operatorNetworkLimit = EXCLUDED.operatorNetworkLimit
             """,
-            (
-                state["delegator"],
-                state["network"],
-                int_to_numeric(state["identifier"]),
-                state["operator"],
-                int_to_numeric(state["operatorNetworkLimit"]),
-            ),
+            values,
         )
+        if block_number is not None and self.state_history:
+            self.save_state_history(
+                "Delegator1OperatorNetworkState", values, block_number
+            )
 
     # -------------------------------------------------------------------------
     # Delegator2NetworkState
     # -------------------------------------------------------------------------
-    def save_delegator2_network_state(self, state: dict):
+    def save_delegator2_network_state(self, state: dict, block_number: int = None):
+        values = (
+            state["delegator"],
+            state["network"],
+            int_to_numeric(state["identifier"]),
+            int_to_numeric(state["networkLimit"]),
+        )
         self.cursor.execute(
             """
             INSERT INTO Delegator2NetworkState (
@@ -2408,13 +2765,10 @@ class Storage:
             DO UPDATE SET
                 networkLimit = EXCLUDED.networkLimit
             """,
-            (
-                state["delegator"],
-                state["network"],
-                int_to_numeric(state["identifier"]),
-                int_to_numeric(state["networkLimit"]),
-            ),
+            values,
         )
+        if block_number is not None and self.state_history:
+            self.save_state_history("Delegator2NetworkState", values, block_number)
 
     def get_delegator2_network_state(
         self, delegator_address: str, network: str, identifier: int
@@ -2436,9 +2790,23 @@ class Storage:
     # -------------------------------------------------------------------------
     # get_stakes(...) and get_all_stakes(...)
     # -------------------------------------------------------------------------
-    def get_stakes(self, network: str, identifier: int):
-        self.cursor.execute(
-            """
+    def get_stakes_query(self, columns: str, condition: str, block_number=None):
+        """
+        Build the effective stake query for one (network, identifier) pair.
+        With block_number the state is read from the *History tables at that block.
+        """
+        tables = {}
+        for table in STATE_HISTORY_TABLES:
+            if block_number is None:
+                tables[table] = table
+            else:
+                tables[
+                    table
+                ] = f"""(
+                    SELECT * FROM {table}History
+                    WHERE int8range(valid_from_block, valid_to_block, '[]') @> %(block_number)s::BIGINT
+                )"""
+        return f"""
             WITH combined AS (
                 SELECT 
                     gv.vault,
@@ -2463,53 +2831,58 @@ class Storage:
                     END AS isValidOperator,
                     CASE
                         WHEN gv.delegator_type NOT IN (3) THEN 1
-                        WHEN %s = gv.network THEN 1
+                        WHEN %(network)s = gv.network THEN 1
                         ELSE 0
                     END AS isValidNetwork
                 FROM GlobalVars gv
-                JOIN VaultGlobalState vgs ON vgs.vault = gv.vault
+                JOIN {tables["VaultGlobalState"]} vgs ON vgs.vault = gv.vault
                 JOIN Collaterals c ON c.collateral = gv.collateral
 
-                LEFT JOIN DelegatorNetworkState dns
+                LEFT JOIN {tables["DelegatorNetworkState"]} dns
                     ON dns.delegator = gv.delegator
-                    AND dns.network = %s
-                    AND dns.identifier = %s
+                    AND dns.network = %(network)s
+                    AND dns.identifier = %(identifier)s
 
-                LEFT JOIN Delegator0NetworkState d0ns
+                LEFT JOIN {tables["Delegator0NetworkState"]} d0ns
                     ON d0ns.delegator = gv.delegator
-                    AND d0ns.network = %s
-                    AND d0ns.identifier = %s
-                LEFT JOIN Delegator0OperatorNetworkState d0ons
+                    AND d0ns.network = %(network)s
+                    AND d0ns.identifier = %(identifier)s
+                LEFT JOIN {tables["Delegator0OperatorNetworkState"]} d0ons
                     ON d0ons.delegator = gv.delegator
-                    AND d0ons.network = %s
-                    AND d0ons.identifier = %s
+                    AND d0ons.network = %(network)s
+                    AND d0ons.identifier = %(identifier)s
 
-                LEFT JOIN Delegator1NetworkState d1ns
+                LEFT JOIN {tables["Delegator1NetworkState"]} d1ns
                     ON d1ns.delegator = gv.delegator
-                    AND d1ns.network = %s
-                    AND d1ns.identifier = %s
-                LEFT JOIN Delegator1OperatorNetworkState d1ons
+                    AND d1ns.network = %(network)s
+                    AND d1ns.identifier = %(identifier)s
+                LEFT JOIN {tables["Delegator1OperatorNetworkState"]} d1ons
                     ON d1ons.delegator = gv.delegator
-                    AND d1ons.network = %s
-                    AND d1ons.identifier = %s
+                    AND d1ons.network = %(network)s
+                    AND d1ons.identifier = %(identifier)s
 
-                LEFT JOIN Delegator2NetworkState d2ns
+                LEFT JOIN {tables["Delegator2NetworkState"]} d2ns
                     ON d2ns.delegator = gv.delegator
-                    AND d2ns.network = %s
-                    AND d2ns.identifier = %s
+                    AND d2ns.network = %(network)s
+                    AND d2ns.identifier = %(identifier)s
 
-                LEFT JOIN OperatorNetworkOptInServiceState onos
+                LEFT JOIN {tables["OperatorNetworkOptInServiceState"]} onos
                     ON onos.operator = COALESCE(d0ons.operator, d1ons.operator, gv.operator)
-                    AND onos.network = %s
+                    AND onos.network = %(network)s
 
-                LEFT JOIN OperatorVaultOptInServiceState ovos
+                LEFT JOIN {tables["OperatorVaultOptInServiceState"]} ovos
                     ON ovos.operator = COALESCE(d0ons.operator, d1ons.operator, gv.operator)
                     AND ovos.vault = gv.vault
             ),
             calculated AS (
                 SELECT 
-                    vault,
-                    operator,
+                    *,
+                    CASE delegator_type
+                        WHEN 0 THEN networkLimit0
+                        WHEN 1 THEN networkLimit1
+                        WHEN 2 THEN networkLimit2
+                        ELSE 0
+                    END AS networkLimit,
                     stake(
                         delegator_type,
                         COALESCE(isOptedInNetwork::int, 0),
@@ -2527,29 +2900,166 @@ class Storage:
                         COALESCE(operatorNetworkLimit, 0),
                         isValidOperator,
                         isValidNetwork
-                    ) AS computed_stake,
-                    collateral_address
+                    ) AS computed_stake
                 FROM combined
                 WHERE operator IS NOT NULL
             )
-            SELECT * FROM calculated WHERE computed_stake != 0
-            """,
-            (
-                network,
-                network,
-                int_to_numeric(identifier),
-                network,
-                int_to_numeric(identifier),
-                network,
-                int_to_numeric(identifier),
-                network,
-                int_to_numeric(identifier),
-                network,
-                int_to_numeric(identifier),
-                network,
-                int_to_numeric(identifier),
-                network,
+            SELECT {columns} FROM calculated WHERE {condition}
+            """
+
+    def get_stakes(self, network: str, identifier: int):
+        self.cursor.execute(
+            self.get_stakes_query(
+                "vault, operator, computed_stake, collateral_address",
+                "computed_stake != 0",
             ),
+            {"network": network, "identifier": int_to_numeric(identifier)},
+        )
+        return [
+            {
+                "network": network,
+                "identifier": identifier,
+                "vault": r[0],
+                "operator": r[1],
+                "stake": numeric_to_int(r[2]),
+                "collateral": r[3],
+            }
+            for r in self.cursor.fetchall()
+        ]
+
+    def get_stake_inputs_at(self, network: str, identifier: int, block_number: int):
+        """
+        Return the stake inputs of every vault for a network as they were right after
+        block_number was applied. Reads the *History tables only (requires STATE_HISTORY).
+        """
+        self.cursor.execute(
+            self.get_stakes_query(
+                """
+                vault,
+                operator,
+                delegator_type,
+                activeStake,
+                maxNetworkLimit,
+                networkLimit,
+                operatorNetworkShares,
+                totalOperatorNetworkShares,
+                operatorNetworkLimit,
+                isOptedInNetwork,
+                isOptedInVault,
+                computed_stake,
+                collateral_address
+                """,
+                "TRUE",
+                block_number,
+            ),
+            {
+                "network": network,
+                "identifier": int_to_numeric(identifier),
+                "block_number": block_number,
+            },
+        )
+        return [
+            {
+                "network": network,
+                "identifier": identifier,
+                "vault": r[0],
+                "operator": r[1],
+                "delegator_type": r[2],
+                "activeStake": numeric_to_int(r[3]),
+                "maxNetworkLimit": numeric_to_int(r[4]),
+                "networkLimit": numeric_to_int(r[5]),
+                "operatorNetworkShares": numeric_to_int(r[6]),
+                "totalOperatorNetworkShares": numeric_to_int(r[7]),
+                "operatorNetworkLimit": numeric_to_int(r[8]),
+                "isOptedInNetwork": r[9],
+                "isOptedInVault": r[10],
+                "stake": numeric_to_int(r[11]),
+                "collateral": r[12],
+            }
+            for r in self.cursor.fetchall()
+        ]
+
+    # -------------------------------------------------------------------------
+    # EffectiveStake
+    # -------------------------------------------------------------------------
+    def refresh_effective_stakes(
+        self,
+        vault: str = None,
+        network: str = None,
+        identifier: int = None,
+        operator: str = None,
+    ):
+        """
+        Recompute the EffectiveStake rows matching the given filters
+        (all rows of every points network if no filter is given).
+        """
+        conditions = [
+            f"{column}=%({column})s"
+            for column, value in (
+                ("vault", vault),
+                ("operator", operator),
+            )
+            if value is not None
+        ]
+        for network_points_data in self.get_all_networks_points_data():
+            if network is not None and network_points_data["network"] != network:
+                continue
+            if (
+                identifier is not None
+                and network_points_data["identifier"] != identifier
+            ):
+                continue
+            params = {
+                "network": network_points_data["network"],
+                "identifier": int_to_numeric(network_points_data["identifier"]),
+                "vault": vault,
+                "operator": operator,
+            }
+            self.cursor.execute(
+                f"""
+                DELETE FROM EffectiveStake
+                WHERE network=%(network)s AND identifier=%(identifier)s
+                {"".join(f" AND {condition}" for condition in conditions)}
+                """,
+                params,
+            )
+            self.cursor.execute(
+                """
+                INSERT INTO EffectiveStake (
+                    network,
+                    identifier,
+                    operator,
+                    vault,
+                    collateral,
+                    stake
+                )
+                """
+                + self.get_stakes_query(
+                    """
+                    %(network)s,
+                    %(identifier)s,
+                    operator,
+                    vault,
+                    collateral_address,
+                    computed_stake
+                    """,
+                    " AND ".join(["computed_stake != 0"] + conditions),
+                ),
+                params,
+            )
+
+    def rebuild_effective_stakes(self):
+        self.cursor.execute("DELETE FROM EffectiveStake")
+        self.refresh_effective_stakes()
+
+    def get_effective_stakes(self, network: str, identifier: int):
+        self.cursor.execute(
+            """
+            SELECT vault, operator, stake, collateral
+            FROM EffectiveStake
+            WHERE network=%s AND identifier=%s
+            """,
+            (network, int_to_numeric(identifier)),
         )
         return [
             {
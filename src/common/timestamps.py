@@ -0,0 +1,224 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import mmap
+import os
+
+
+# Post-merge blocks are one slot apart unless slots are missed
+SLOT_TIME = 12
+
+FORMAT_VERSION = 1
+# version, last block, runs count, exceptions count
+HEADER_SIZE = 4
+SYNC_RANGE = 100000
+
+
+class TimestampStore:
+    """
+    Compact block timestamps: runs of consecutive blocks SLOT_TIME seconds apart,
+    stored as (start block, start timestamp, count), and the blocks outside any run
+    as (block, timestamp) exceptions. The columns are kept in a file of int64 values
+    that is memory-mapped, so lookups are bisections over a few megabytes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.last_block = None
+        self.run_blocks = array("q")
+        self.run_timestamps = array("q")
+        self.run_counts = array("q")
+        self.exception_blocks = array("q")
+        self.exception_timestamps = array("q")
+        self.mmap = None
+        self.values = None
+        if os.path.exists(self.path):
+            self.map()
+
+    def unmap(self):
+        if self.mmap is None:
+            return
+        # The column views must be released before the mapping can be closed
+        for column in [
+            self.run_blocks,
+            self.run_timestamps,
+            self.run_counts,
+            self.exception_blocks,
+            self.exception_timestamps,
+        ]:
+            if isinstance(column, memoryview):
+                column.release()
+        self.values.release()
+        self.mmap.close()
+        self.mmap = None
+        self.values = None
+
+    def map(self):
+        self.unmap()
+        with open(self.path, "rb") as store_file:
+            self.mmap = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        values = self.values = memoryview(self.mmap).cast("q")
+        version, last_block, runs_count, exceptions_count = values[:HEADER_SIZE]
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported timestamp store version {version}")
+
+        self.last_block = last_block
+        columns = []
+        offset = HEADER_SIZE
+        for count in [runs_count] * 3 + [exceptions_count] * 2:
+            columns.append(values[offset : offset + count])
+            offset += count
+        (
+            self.run_blocks,
+            self.run_timestamps,
+            self.run_counts,
+            self.exception_blocks,
+            self.exception_timestamps,
+        ) = columns
+
+    def save(self, columns, last_block):
+        run_blocks, _, _, exception_blocks, _ = columns
+        values = array(
+            "q", [FORMAT_VERSION, last_block, len(run_blocks), len(exception_blocks)]
+        )
+        for column in columns:
+            values.extend(column)
+        with open(self.path + ".tmp", "wb") as store_file:
+            values.tofile(store_file)
+        os.replace(self.path + ".tmp", self.path)
+        self.map()
+
+    def extend(self, rows):
+        """
+        Appends (number, timestamp) rows above the last block, in order.
+        """
+        if len(rows) == 0:
+            return
+        columns = [
+            array("q", column)
+            for column in [
+                self.run_blocks,
+                self.run_timestamps,
+                self.run_counts,
+                self.exception_blocks,
+                self.exception_timestamps,
+            ]
+        ]
+        (
+            run_blocks,
+            run_timestamps,
+            run_counts,
+            exception_blocks,
+            exception_timestamps,
+        ) = columns
+
+        last_block = self.last_block
+        last_timestamp = (
+            self.get_timestamp(last_block) if last_block is not None else None
+        )
+        for number, timestamp in rows:
+            if (
+                last_block is not None
+                and number == last_block + 1
+                and timestamp == last_timestamp + SLOT_TIME
+            ):
+                if (
+                    len(run_blocks) != 0
+                    and run_blocks[-1] + run_counts[-1] - 1 == last_block
+                ):
+                    run_counts[-1] += 1
+                else:
+                    # The previous block was an exception, it starts a new run
+                    exception_blocks.pop()
+                    exception_timestamps.pop()
+                    run_blocks.append(last_block)
+                    run_timestamps.append(last_timestamp)
+                    run_counts.append(2)
+            else:
+                exception_blocks.append(number)
+                exception_timestamps.append(timestamp)
+            last_block, last_timestamp = number, timestamp
+
+        self.save(columns, last_block)
+
+    def sync(self, storage, to_block):
+        """
+        Appends the BlocksData rows up to to_block. It should not go beyond the
+        finalized and processed blocks, so that the stored blocks never change.
+        """
+        from_block = self.last_block + 1 if self.last_block is not None else 0
+        for range_from_block in range(from_block, to_block + 1, SYNC_RANGE):
+            self.extend(
+                storage.get_blocks_timestamps(
+                    range_from_block, min(to_block, range_from_block + SYNC_RANGE - 1)
+                )
+            )
+
+    def get_timestamp(self, block_number):
+        i = bisect_right(self.run_blocks, block_number) - 1
+        if i >= 0 and block_number < self.run_blocks[i] + self.run_counts[i]:
+            return self.run_timestamps[i] + SLOT_TIME * (
+                block_number - self.run_blocks[i]
+            )
+        j = bisect_left(self.exception_blocks, block_number)
+        if j < len(self.exception_blocks) and self.exception_blocks[j] == block_number:
+            return self.exception_timestamps[j]
+        return None
+
+    def get_block_number_by_timestamp(self, timestamp):
+        """
+        Returns the last stored block with a timestamp not above the given one,
+        or None if there is none.
+        """
+        block_number = None
+        i = bisect_right(self.run_timestamps, timestamp) - 1
+        if i >= 0:
+            block_number = self.run_blocks[i] + min(
+                self.run_counts[i] - 1,
+                (timestamp - self.run_timestamps[i]) // SLOT_TIME,
+            )
+        j = bisect_right(self.exception_timestamps, timestamp) - 1
+        if j >= 0 and (block_number is None or self.exception_blocks[j] > block_number):
+            block_number = self.exception_blocks[j]
+        return block_number
+
+    def get_last_timestamp(self):
+        if self.last_block is None:
+            return None
+        return self.get_timestamp(self.last_block)
+
+
+class TimestampIndex:
+    """
+    Sorted timestamps and block numbers of BlocksData in a time window (plus the
+    last block before it), to map timestamps to blocks with bisections in memory.
+    """
+
+    def __init__(self, storage, from_timestamp, to_timestamp):
+        self.from_timestamp = from_timestamp
+        self.to_timestamp = to_timestamp
+        rows = storage.get_blocks_by_timestamp_range(from_timestamp, to_timestamp)
+        self.block_numbers = array("q", [row[0] for row in rows])
+        self.timestamps = array("q", [row[1] for row in rows])
+
+    def covers(self, timestamp):
+        return self.from_timestamp <= timestamp <= self.to_timestamp
+
+    def get_block_number_by_timestamp(self, timestamp):
+        """
+        Returns the last block with a timestamp not above the given one, or None if
+        there is none. The timestamp must be covered by the window.
+        """
+        i = bisect_right(self.timestamps, timestamp) - 1
+        return self.block_numbers[i] if i >= 0 else None
+
+    def get_block_numbers_by_timestamps(self, timestamps):
+        """
+        Maps ascending timestamps covered by the window with one merge pass.
+        """
+        block_numbers = []
+        i = -1
+        for timestamp in timestamps:
+            while i + 1 < len(self.timestamps) and self.timestamps[i + 1] <= timestamp:
+                i += 1
+            block_numbers.append(self.block_numbers[i] if i >= 0 else None)
+        return block_numbers
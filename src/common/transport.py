@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class Host:
+    def __init__(self, max_connections):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        self.latencies = deque(maxlen=1000)
+        self.requests = 0
+        self.errors = 0
+
+
+class Transport:
+    """
+    Outbound HTTP for the whole process: one keep-alive session per host with at most
+    HTTP_MAX_PER_HOST concurrent requests, compressed responses, connect/read timeouts
+    and per-host latency metrics.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.timeout = (
+            self.config.get_http_connect_timeout(),
+            self.config.get_http_read_timeout(),
+        )
+        self.max_per_host = self.config.get_http_max_per_host()
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def get_host(self, url):
+        netloc = urlsplit(url).netloc
+        with self.lock:
+            host = self.hosts.get(netloc)
+            if host is None:
+                host = self.hosts[netloc] = Host(self.max_per_host)
+        return host
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        host = self.get_host(url)
+        with host.semaphore:
+            start = time.monotonic()
+            try:
+                response = host.session.request(method, url, **kwargs)
+            except Exception:
+                host.errors += 1
+                raise
+            finally:
+                host.requests += 1
+                host.latencies.append(time.monotonic() - start)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get_stats(self):
+        stats = {}
+        for netloc, host in list(self.hosts.items()):
+            latencies = sorted(host.latencies)
+            stats[netloc] = {
+                "requests": host.requests,
+                "errors": host.errors,
+                "p50_latency": latencies[len(latencies) // 2] if latencies else None,
+                "p90_latency": (
+                    latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))]
+                    if latencies
+                    else None
+                ),
+            }
+        return stats
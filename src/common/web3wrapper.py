@@ -1,39 +1,278 @@
 from functools import lru_cache
 from web3 import Web3
-import requests
+from web3._utils.method_formatters import log_entry_formatter
+from web3.datastructures import AttributeDict
 
 from .constants import ABIS, Addresses
 from .helpers import Helpers
+from .logfetcher import LogFetcher
+from .rpcpool import RpcPool, PooledHTTPProvider
+from .timestamps import SLOT_TIME, TimestampStore, TimestampIndex
+from .blockcache import BlockCache
+from .transport import Transport
 
 
 class Web3Wrapper:
     def __init__(self, config, storage):
         self.config = config
         self.storage = storage
-        self.w3 = Web3(Web3.HTTPProvider(self.config.get_rpc()))
+        self.transport = Transport(self.config)
+        self.rpc_pool = RpcPool(self.config, self.transport)
+        self.w3 = Web3(PooledHTTPProvider(self.rpc_pool))
         self.addresses = Addresses(self)
+        self.timestamp_store = None
+        self.timestamp_index = None
+        self.block_cache = BlockCache(self.config, self.storage)
+        self.sparse_blocks = self.config.get_blocks_sparse()
+        self.blocks_batch_size = self.config.get_blocks_batch_size()
 
-    @lru_cache(maxsize=None)
     def get_block_data(self, block_number, full=False):
         if full == False:
-            block_data = self.storage.get_block_data(block_number)
+            block_data = self.block_cache.get(block_number)
             if block_data != None:
                 return block_data
         block_data = self.w3.eth.get_block(block_number)
         self.storage.save_block_data(block_data)
+        if full == False:
+            self.block_cache.put(
+                {
+                    "number": block_data["number"],
+                    "timestamp": block_data["timestamp"],
+                    "hash": block_data["hash"],
+                }
+            )
         return block_data
 
-    @lru_cache(maxsize=None)
+    def fetch_blocks(self, block_numbers):
+        """
+        Fetches the headers of the given blocks with batch requests and stores them
+        (committed together with the caller's data). Returns the fetched block data.
+        """
+        fetched_blocks = []
+        for i in range(0, len(block_numbers), self.blocks_batch_size):
+            json = [
+                {
+                    "method": "eth_getBlockByNumber",
+                    "params": [hex(block_number), False],
+                    "id": j,
+                    "jsonrpc": "2.0",
+                }
+                for j, block_number in enumerate(
+                    block_numbers[i : i + self.blocks_batch_size]
+                )
+            ]
+            blocks = [
+                {
+                    "number": int(response_data["result"]["number"], 16),
+                    "timestamp": int(response_data["result"]["timestamp"], 16),
+                    "hash": response_data["result"]["hash"],
+                }
+                for response_data in self.rpc_pool.request(json, hedge=True)
+            ]
+            self.storage.save_blocks_data(blocks)
+            for block_data in blocks:
+                self.block_cache.put(block_data)
+            fetched_blocks.extend(blocks)
+        return fetched_blocks
+
+    def ensure_blocks(self, block_numbers):
+        """
+        Sparse blocks mode: makes sure the given blocks (ascending) are stored,
+        fetching only the missing ones with batch requests.
+        """
+        if len(block_numbers) == 0:
+            return
+        stored_numbers = set(
+            row[0]
+            for row in self.storage.get_blocks_timestamps(
+                block_numbers[0], block_numbers[-1]
+            )
+        )
+        self.fetch_blocks(
+            [
+                block_number
+                for block_number in block_numbers
+                if block_number not in stored_numbers
+            ]
+        )
+
+    def find_block_by_timestamp(self, timestamp):
+        return self.find_blocks_by_timestamps([timestamp])[0]
+
+    def find_blocks_by_timestamps(self, timestamps):
+        """
+        Sparse blocks mode: searches the last block with a timestamp not above each
+        given one between the closest stored blocks, guessing from the slot time and
+        falling back to bisection. The searches advance in rounds, and the headers
+        probed by a round are fetched together with batch requests and stored.
+        """
+        block_numbers = {}
+        # timestamp -> [lower block, its timestamp, upper block, its timestamp, guess]
+        searches = {}
+        for timestamp in set(timestamps):
+            lower_block = self.storage.get_block_number_by_timestamp(timestamp)
+            if lower_block is None:
+                lower_block = (
+                    self.get_creation_block(self.addresses.vault_factory.address) - 100
+                )
+                if self.get_block_timestamp(lower_block) > timestamp:
+                    block_numbers[timestamp] = None
+                    continue
+            upper_block = self.storage.get_first_block_number_after_timestamp(timestamp)
+            if upper_block is None:
+                # The last processed block is stored, so no later block can qualify
+                block_numbers[timestamp] = lower_block
+                continue
+            searches[timestamp] = [
+                lower_block,
+                self.get_block_timestamp(lower_block),
+                upper_block,
+                self.get_block_timestamp(upper_block),
+                True,
+            ]
+
+        while len(searches) != 0:
+            probes = {}
+            for timestamp, search in list(searches.items()):
+                lower_block, lower_timestamp, upper_block, upper_timestamp, guess = (
+                    search
+                )
+                if upper_block - lower_block <= 1:
+                    block_numbers[timestamp] = lower_block
+                    del searches[timestamp]
+                    continue
+                if guess:
+                    # Blocks are at least a slot apart, the answer is at most this guess
+                    middle_block = min(
+                        lower_block + (timestamp - lower_timestamp) // SLOT_TIME,
+                        lower_block
+                        + (timestamp - lower_timestamp)
+                        * (upper_block - lower_block)
+                        // (upper_timestamp - lower_timestamp),
+                    )
+                else:
+                    middle_block = (lower_block + upper_block) // 2
+                probes[timestamp] = min(
+                    max(middle_block, lower_block + 1), upper_block - 1
+                )
+
+            # The probes lie between stored blocks, so none of them is stored yet
+            probed_timestamps = {
+                block_data["number"]: block_data["timestamp"]
+                for block_data in self.fetch_blocks(sorted(set(probes.values())))
+            }
+            for timestamp, middle_block in probes.items():
+                search = searches[timestamp]
+                middle_timestamp = probed_timestamps[middle_block]
+                if middle_timestamp <= timestamp:
+                    search[0:2] = [middle_block, middle_timestamp]
+                    search[4] = True
+                else:
+                    search[2:4] = [middle_block, middle_timestamp]
+                    search[4] = not search[4]
+        return [block_numbers[timestamp] for timestamp in timestamps]
+
+    def get_timestamp_store(self):
+        """
+        Returns the compact timestamp store if TIMESTAMPS_FILE is set, synced once
+        per process up to the finalized and processed blocks.
+        """
+        if self.timestamp_store is None and self.config.get_timestamps_file():
+            self.timestamp_store = TimestampStore(self.config.get_timestamps_file())
+            last_processed_block = self.storage.get_processed_timepoint(
+                self.config.get_blocks_module_name()
+            )
+            if last_processed_block is not None:
+                self.timestamp_store.sync(
+                    self.storage,
+                    min(last_processed_block, self.get_finalized_block()),
+                )
+        return self.timestamp_store
+
     def get_block_timestamp(self, block_number):
+        timestamp_store = self.get_timestamp_store()
+        if timestamp_store is not None:
+            timestamp = timestamp_store.get_timestamp(block_number)
+            if timestamp is not None:
+                return timestamp
         block_data = self.get_block_data(block_number)
         return block_data["timestamp"]
 
+    def load_timestamp_index(self, from_timestamp, to_timestamp):
+        """
+        Loads the blocks of the time window into memory for the following
+        get_block_number_by_timestamp calls.
+        """
+        if self.sparse_blocks:
+            return
+        self.timestamp_index = TimestampIndex(
+            self.storage, from_timestamp, to_timestamp
+        )
+
+    def get_block_number_by_timestamp(self, timestamp):
+        if self.sparse_blocks:
+            return self.find_block_by_timestamp(timestamp)
+        if self.timestamp_index is not None and self.timestamp_index.covers(timestamp):
+            return self.timestamp_index.get_block_number_by_timestamp(timestamp)
+        timestamp_store = self.get_timestamp_store()
+        # Later blocks are only in BlocksData
+        if timestamp_store is not None and timestamp <= (
+            timestamp_store.get_last_timestamp() or -1
+        ):
+            block_number = timestamp_store.get_block_number_by_timestamp(timestamp)
+            if block_number is not None:
+                return block_number
+        return self.storage.get_block_number_by_timestamp(timestamp)
+
+    def get_block_numbers_by_timestamps(self, timestamps):
+        """
+        Maps ascending timestamps to blocks, in memory if the loaded index covers them.
+        """
+        if self.sparse_blocks:
+            return self.find_blocks_by_timestamps(timestamps)
+        if (
+            len(timestamps) != 0
+            and self.timestamp_index is not None
+            and self.timestamp_index.covers(timestamps[0])
+            and self.timestamp_index.covers(timestamps[-1])
+        ):
+            return self.timestamp_index.get_block_numbers_by_timestamps(timestamps)
+        return [
+            self.get_block_number_by_timestamp(timestamp) for timestamp in timestamps
+        ]
+
+    def get_logs(self, filter_params, priority=None):
+        """
+        eth_getLogs through the RPC pool with the scheduler priority of the call,
+        formatted like w3.eth.get_logs.
+        """
+        params = {
+            "fromBlock": hex(filter_params["fromBlock"]),
+            "toBlock": hex(filter_params["toBlock"]),
+            "topics": LogFetcher.format_topics(filter_params.get("topics")),
+        }
+        if filter_params.get("address") is not None:
+            params["address"] = filter_params["address"]
+        response = self.rpc_pool.request(
+            {"jsonrpc": "2.0", "id": 1, "method": "eth_getLogs", "params": [params]},
+            hedge=True,
+            priority=priority,
+        )
+        if "error" in response:
+            raise ValueError(response["error"])
+        return [AttributeDict(log_entry_formatter(log)) for log in response["result"]]
+
     def get_block_number(self):
         return self.w3.eth.block_number
 
     def get_finalized_block(self):
         return self.get_block_number() - 160
 
+    def get_target_block(self):
+        if self.config.get_follow_head():
+            return self.get_block_number() - self.config.get_head_confirmations()
+        return self.get_finalized_block()
+
     @lru_cache(maxsize=None)
     def get_chain_id(self):
         return self.w3.eth.chain_id
@@ -48,7 +287,7 @@ class Web3Wrapper:
             "contractaddresses": contract_address,
             "apikey": self.config.get_blockscout_api_key(),
         }
-        response = requests.get(api_url, params=params)
+        response = self.transport.get(api_url, params=params)
         Helpers.raise_for_status_with_log(response)
         data = response.json()
 
@@ -58,7 +297,7 @@ class Web3Wrapper:
             "txhash": data["result"][0]["txHash"],
             "apikey": self.config.get_blockscout_api_key(),
         }
-        response = requests.get(api_url, params=params)
+        response = self.transport.get(api_url, params=params)
         Helpers.raise_for_status_with_log(response)
         data = response.json()
         return int(data["result"]["blockNumber"])
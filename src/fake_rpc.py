@@ -0,0 +1,308 @@
+from bisect import bisect_left, bisect_right
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from common.config import Config
+from common.transport import Transport
+
+
+# Infura's error for eth_getLogs results above its cap, which the fetchers split on
+TOO_MANY_RESULTS_CODE = -32005
+
+
+def to_int(value):
+    if isinstance(value, int):
+        return value
+    return int(value, 16)
+
+
+class FixtureRecorder:
+    """
+    Forwards the JSON-RPC requests to the upstream RPC unchanged and appends every
+    successful (method, params, result) call to the fixture file.
+    """
+
+    def __init__(self, config, fixture_path):
+        self.config = config
+        self.debug = self.config.get_debug()
+        self.upstream = self.config.get_fake_rpc_upstream()
+        self.transport = Transport(self.config)
+        self.fixture_path = fixture_path
+        self.lock = threading.Lock()
+        self.recorded = 0
+
+    def handle(self, body):
+        response = self.transport.post(
+            self.upstream,
+            data=body,
+            headers={"Content-Type": "application/json"},
+        )
+        if response.status_code == 200:
+            self.record(json.loads(body), response.json())
+        return response.status_code, response.content
+
+    def record(self, payload, response_data):
+        requests_list = payload if isinstance(payload, list) else [payload]
+        responses = (
+            response_data if isinstance(response_data, list) else [response_data]
+        )
+        responses_by_id = {response.get("id"): response for response in responses}
+
+        with self.lock:
+            with open(self.fixture_path, "a") as fixture_file:
+                for request in requests_list:
+                    response = responses_by_id.get(request.get("id"))
+                    if response is None or "result" not in response:
+                        continue
+                    fixture_file.write(
+                        json.dumps(
+                            {
+                                "method": request["method"],
+                                "params": request.get("params", []),
+                                "result": response["result"],
+                            }
+                        )
+                        + "\n"
+                    )
+                    self.recorded += 1
+        if self.debug:
+            print(f"  Recorded {self.recorded} calls")
+
+
+class FixtureStore:
+    """
+    Serves recorded calls. Logs are indexed by block and filtered by range, address
+    and topics, so that any split of a recorded range is answered; blocks are looked
+    up by number or recorded tag; other calls must match a recorded one exactly
+    (eth_call also falls back to the same call at another block).
+    """
+
+    def __init__(self, fixture_path):
+        self.logs = {}
+        self.blocks = {}
+        self.block_tags = {}
+        self.calls = {}
+        self.latest_calls = {}
+        self.results = {}
+
+        with open(fixture_path, "r") as fixture_file:
+            for line in fixture_file:
+                entry = json.loads(line)
+                self.add(entry["method"], entry["params"], entry["result"])
+        self.log_blocks = sorted(self.logs.keys())
+
+    @staticmethod
+    def get_key(method, params):
+        return json.dumps([method, params], sort_keys=True)
+
+    def add(self, method, params, result):
+        if method == "eth_getLogs":
+            for log in result:
+                block_logs = self.logs.setdefault(to_int(log["blockNumber"]), {})
+                block_logs[to_int(log["logIndex"])] = log
+        elif method == "eth_getBlockByNumber":
+            if result is None:
+                return
+            block_number = to_int(result["number"])
+            self.blocks[(block_number, params[1])] = result
+            if not params[0].startswith("0x"):
+                self.block_tags[params[0]] = block_number
+        elif method == "eth_call":
+            self.calls[self.get_key(method, params)] = result
+            self.latest_calls[self.get_key(method, params[0])] = result
+        else:
+            self.results[self.get_key(method, params)] = result
+
+    def get_block_number(self, tag):
+        if isinstance(tag, int) or tag.startswith("0x"):
+            return to_int(tag)
+        if tag in self.block_tags:
+            return self.block_tags[tag]
+        if tag == "earliest":
+            return 0
+        return max(self.block_tags.values(), default=0)
+
+    @staticmethod
+    def match_topics(log_topics, topics):
+        for i, topic in enumerate(topics):
+            if topic is None:
+                continue
+            if i >= len(log_topics):
+                return False
+            options = topic if isinstance(topic, list) else [topic]
+            if log_topics[i].lower() not in [option.lower() for option in options]:
+                return False
+        return True
+
+    def get_logs(self, filter_params):
+        from_block = self.get_block_number(filter_params.get("fromBlock", "latest"))
+        to_block = self.get_block_number(filter_params.get("toBlock", "latest"))
+        addresses = filter_params.get("address")
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        address_set = (
+            set(address.lower() for address in addresses)
+            if addresses is not None
+            else None
+        )
+        topics = filter_params.get("topics") or []
+
+        logs = []
+        start = bisect_left(self.log_blocks, from_block)
+        end = bisect_right(self.log_blocks, to_block)
+        for block_number in self.log_blocks[start:end]:
+            block_logs = self.logs[block_number]
+            for log_index in sorted(block_logs):
+                log = block_logs[log_index]
+                if (
+                    address_set is not None
+                    and log["address"].lower() not in address_set
+                ):
+                    continue
+                if self.match_topics(log["topics"], topics):
+                    logs.append(log)
+        return logs
+
+    def call(self, method, params):
+        """
+        Returns the recorded result, or raises KeyError for calls that were not recorded.
+        """
+        if method == "eth_getLogs":
+            return self.get_logs(params[0])
+        if method == "eth_getBlockByNumber":
+            return self.blocks.get((self.get_block_number(params[0]), params[1]))
+        if method == "eth_call":
+            key = self.get_key(method, params)
+            if key in self.calls:
+                return self.calls[key]
+            return self.latest_calls[self.get_key(method, params[0])]
+        return self.results[self.get_key(method, params)]
+
+
+class FixtureReplayer:
+    """
+    Answers JSON-RPC requests from a FixtureStore with the configured latency, and
+    injects provider-side failures: rate limiting, random errors, oversized batches and
+    eth_getLogs results above a cap.
+    """
+
+    def __init__(self, config, fixture_path):
+        self.config = config
+        self.debug = self.config.get_debug()
+        self.store = FixtureStore(fixture_path)
+        self.latency = self.config.get_fake_rpc_latency()
+        self.max_results = self.config.get_fake_rpc_max_results()
+        self.max_batch_size = self.config.get_fake_rpc_max_batch_size()
+        self.error_rate = self.config.get_fake_rpc_error_rate()
+        self.rate_limit_rate = self.config.get_fake_rpc_rate_limit_rate()
+
+    @staticmethod
+    def error(request, code, message):
+        return {
+            "jsonrpc": "2.0",
+            "id": request.get("id"),
+            "error": {"code": code, "message": message},
+        }
+
+    def answer(self, request):
+        method = request.get("method")
+        params = request.get("params", [])
+        if random.random() < self.error_rate:
+            return self.error(request, -32000, "injected internal error")
+        try:
+            result = self.store.call(method, params)
+        except KeyError:
+            return self.error(
+                request, -32601, f"{method} call not found in the fixtures"
+            )
+        if (
+            method == "eth_getLogs"
+            and self.max_results > 0
+            and len(result) > self.max_results
+        ):
+            return self.error(
+                request,
+                TOO_MANY_RESULTS_CODE,
+                f"query returned more than {self.max_results} results",
+            )
+        return {"jsonrpc": "2.0", "id": request.get("id"), "result": result}
+
+    def handle(self, body):
+        if self.latency > 0:
+            time.sleep(random.expovariate(1 / self.latency))
+        if random.random() < self.rate_limit_rate:
+            return 429, b"Too Many Requests"
+
+        payload = json.loads(body)
+        if isinstance(payload, list):
+            if self.max_batch_size > 0 and len(payload) > self.max_batch_size:
+                return (
+                    200,
+                    json.dumps(
+                        [
+                            self.error(
+                                request,
+                                -32600,
+                                f"batch size exceeds the limit of {self.max_batch_size}",
+                            )
+                            for request in payload
+                        ]
+                    ).encode(),
+                )
+            response_data = [self.answer(request) for request in payload]
+        else:
+            response_data = self.answer(payload)
+        return 200, json.dumps(response_data).encode()
+
+
+def make_handler(backend):
+    class FakeRpcHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                status, content = backend.handle(body)
+            except Exception as e:
+                print(f"Failed to handle request: {e}")
+                status, content = 500, str(e).encode()
+
+            self.send_response(status)
+            if status == 429:
+                self.send_header("Retry-After", "1")
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            if backend.debug:
+                super().log_message(format, *args)
+
+    return FakeRpcHandler
+
+
+if __name__ == "__main__":
+    config = Config()
+    fixtures_dir = config.get_fake_rpc_fixtures_dir()
+    os.makedirs(fixtures_dir, exist_ok=True)
+    fixture_path = os.path.join(fixtures_dir, f"{config.get_chain()}.jsonl")
+
+    if config.get_fake_rpc_mode() == "record":
+        backend = FixtureRecorder(config, fixture_path)
+        print(f"Recording {backend.upstream} calls into {fixture_path}...")
+    else:
+        backend = FixtureReplayer(config, fixture_path)
+        print(f"Replaying calls from {fixture_path}...")
+
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", config.get_fake_rpc_port()), make_handler(backend)
+    )
+    print(f"Fake RPC listening on http://127.0.0.1:{config.get_fake_rpc_port()}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -59,6 +59,9 @@ class CollateralsHelper:
                     "cmcID": collaterals[collateral]["cmcID"],
                 }
             )
+        # The stakes query joins Collaterals, so the vaults of new collaterals are
+        # only picked up by a rebuild
+        self.storage.rebuild_effective_stakes()
         self.storage.commit()
 
 
@@ -69,4 +72,5 @@ if __name__ == "__main__":
     helper = CollateralsHelper(config, w3_wrapper, storage)
 
     helper.run()
+    print(f"RPC pool stats: {w3_wrapper.rpc_pool.get_stats()}")
     storage.close()
@@ -83,6 +83,7 @@ class NetworksHelper:
                         ],
                     }
                 )
+        self.storage.rebuild_effective_stakes()
         self.storage.commit()
 
 
@@ -93,4 +94,5 @@ if __name__ == "__main__":
     helper = NetworksHelper(config, w3_wrapper, storage)
 
     helper.run()
+    print(f"RPC pool stats: {w3_wrapper.rpc_pool.get_stats()}")
     storage.close()
@@ -1,10 +1,11 @@
-import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from retry import retry
 
 from common.config import Config
 from common.storage import Storage
 from common.web3wrapper import Web3Wrapper
-from common.helpers import Helpers
+from common.reorg import ReorgGuard, normalize_hash
 
 
 class Blocks:
@@ -13,8 +14,13 @@ class Blocks:
         self.w3_wrapper = w3_wrapper
         self.storage = storage
         self.name = self.config.get_blocks_module_name()
-        self.chunk_size = 1000
+        self.chunk_size = self.config.get_blocks_batch_size()
+        self.max_in_flight = self.config.get_blocks_max_in_flight()
+        self.sparse = self.config.get_blocks_sparse()
         self.debug = self.config.get_debug()
+        self.follow_head = self.config.get_follow_head()
+        self.end_block = None
+        self.reorg_guard = ReorgGuard(self.config, self.w3_wrapper, self.storage)
 
     def get_start_block(self):
         if self.debug:
@@ -38,11 +44,26 @@ class Blocks:
         return start_block
 
     def get_end_block(self):
-        return self.w3_wrapper.get_finalized_block()
+        return self.w3_wrapper.get_target_block()
+
+    def check_parent_hashes(self, from_block, blocks_data):
+        """
+        Checks that the fetched blocks extend the stored chain and each other.
+        On mismatch, rolls back to the fork point and raises to re-ingest.
+        """
+        previous = self.storage.get_block_data(from_block - 1)
+        previous_hash = previous["hash"] if previous is not None else None
+        for block_data in blocks_data:
+            if previous_hash is not None and normalize_hash(
+                block_data["parentHash"]
+            ) != normalize_hash(previous_hash):
+                fork_block = self.reorg_guard.check()
+                raise Exception(
+                    f"Parent hash mismatch at block {int(block_data['number'], 16)}, reorg fork block: {fork_block}"
+                )
+            previous_hash = block_data["hash"]
 
-    def parse_blocks(self, from_block, to_block):
-        if self.debug:
-            print(f"Parsing blocks from {from_block} to {to_block}...")
+    def fetch_blocks(self, from_block, to_block):
         json = [
             {
                 "method": "eth_getBlockByNumber",
@@ -56,41 +77,50 @@ class Blocks:
         if self.debug:
             print(f"  Sending batch request for {len(json)} blocks.")
 
-        response = requests.post(
-            self.config.get_rpc(),
-            json=json,
-            headers={"Content-Type": "application/json"},
+        data = self.w3_wrapper.rpc_pool.request(
+            json,
+            hedge=True,
+            priority=(
+                "head"
+                if self.follow_head and self.end_block - to_block < self.chunk_size
+                else "backfill"
+            ),
         )
-        Helpers.raise_for_status_with_log(response)
-        data = response.json()
 
         if self.debug:
             print(f"  Received response for {len(data)} blocks.")
 
-        for response_data in data:
-            block_data = response_data["result"]
-            number = int(block_data["number"], 16)
-            timestamp = int(block_data["timestamp"], 16)
-            block_hash = block_data["hash"]
+        return sorted(
+            [response_data["result"] for response_data in data],
+            key=lambda block_data: int(block_data["number"], 16),
+        )
 
-            if self.debug:
-                print(
-                    f"    Storing block number: {number}, timestamp: {timestamp}, hash: {block_hash}"
-                )
+    def store_blocks(self, from_block, to_block, blocks_data):
+        if self.follow_head:
+            self.check_parent_hashes(from_block, blocks_data)
 
-            self.storage.save_block_data(
-                {
-                    "number": number,
-                    "timestamp": timestamp,
-                    "hash": block_hash,
-                }
-            )
+        blocks = [
+            {
+                "number": int(block_data["number"], 16),
+                "timestamp": int(block_data["timestamp"], 16),
+                "hash": block_data["hash"],
+            }
+            for block_data in blocks_data
+        ]
+        if self.debug:
+            print(f"  Storing {len(blocks)} blocks from {from_block} to {to_block}.")
+        self.storage.save_blocks_data(blocks)
 
         if self.debug:
             print(f"  Updating last processed block to {to_block}.")
         self.storage.save_processed_timepoint(self.name, to_block)
         self.storage.commit()
 
+    def parse_blocks(self, from_block, to_block):
+        if self.debug:
+            print(f"Parsing blocks from {from_block} to {to_block}...")
+        self.store_blocks(from_block, to_block, self.fetch_blocks(from_block, to_block))
+
     @retry(
         tries=5,
         delay=1,
@@ -101,29 +131,69 @@ class Blocks:
     def parse_all_blocks(self):
         print("Starting parse_all_blocks...")
 
+        if self.follow_head:
+            self.reorg_guard.check()
+
         start_block = self.get_start_block()
         end_block = self.get_end_block()
+        self.end_block = end_block
 
         if self.debug:
             print(f"End block: {end_block}. Start block: {start_block}.")
 
         if start_block > end_block:
-            print(
-                "Start block is greater than the finalized block. Nothing to process."
-            )
+            print("Start block is greater than the end block. Nothing to process.")
             return
 
-        while True:
-            from_block = self.get_start_block()
-            to_block = min(end_block, from_block + self.chunk_size - 1)
-
-            print(f"Processing chunk: from_block={from_block}, to_block={to_block}")
-
-            if from_block > to_block:
-                print("All blocks processed. Exiting loop.")
-                break
+        if self.sparse:
+            # Other blocks are fetched on demand by the scripts that need them
+            print(f"Sparse mode: storing the end block {end_block} only.")
+            self.storage.save_blocks_data(
+                [
+                    {
+                        "number": int(block_data["number"], 16),
+                        "timestamp": int(block_data["timestamp"], 16),
+                        "hash": block_data["hash"],
+                    }
+                    for block_data in self.fetch_blocks(end_block, end_block)
+                ]
+            )
+            self.storage.save_processed_timepoint(self.name, end_block)
+            self.storage.commit()
+            return
 
-            self.parse_blocks(from_block, to_block)
+        # Up to max_in_flight batches are fetched ahead, chunks are stored in order
+        in_flight = deque()
+        next_block = start_block
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            try:
+                while next_block <= end_block or in_flight:
+                    while (
+                        next_block <= end_block and len(in_flight) < self.max_in_flight
+                    ):
+                        to_block = min(end_block, next_block + self.chunk_size - 1)
+                        in_flight.append(
+                            (
+                                next_block,
+                                to_block,
+                                executor.submit(
+                                    self.fetch_blocks, next_block, to_block
+                                ),
+                            )
+                        )
+                        next_block = to_block + 1
+
+                    from_block, to_block, future = in_flight.popleft()
+                    print(
+                        f"Processing chunk: from_block={from_block}, to_block={to_block}"
+                    )
+                    self.store_blocks(from_block, to_block, future.result())
+            except Exception:
+                for _, _, future in in_flight:
+                    future.cancel()
+                self.storage.rollback()
+                raise
+        print("All blocks processed.")
 
 
 if __name__ == "__main__":
@@ -133,4 +203,5 @@ if __name__ == "__main__":
     blocks = Blocks(config, w3_wrapper, storage)
 
     blocks.parse_all_blocks()
+    print(f"RPC pool stats: {w3_wrapper.rpc_pool.get_stats()}")
     storage.close()
@@ -5,14 +5,27 @@ warnings.filterwarnings("ignore", category=UserWarning, module="eth_utils")
 from web3 import Web3
 from w3multicall.multicall import W3Multicall
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+    FIRST_COMPLETED,
+)
 from eth_utils import event_signature_to_log_topic
-from retry import retry
+import heapq
+import itertools
+import queue
+import random
+import signal
+import threading
 
 from common.config import Config
 from common.storage import Storage
-from common.constants import Address
 from common.web3wrapper import Web3Wrapper
+from common.logfetcher import LogFetcher
+from common.logcache import LogCache
+from common.decoder import LogDecoder, decode_batch
+from common.reorg import ReorgGuard
 
 
 class Events:
@@ -24,6 +37,66 @@ class Events:
         self.chunk_size = 5000
         self.max_workers = 4
         self.debug = self.config.get_debug()
+        self.decoders = {
+            "vault_factory": LogDecoder([("vault_factory", "AddEntity")]),
+            "operator_network_opt_in_service": LogDecoder(
+                [
+                    ("operator_network_opt_in_service", "OptIn"),
+                    ("operator_network_opt_in_service", "OptOut"),
+                ]
+            ),
+            "operator_vault_opt_in_service": LogDecoder(
+                [
+                    ("operator_vault_opt_in_service", "OptIn"),
+                    ("operator_vault_opt_in_service", "OptOut"),
+                ]
+            ),
+            "vaults": LogDecoder(
+                [
+                    ("vault", "Deposit"),
+                    ("vault", "Withdraw"),
+                    ("vault", "OnSlash"),
+                    ("vault", "Transfer"),
+                ]
+            ),
+            "delegators": LogDecoder(
+                [
+                    ("delegator", "SetMaxNetworkLimit"),
+                    ("network_restake_delegator", "SetNetworkLimit"),
+                    ("network_restake_delegator", "SetOperatorNetworkShares"),
+                    ("full_restake_delegator", "SetOperatorNetworkLimit"),
+                ]
+            ),
+        }
+        self.event_topics = {
+            kind: list(decoder.events) for kind, decoder in self.decoders.items()
+        }
+        self.decode_batch_size = 2000
+        self.decode_pool = (
+            ProcessPoolExecutor(max_workers=self.config.get_decode_workers())
+            if self.config.get_decode_workers() > 0
+            else None
+        )
+        self.scan_mode = self.config.get_logs_scan_mode()
+        self.address_batch_size = 500
+        self.address_kinds = None
+        self.pipeline_depth = self.config.get_events_pipeline_depth()
+        self.follow_head = self.config.get_follow_head()
+        self.poll_interval = self.config.get_events_poll_interval()
+        self.stop_event = threading.Event()
+        self.end_block = None
+        self.reorg_guard = ReorgGuard(self.config, self.w3_wrapper, self.storage)
+        self.log_cache = (
+            LogCache(self.config) if self.config.get_logs_cache_dir() else None
+        )
+        self.cache_finalized_block = None
+        self.stream_batch_size = self.config.get_logs_stream_batch_size()
+        self.sub_chunk_size = 500
+        self.log_fetcher = (
+            LogFetcher(self.config, self.w3_wrapper.rpc_pool)
+            if self.config.get_logs_fetcher() == "async"
+            else None
+        )
 
     def get_logs(
         self,
@@ -33,11 +106,122 @@ class Events:
         to_block,
         max_workers=4,
         show_progress=False,
+        group="default",
+        priority=None,
     ):
-        logs = []
+        """
+        Yields the logs of the range in block order. When streaming, the range is
+        fetched in sub-chunks and the logs are yielded as the sub-chunks complete.
+        """
+        if self.log_cache is None:
+            yield from self.fetch_logs(
+                contract_addresses,
+                topics,
+                from_block,
+                to_block,
+                max_workers=max_workers,
+                show_progress=show_progress,
+                group=group,
+                priority=priority,
+            )
+            return
+
+        # Only finalized ranges are cached
+        if self.cache_finalized_block is None:
+            self.cache_finalized_block = self.w3_wrapper.get_finalized_block()
+        cached_to_block = min(to_block, self.cache_finalized_block)
+
+        if from_block <= cached_to_block:
+            parts, gaps = self.log_cache.find_segments(
+                contract_addresses, topics, from_block, cached_to_block
+            )
+            streams = [self.log_cache.read_segments(parts)]
+            # Only the gaps of the cached segments are fetched and cached
+            for gap_addresses, gap_from_block, gap_to_block in gaps:
+                failed_ranges = []
+                streams.append(
+                    self.log_cache.put_stream(
+                        gap_addresses,
+                        topics,
+                        gap_from_block,
+                        gap_to_block,
+                        self.fetch_logs(
+                            gap_addresses,
+                            topics,
+                            gap_from_block,
+                            gap_to_block,
+                            max_workers=max_workers,
+                            show_progress=show_progress,
+                            group=group,
+                            priority=priority,
+                            failed_ranges=failed_ranges,
+                        ),
+                        is_complete=lambda failed_ranges=failed_ranges: (
+                            len(failed_ranges) == 0
+                        ),
+                    )
+                )
+            yield from heapq.merge(
+                *streams, key=lambda log: (log["blockNumber"], log["logIndex"])
+            )
+        if cached_to_block < to_block:
+            yield from self.fetch_logs(
+                contract_addresses,
+                topics,
+                max(from_block, cached_to_block + 1),
+                to_block,
+                max_workers=max_workers,
+                show_progress=show_progress,
+                group=group,
+                priority=priority,
+            )
+
+    def get_sub_chunks(self, from_block, to_block):
+        if self.stream_batch_size == 0:
+            return [(from_block, to_block)]
+        return [
+            (sub_from_block, min(to_block, sub_from_block + self.sub_chunk_size - 1))
+            for sub_from_block in range(from_block, to_block + 1, self.sub_chunk_size)
+        ]
+
+    def fetch_logs(
+        self,
+        contract_addresses,
+        topics,
+        from_block,
+        to_block,
+        max_workers=4,
+        show_progress=False,
+        group="default",
+        priority=None,
+        failed_ranges=None,
+    ):
+        """
+        Yields the logs of the range in block order. The ranges given up on are
+        appended to failed_ranges, if given.
+        """
+        if self.log_fetcher is not None:
+            yield from self.log_fetcher.get_logs(
+                contract_addresses,
+                topics,
+                from_block,
+                to_block,
+                group=group,
+                priority=priority,
+            )
+            if self.debug:
+                print(
+                    f"  Log fetcher metrics: {self.log_fetcher.get_metrics_summary()}"
+                )
+            return
+
         total_blocks = to_block - from_block + 1
-        chunks_to_process = [(from_block, to_block)]
+        chunks_to_process = self.get_sub_chunks(from_block, to_block)
         future_to_chunk = {}
+        # Reorder buffer: the pending chunks in block order and the fetched ones among them
+        pending_chunks = list(chunks_to_process)
+        fetched_logs = {}
+        max_buffered = 2 * max_workers
 
         progress_bar = (
             tqdm(total=total_blocks, desc="Blocks processed") if show_progress else None
@@ -52,20 +236,29 @@ class Events:
                     print(
                         f"  Chunks to process: {chunks_to_process}, Futures: {len(future_to_chunk)}"
                     )
-                while chunks_to_process and len(future_to_chunk) < max_workers:
-                    chunk_from_block, chunk_to_block = chunks_to_process.pop()
+                # The first pending chunk is always submitted, or the buffer would never drain
+                while (
+                    chunks_to_process
+                    and len(future_to_chunk) < max_workers
+                    and (
+                        len(future_to_chunk) + len(fetched_logs) < max_buffered
+                        or chunks_to_process[0] == pending_chunks[0]
+                    )
+                ):
+                    chunk_from_block, chunk_to_block = chunks_to_process.pop(0)
                     if self.debug:
                         print(
                             f"    Submitting logs fetch for chunk: {chunk_from_block}-{chunk_to_block}"
                         )
+                    filter_params = {
+                        "fromBlock": chunk_from_block,
+                        "toBlock": chunk_to_block,
+                        "topics": topics,
+                    }
+                    if contract_addresses is not None:
+                        filter_params["address"] = contract_addresses
                     future = executor.submit(
-                        self.w3_wrapper.w3.eth.get_logs,
-                        {
-                            "fromBlock": chunk_from_block,
-                            "toBlock": chunk_to_block,
-                            "address": contract_addresses,
-                            "topics": topics,
-                        },
+                        self.w3_wrapper.get_logs, filter_params, priority
                     )
                     future_to_chunk[future] = (chunk_from_block, chunk_to_block)
                 if not future_to_chunk:
@@ -74,11 +267,12 @@ class Events:
                     future_to_chunk.keys(), return_when=FIRST_COMPLETED
                 )
                 for future in done:
-                    chunk_from_block, chunk_to_block = future_to_chunk.pop(future)
+                    chunk = future_to_chunk.pop(future)
+                    chunk_from_block, chunk_to_block = chunk
                     chunk_size = chunk_to_block - chunk_from_block + 1
                     try:
                         result = future.result()
-                        logs.extend(result)
+                        fetched_logs[chunk] = result
                         if self.debug:
                             print(
                                 f"    Successfully fetched {len(result)} logs for blocks {chunk_from_block}-{chunk_to_block}"
@@ -94,6 +288,9 @@ class Events:
                             print(
                                 f"Failed to get logs for block {chunk_from_block}: {e}"
                             )
+                            fetched_logs[chunk] = []
+                            if failed_ranges is not None:
+                                failed_ranges.append(chunk)
                             if progress_bar:
                                 progress_bar.update(1)
                         else:
@@ -102,6 +299,9 @@ class Events:
                                 print(
                                     f"Failed to get logs for blocks {chunk_from_block}-{chunk_to_block}: {e}"
                                 )
+                                fetched_logs[chunk] = []
+                                if failed_ranges is not None:
+                                    failed_ranges.append(chunk)
                                 if progress_bar:
                                     progress_bar.update(chunk_size)
                             else:
@@ -109,13 +309,19 @@ class Events:
                                     print(
                                         f"    Splitting chunk {chunk_from_block}-{chunk_to_block} into {chunk_from_block}-{mid_block} and {mid_block + 1}-{chunk_to_block}"
                                     )
-                                chunks_to_process.append((chunk_from_block, mid_block))
-                                chunks_to_process.append(
-                                    (mid_block + 1, chunk_to_block)
-                                )
+                                halves = [
+                                    (chunk_from_block, mid_block),
+                                    (mid_block + 1, chunk_to_block),
+                                ]
+                                index = pending_chunks.index(chunk)
+                                pending_chunks[index : index + 1] = halves
+                                chunks_to_process.extend(halves)
+                                chunks_to_process.sort()
+
+                while pending_chunks and pending_chunks[0] in fetched_logs:
+                    yield from fetched_logs.pop(pending_chunks.pop(0))
             if progress_bar:
                 progress_bar.close()
-        return logs
 
     def get_start_block(self):
         print("Retrieving the starting block for events parsing...")
@@ -137,377 +343,448 @@ class Events:
         return start_block
 
     def get_end_block(self):
-        return self.w3_wrapper.get_finalized_block()
+        if not self.follow_head:
+            return self.w3_wrapper.get_finalized_block()
+
+        # Only blocks with a stored hash can be checked for reorgs
+        last_blocks_block = self.storage.get_processed_timepoint(
+            self.config.get_blocks_module_name()
+        )
+        if last_blocks_block is None:
+            return self.w3_wrapper.get_finalized_block()
+        return min(self.w3_wrapper.get_target_block(), last_blocks_block)
 
     def decode_vault_factory_logs(self, raw_logs):
         if self.debug:
             print(f"Decoding {len(raw_logs)} raw logs from VaultFactory...")
-        contract = self.w3_wrapper.addresses.vault_factory.contract
-
-        def decode_log(raw_log):
-            nonlocal contract
-
-            if raw_log["topics"][0] == event_signature_to_log_topic(
-                "AddEntity(address)"
-            ):
-                return contract.events.AddEntity().process_log(raw_log)
-            else:
-                raise ValueError("Unknown event signature")
-
-        decoded = [decode_log(raw_log) for raw_log in raw_logs]
+        decoded = self.decode("vault_factory", raw_logs)
         if self.debug:
             print(f"  Decoded logs count: {len(decoded)}")
         return decoded
 
-    def collect_global_vars(self, logs):
+    def collect_global_vars(self, logs, block_number):
+        """
+        Reads the modules of the vaults created by the AddEntity logs at block_number,
+        the last block of their chunk: in the follow-head mode the vaults may not
+        exist yet at the finalized block.
+        """
         if self.debug:
             print(f"Collecting global vars for {len(logs)} logs...")
-        var_sets = []
-        for log in logs:
-            vault = log["args"]["entity"]
-            w3_multicall = W3Multicall(self.w3_wrapper.w3)
+        if len(logs) == 0:
+            return []
+
+        vaults = [log["args"]["entity"] for log in logs]
+        w3_multicall = W3Multicall(self.w3_wrapper.w3)
+        for vault in vaults:
             w3_multicall.add(W3Multicall.Call(vault, "delegator()(address)"))
             w3_multicall.add(W3Multicall.Call(vault, "collateral()(address)"))
             w3_multicall.add(W3Multicall.Call(vault, "epochDurationInit()(uint48)"))
             w3_multicall.add(W3Multicall.Call(vault, "epochDuration()(uint48)"))
-            result = w3_multicall.call(self.w3_wrapper.get_finalized_block())
-            delegator = Web3.to_checksum_address(result[0])
-            collateral = Web3.to_checksum_address(result[1])
+        result = w3_multicall.call(block_number)
+
+        var_sets = []
+        for i, vault in enumerate(vaults):
+            delegator = Web3.to_checksum_address(result[4 * i])
+            collateral = Web3.to_checksum_address(result[4 * i + 1])
 
             if delegator == "0x0000000000000000000000000000000000000000":
                 if self.debug:
                     print(f"  Skipping vault with zero delegator: {vault}")
                 continue
 
-            finalized_block = self.w3_wrapper.get_finalized_block()
-            delegator_type = (
-                Address(self.w3_wrapper, "delegator", delegator)
-                .contract.functions.TYPE()
-                .call({"block_identifier": finalized_block})
+            var_sets.append(
+                {
+                    "vault": vault,
+                    "delegator": delegator,
+                    "delegator_type": None,
+                    "collateral": collateral,
+                    "epochDurationInit": result[4 * i + 2],
+                    "epochDuration": result[4 * i + 3],
+                    "operator": None,
+                    "network": None,
+                }
             )
+        if len(var_sets) == 0:
+            return var_sets
 
-            var_set = {
-                "vault": vault,
-                "delegator": delegator,
-                "delegator_type": delegator_type,
-                "collateral": collateral,
-                "epochDurationInit": result[2],
-                "epochDuration": result[3],
-                "operator": None,
-                "network": None,
-            }
-
-            if delegator_type == 2:
-                w3_multicall = W3Multicall(self.w3_wrapper.w3)
-                w3_multicall.add(W3Multicall.Call(delegator, "operator()(address)"))
-                result = w3_multicall.call()
+        w3_multicall = W3Multicall(self.w3_wrapper.w3)
+        for var_set in var_sets:
+            w3_multicall.add(W3Multicall.Call(var_set["delegator"], "TYPE()(uint64)"))
+        result = w3_multicall.call(block_number)
+        for var_set, delegator_type in zip(var_sets, result):
+            var_set["delegator_type"] = delegator_type
 
-                var_set["operator"] = Web3.to_checksum_address(result[0])
-            elif delegator_type == 3:
-                w3_multicall = W3Multicall(self.w3_wrapper.w3)
-                w3_multicall.add(W3Multicall.Call(delegator, "operator()(address)"))
-                w3_multicall.add(W3Multicall.Call(delegator, "network()(address)"))
-                result = w3_multicall.call(finalized_block)
-
-                var_set["operator"] = Web3.to_checksum_address(result[0])
-                var_set["network"] = Web3.to_checksum_address(result[1])
+        w3_multicall = W3Multicall(self.w3_wrapper.w3)
+        lookups = []
+        for var_set in var_sets:
+            if var_set["delegator_type"] in (2, 3):
+                w3_multicall.add(
+                    W3Multicall.Call(var_set["delegator"], "operator()(address)")
+                )
+                lookups.append((var_set, "operator"))
+            if var_set["delegator_type"] == 3:
+                w3_multicall.add(
+                    W3Multicall.Call(var_set["delegator"], "network()(address)")
+                )
+                lookups.append((var_set, "network"))
+        if len(lookups) != 0:
+            result = w3_multicall.call(block_number)
+            for (var_set, field), address in zip(lookups, result):
+                var_set[field] = Web3.to_checksum_address(address)
 
-            var_sets.append(var_set)
         if self.debug:
             print(f"  Global vars collected: {len(var_sets)}")
         return var_sets
 
-    def parse_vault_factory(self, from_block, to_block):
-        if self.debug:
-            print(f"Parsing VaultFactory events from {from_block} to {to_block}...")
-        contract_address = self.w3_wrapper.addresses.vault_factory.address
-
-        raw_logs = self.get_logs(
-            [contract_address],
-            [[event_signature_to_log_topic("AddEntity(address)")]],
-            from_block,
-            to_block,
-            max_workers=self.max_workers,
-        )
-        logs = self.decode_vault_factory_logs(raw_logs)
-        var_sets = self.collect_global_vars(logs)
-        if self.debug:
-            print(f"  Saving global vars for {len(var_sets)} new vaults...")
-        self.storage.save_global_vars(var_sets)
-
-        return [
-            {"vault": var_set["vault"], "delegator": var_set["delegator"]}
-            for var_set in var_sets
-        ]
-
     def decode_operator_network_opt_in_service_logs(self, raw_logs):
         if self.debug:
             print(
                 f"Decoding {len(raw_logs)} raw logs from OperatorNetworkOptInService..."
             )
-        contract = self.w3_wrapper.addresses.operator_network_opt_in_service.contract
-
-        def decode_log(raw_log):
-            nonlocal contract
-
-            if raw_log["topics"][0] == event_signature_to_log_topic(
-                "OptIn(address,address)"
-            ):
-                return contract.events.OptIn().process_log(raw_log)
-            elif raw_log["topics"][0] == event_signature_to_log_topic(
-                "OptOut(address,address)"
-            ):
-                return contract.events.OptOut().process_log(raw_log)
-            else:
-                raise ValueError("Unknown event signature")
-
-        decoded = [decode_log(raw_log) for raw_log in raw_logs]
+        decoded = self.decode("operator_network_opt_in_service", raw_logs)
         if self.debug:
             print(f"  Decoded logs count: {len(decoded)}")
         return decoded
 
-    def parse_operator_network_opt_in_service_logs(self, from_block, to_block):
+    def decode_operator_vault_opt_in_service_logs(self, raw_logs):
         if self.debug:
             print(
-                f"Parsing OperatorNetworkOptInService logs from {from_block} to {to_block}..."
+                f"Decoding {len(raw_logs)} raw logs from OperatorVaultOptInService..."
             )
-        contract_address = (
-            self.w3_wrapper.addresses.operator_network_opt_in_service.address
-        )
+        decoded = self.decode("operator_vault_opt_in_service", raw_logs)
+        if self.debug:
+            print(f"  Decoded logs count: {len(decoded)}")
+        return decoded
 
-        raw_logs = self.get_logs(
-            [contract_address],
-            [
-                [
-                    event_signature_to_log_topic("OptIn(address,address)"),
-                    event_signature_to_log_topic("OptOut(address,address)"),
-                ]
-            ],
-            from_block,
-            to_block,
-            max_workers=self.max_workers,
-        )
-        logs = self.decode_operator_network_opt_in_service_logs(raw_logs)
+    def decode_vault_logs(self, raw_logs):
+        if self.debug:
+            print(f"Decoding {len(raw_logs)} raw logs from vaults...")
+        decoded = self.decode("vaults", raw_logs)
         if self.debug:
-            print(f"  Saving {len(logs)} OperatorNetworkOptInService logs...")
-        self.storage.save_operator_network_opt_in_service_logs(logs)
+            print(f"  Decoded vault logs count: {len(decoded)}")
+        return decoded
 
-    def decode_operator_vault_opt_in_service_logs(self, raw_logs):
+    def decode_delegator_logs(self, raw_logs):
         if self.debug:
-            print(
-                f"Decoding {len(raw_logs)} raw logs from OperatorVaultOptInService..."
+            print(f"Decoding {len(raw_logs)} raw logs from delegators...")
+        decoded = self.decode("delegators", raw_logs)
+        if self.debug:
+            print(f"  Decoded delegator logs count: {len(decoded)}")
+        return decoded
+
+    def get_address_kinds(self, modules, with_services=True):
+        address_kinds = {}
+        if with_services:
+            address_kinds[self.w3_wrapper.addresses.vault_factory.address.lower()] = (
+                "vault_factory"
             )
-        contract = self.w3_wrapper.addresses.operator_vault_opt_in_service.contract
+            address_kinds[
+                self.w3_wrapper.addresses.operator_network_opt_in_service.address.lower()
+            ] = "operator_network_opt_in_service"
+            address_kinds[
+                self.w3_wrapper.addresses.operator_vault_opt_in_service.address.lower()
+            ] = "operator_vault_opt_in_service"
+        for modules_set in modules:
+            address_kinds[modules_set["vault"].lower()] = "vaults"
+            address_kinds[modules_set["delegator"].lower()] = "delegators"
+        return address_kinds
 
-        def decode_log(raw_log):
-            nonlocal contract
+    def new_routed_logs(self):
+        return {kind: [] for kind in self.event_topics}
 
-            if raw_log["topics"][0] == event_signature_to_log_topic(
-                "OptIn(address,address)"
-            ):
-                return contract.events.OptIn().process_log(raw_log)
-            elif raw_log["topics"][0] == event_signature_to_log_topic(
-                "OptOut(address,address)"
-            ):
-                return contract.events.OptOut().process_log(raw_log)
-            else:
-                raise ValueError("Unknown event signature")
+    def merge_routed_logs(self, batches):
+        routed_logs = self.new_routed_logs()
+        for batch in batches:
+            for kind, raw_logs in batch.items():
+                routed_logs[kind].extend(raw_logs)
+        return routed_logs
 
-        decoded = [decode_log(raw_log) for raw_log in raw_logs]
-        if self.debug:
-            print(f"  Decoded logs count: {len(decoded)}")
-        return decoded
+    def batched(self, raw_logs):
+        """
+        Splits the streamed logs into batches of stream_batch_size, or returns all of
+        them as one batch when streaming is disabled.
+        """
+        if self.stream_batch_size == 0:
+            yield list(raw_logs)
+            return
+        raw_logs = iter(raw_logs)
+        while True:
+            batch = list(itertools.islice(raw_logs, self.stream_batch_size))
+            if len(batch) == 0:
+                return
+            yield batch
 
-    def parse_operator_vault_opt_in_service_logs(self, from_block, to_block):
-        if self.debug:
-            print(
-                f"Parsing OperatorVaultOptInService logs from {from_block} to {to_block}..."
-            )
-        contract_address = (
-            self.w3_wrapper.addresses.operator_vault_opt_in_service.address
-        )
+    def iter_chunk(
+        self, address_kinds, from_block, to_block, group="combined", priority=None
+    ):
+        """
+        Fetches the logs of all the given addresses with a single eth_getLogs scan
+        (the union of their topics) and yields them routed by (address, topic0),
+        batch by batch.
+        """
+        if len(address_kinds) == 0:
+            return
+
+        kinds = set(address_kinds.values())
+        topics = []
+        for kind in self.event_topics:
+            if kind in kinds:
+                topics.extend(
+                    topic for topic in self.event_topics[kind] if topic not in topics
+                )
 
         raw_logs = self.get_logs(
-            [contract_address],
-            [
-                [
-                    event_signature_to_log_topic("OptIn(address,address)"),
-                    event_signature_to_log_topic("OptOut(address,address)"),
-                ]
-            ],
+            [Web3.to_checksum_address(address) for address in address_kinds],
+            [topics],
             from_block,
             to_block,
             max_workers=self.max_workers,
+            group=group,
+            priority=priority,
         )
-        logs = self.decode_operator_vault_opt_in_service_logs(raw_logs)
-        if self.debug:
-            print(f"  Saving {len(logs)} OperatorVaultOptInService logs...")
-        self.storage.save_operator_vault_opt_in_service_logs(logs)
+        for batch in self.batched(raw_logs):
+            routed_logs = self.new_routed_logs()
+            self.route_logs(batch, address_kinds, routed_logs)
+            yield routed_logs
 
-    def decode_vault_logs(self, raw_logs):
+    def fetch_chunk(
+        self, address_kinds, from_block, to_block, group="combined", priority=None
+    ):
+        return self.merge_routed_logs(
+            self.iter_chunk(
+                address_kinds, from_block, to_block, group=group, priority=priority
+            )
+        )
+
+    def route_logs(self, raw_logs, address_kinds, routed_logs):
+        routed_count = 0
+        for raw_log in raw_logs:
+            kind = address_kinds.get(raw_log["address"].lower())
+            if (
+                kind is not None
+                and len(raw_log["topics"]) != 0
+                and raw_log["topics"][0] in self.event_topics[kind]
+            ):
+                routed_logs[kind].append(raw_log)
+                routed_count += 1
         if self.debug:
-            print(f"Decoding {len(raw_logs)} raw logs from vaults...")
-        contract = Address(
-            self.w3_wrapper, "vault", "0x0000000000000000000000000000000000000000"
-        ).contract
+            print(f"  Routed {routed_count} of {len(raw_logs)} raw logs")
 
-        def decode_log(raw_log):
-            nonlocal contract
+    def iter_chunk_by_topics(self, address_kinds, from_block, to_block, priority=None):
+        """
+        Scans the chunk by the event topics only and drops the logs of unknown
+        addresses locally. The vault Transfer and Deposit topics are shared with every
+        ERC20 token/ERC4626 vault, so they are still fetched with an address filter,
+        in batches.
+        """
+        vault_topics = [
+            event_signature_to_log_topic(signature)
+            for signature in [
+                "Transfer(address,address,uint256)",
+                "Deposit(address,address,uint256,uint256)",
+            ]
+        ]
 
-            if raw_log["topics"][0] == event_signature_to_log_topic(
-                "Deposit(address,address,uint256,uint256)"
-            ):
-                return contract.events.Deposit().process_log(raw_log)
-            elif raw_log["topics"][0] == event_signature_to_log_topic(
-                "Withdraw(address,address,uint256,uint256,uint256)"
-            ):
-                return contract.events.Withdraw().process_log(raw_log)
-            elif raw_log["topics"][0] == event_signature_to_log_topic(
-                "OnSlash(uint256,uint48,uint256)"
-            ):
-                return contract.events.OnSlash().process_log(raw_log)
-            elif raw_log["topics"][0] == event_signature_to_log_topic(
-                "Transfer(address,address,uint256)"
-            ):
-                return contract.events.Transfer().process_log(raw_log)
-            else:
-                raise ValueError("Unknown event signature")
+        topics = []
+        for kind_topics in self.event_topics.values():
+            topics.extend(
+                topic
+                for topic in kind_topics
+                if topic not in vault_topics and topic not in topics
+            )
+        scans = [
+            self.get_logs(
+                None,
+                [topics],
+                from_block,
+                to_block,
+                max_workers=self.max_workers,
+                group="topics",
+                priority=priority,
+            )
+        ]
 
-        decoded = [decode_log(raw_log) for raw_log in raw_logs]
-        if self.debug:
-            print(f"  Decoded vault logs count: {len(decoded)}")
-        return decoded
+        vaults = [
+            Web3.to_checksum_address(address)
+            for address, kind in address_kinds.items()
+            if kind == "vaults"
+        ]
+        for i in range(0, len(vaults), self.address_batch_size):
+            scans.append(
+                self.get_logs(
+                    vaults[i : i + self.address_batch_size],
+                    [vault_topics],
+                    from_block,
+                    to_block,
+                    max_workers=self.max_workers,
+                    group="vaults",
+                    priority=priority,
+                )
+            )
 
-    def parse_vault_logs(self, vaults, from_block, to_block):
-        if self.debug:
-            print(
-                f"Parsing vault logs for {len(vaults)} vaults, blocks {from_block}-{to_block}..."
+        # The scans are generators, each one only starts fetching once reached
+        for raw_logs in scans:
+            for batch in self.batched(raw_logs):
+                routed_logs = self.new_routed_logs()
+                self.route_logs(batch, address_kinds, routed_logs)
+                yield routed_logs
+
+    def fetch_chunk_by_topics(self, address_kinds, from_block, to_block, priority=None):
+        return self.merge_routed_logs(
+            self.iter_chunk_by_topics(
+                address_kinds, from_block, to_block, priority=priority
             )
-        raw_logs = self.get_logs(
-            vaults,
-            [
-                [
-                    event_signature_to_log_topic(
-                        "Deposit(address,address,uint256,uint256)"
-                    ),
-                    event_signature_to_log_topic(
-                        "Withdraw(address,address,uint256,uint256,uint256)"
-                    ),
-                    event_signature_to_log_topic("OnSlash(uint256,uint48,uint256)"),
-                    event_signature_to_log_topic("Transfer(address,address,uint256)"),
-                ]
-            ],
-            from_block,
-            to_block,
-            max_workers=self.max_workers,
         )
-        logs = self.decode_vault_logs(raw_logs)
-        if self.debug:
-            print(f"  Saving {len(logs)} decoded vault logs...")
-        self.storage.save_vault_logs(logs)
 
-    def decode_delegator_logs(self, raw_logs):
-        if self.debug:
-            print(f"Decoding {len(raw_logs)} raw logs from delegators...")
-        contract = Address(
-            self.w3_wrapper, "delegator", "0x0000000000000000000000000000000000000000"
-        ).contract
-        network_restake_contract = Address(
-            self.w3_wrapper,
-            "network_restake_delegator",
-            "0x0000000000000000000000000000000000000000",
-        ).contract
-        full_restake_contract = Address(
-            self.w3_wrapper,
-            "full_restake_delegator",
-            "0x0000000000000000000000000000000000000000",
-        ).contract
-
-        def decode_log(raw_log):
-            nonlocal contract
-
-            if raw_log["topics"][0] == event_signature_to_log_topic(
-                "SetMaxNetworkLimit(bytes32,uint256)"
-            ):
-                return contract.events.SetMaxNetworkLimit().process_log(raw_log)
-            elif raw_log["topics"][0] == event_signature_to_log_topic(
-                "SetNetworkLimit(bytes32,uint256)"
-            ):
-                return network_restake_contract.events.SetNetworkLimit().process_log(
-                    raw_log
-                )
-            elif raw_log["topics"][0] == event_signature_to_log_topic(
-                "SetOperatorNetworkShares(bytes32,address,uint256)"
-            ):
-                return network_restake_contract.events.SetOperatorNetworkShares().process_log(
-                    raw_log
-                )
-            elif raw_log["topics"][0] == event_signature_to_log_topic(
-                "SetOperatorNetworkLimit(bytes32,address,uint256)"
-            ):
-                return (
-                    full_restake_contract.events.SetOperatorNetworkLimit().process_log(
-                        raw_log
+    def iter_routed_logs(self, address_kinds, from_block, to_block, priority=None):
+        if self.scan_mode == "topics":
+            return self.iter_chunk_by_topics(
+                address_kinds, from_block, to_block, priority=priority
+            )
+        return self.iter_chunk(address_kinds, from_block, to_block, priority=priority)
+
+    def submit_decode(self, kind, raw_logs):
+        return [
+            self.decode_pool.submit(
+                decode_batch,
+                self.decoders[kind].event_specs,
+                raw_logs[i : i + self.decode_batch_size],
+            )
+            for i in range(0, len(raw_logs), self.decode_batch_size)
+        ]
+
+    def collect_decoded(self, futures):
+        return [log for future in futures for log in future.result()]
+
+    def decode(self, kind, raw_logs):
+        if self.decode_pool is None:
+            return self.decoders[kind].decode_logs(raw_logs)
+        return self.collect_decoded(self.submit_decode(kind, raw_logs))
+
+    def decode_chunk(self, routed_logs):
+        if self.decode_pool is not None:
+            # All the batches are submitted before waiting to decode the kinds in parallel
+            futures = {
+                kind: self.submit_decode(kind, raw_logs)
+                for kind, raw_logs in routed_logs.items()
+            }
+            decoded = {
+                kind: self.collect_decoded(kind_futures)
+                for kind, kind_futures in futures.items()
+            }
+            if self.debug:
+                print(
+                    "  Decoded logs: "
+                    + ", ".join(
+                        f"{kind}={len(kind_logs)}"
+                        for kind, kind_logs in decoded.items()
                     )
                 )
-            else:
-                raise ValueError("Unknown event signature")
+            return decoded
 
-        decoded = [decode_log(raw_log) for raw_log in raw_logs]
-        if self.debug:
-            print(f"  Decoded delegator logs count: {len(decoded)}")
-        return decoded
+        return {
+            "vault_factory": self.decode_vault_factory_logs(
+                routed_logs["vault_factory"]
+            ),
+            "operator_network_opt_in_service": self.decode_operator_network_opt_in_service_logs(
+                routed_logs["operator_network_opt_in_service"]
+            ),
+            "operator_vault_opt_in_service": self.decode_operator_vault_opt_in_service_logs(
+                routed_logs["operator_vault_opt_in_service"]
+            ),
+            "vaults": self.decode_vault_logs(routed_logs["vaults"]),
+            "delegators": self.decode_delegator_logs(routed_logs["delegators"]),
+        }
 
-    def parse_delegator_logs(self, delegators, from_block, to_block):
+    def store_chunk(self, var_sets, logs):
+        if self.debug:
+            print(f"  Saving global vars for {len(var_sets)} new vaults...")
+        self.storage.save_global_vars(var_sets)
         if self.debug:
             print(
-                f"Parsing delegator logs for {len(delegators)} delegators, blocks {from_block}-{to_block}..."
+                f"  Saving {len(logs['operator_network_opt_in_service'])} OperatorNetworkOptInService logs..."
             )
-        raw_logs = self.get_logs(
-            delegators,
+        self.storage.save_operator_network_opt_in_service_logs(
+            logs["operator_network_opt_in_service"]
+        )
+        if self.debug:
+            print(
+                f"  Saving {len(logs['operator_vault_opt_in_service'])} OperatorVaultOptInService logs..."
+            )
+        self.storage.save_operator_vault_opt_in_service_logs(
+            logs["operator_vault_opt_in_service"]
+        )
+        if self.debug:
+            print(f"  Saving {len(logs['vaults'])} decoded vault logs...")
+        self.storage.save_vault_logs(logs["vaults"])
+        if self.debug:
+            print(f"  Saving {len(logs['delegators'])} decoded delegator logs...")
+        self.storage.save_delegator_logs(logs["delegators"])
+
+    def is_near_head(self, to_block):
+        return (
+            self.end_block is not None and self.end_block - to_block < self.chunk_size
+        )
+
+    def get_priority(self, to_block):
+        return (
+            "head" if self.follow_head and self.is_near_head(to_block) else "backfill"
+        )
+
+    def get_new_address_kinds(self, var_sets):
+        return self.get_address_kinds(
             [
-                [
-                    event_signature_to_log_topic("SetMaxNetworkLimit(bytes32,uint256)"),
-                    event_signature_to_log_topic("SetNetworkLimit(bytes32,uint256)"),
-                    event_signature_to_log_topic(
-                        "SetOperatorNetworkShares(bytes32,address,uint256)"
-                    ),
-                    event_signature_to_log_topic(
-                        "SetOperatorNetworkLimit(bytes32,address,uint256)"
-                    ),
-                ]
+                {"vault": var_set["vault"], "delegator": var_set["delegator"]}
+                for var_set in var_sets
             ],
-            from_block,
-            to_block,
-            max_workers=self.max_workers,
+            with_services=False,
         )
-        logs = self.decode_delegator_logs(raw_logs)
-        if self.debug:
-            print(f"  Saving {len(logs)} decoded delegator logs...")
-        self.storage.save_delegator_logs(logs)
 
-    def parse_logs(self, from_block, to_block):
+    def fetch_stage(self, from_block, to_block):
+        """
+        Fetches and routes the raw logs of a chunk. Vaults created inside it are
+        discovered here, so the next chunk can be fetched before this one is stored.
+        """
         if self.debug:
-            print(f"parse_logs called for blocks {from_block}-{to_block}...")
-        all_modules = self.storage.get_all_modules()
-        all_modules.extend(self.parse_vault_factory(from_block, to_block))
-        self.parse_operator_network_opt_in_service_logs(from_block, to_block)
-        self.parse_operator_vault_opt_in_service_logs(from_block, to_block)
-        if len(all_modules) != 0:
-            if self.debug:
-                print(
-                    f"  Found {len(all_modules)} total modules to parse (existing + new)."
-                )
-            self.parse_vault_logs(
-                [modules["vault"] for modules in all_modules], from_block, to_block
-            )
-            self.parse_delegator_logs(
-                [modules["delegator"] for modules in all_modules], from_block, to_block
+            print(f"Fetching logs for blocks {from_block}-{to_block}...")
+        priority = self.get_priority(to_block)
+        routed_logs = self.merge_routed_logs(
+            self.iter_routed_logs(
+                self.address_kinds, from_block, to_block, priority=priority
             )
-        else:
+        )
+        var_sets = self.collect_global_vars(
+            self.decode_vault_factory_logs(routed_logs["vault_factory"]), to_block
+        )
+
+        # Vaults created inside the chunk were not part of the combined scan
+        new_address_kinds = self.get_new_address_kinds(var_sets)
+        if len(new_address_kinds) != 0:
             if self.debug:
-                print("  No modules to parse logs for at this time.")
+                print(f"  Fetching logs of {len(var_sets)} new modules...")
+            new_routed_logs = self.fetch_chunk(
+                new_address_kinds,
+                from_block,
+                to_block,
+                group="new_modules",
+                priority=priority,
+            )
+            routed_logs["vaults"].extend(new_routed_logs["vaults"])
+            routed_logs["delegators"].extend(new_routed_logs["delegators"])
+            self.address_kinds.update(new_address_kinds)
 
+        return {
+            "from_block": from_block,
+            "to_block": to_block,
+            "var_sets": var_sets,
+            "routed_logs": routed_logs,
+        }
+
+    def decode_stage(self, chunk):
+        chunk["logs"] = self.decode_chunk(chunk.pop("routed_logs"))
+        return chunk
+
+    def commit_chunk(self, from_block, to_block):
         if self.debug:
             print(f"  Updating last processed block to {to_block} and committing data.")
         self.storage.save_processed_timepoint(self.name, to_block)
@@ -516,27 +793,186 @@ class Events:
             f"  Updated last processed block from {from_block} to {to_block} and committed data."
         )
 
-    @retry(
-        tries=5,
-        delay=1,
-        backoff=2,
-        jitter=(0, 0.5),
-        exceptions=(Exception,),
-    )
-    def parse_all_logs(self):
+    def write_stage(self, chunk):
+        self.store_chunk(chunk["var_sets"], chunk["logs"])
+        self.commit_chunk(chunk["from_block"], chunk["to_block"])
+
+    def parse_logs_streamed(self, from_block, to_block):
+        """
+        Decodes and stores the chunk batch by batch while its logs are being fetched,
+        so that only one batch of raw and decoded logs is held in memory. The chunk is
+        still committed once, together with its timepoint.
+        """
+        priority = self.get_priority(to_block)
+        var_sets = []
+        for routed_logs in self.iter_routed_logs(
+            self.address_kinds, from_block, to_block, priority=priority
+        ):
+            batch_var_sets = self.collect_global_vars(
+                self.decode_vault_factory_logs(routed_logs["vault_factory"]), to_block
+            )
+            var_sets.extend(batch_var_sets)
+            self.store_chunk(batch_var_sets, self.decode_chunk(routed_logs))
+
+        # Vaults created inside the chunk were not part of the combined scan
+        new_address_kinds = self.get_new_address_kinds(var_sets)
+        if len(new_address_kinds) != 0:
+            if self.debug:
+                print(f"  Fetching logs of {len(var_sets)} new modules...")
+            for routed_logs in self.iter_chunk(
+                new_address_kinds,
+                from_block,
+                to_block,
+                group="new_modules",
+                priority=priority,
+            ):
+                self.store_chunk([], self.decode_chunk(routed_logs))
+            self.address_kinds.update(new_address_kinds)
+
+        self.commit_chunk(from_block, to_block)
+
+    def parse_logs(self, from_block, to_block):
+        if self.debug:
+            print(f"parse_logs called for blocks {from_block}-{to_block}...")
+        if self.stream_batch_size > 0:
+            self.parse_logs_streamed(from_block, to_block)
+            return
+        self.write_stage(self.decode_stage(self.fetch_stage(from_block, to_block)))
+
+    def parse_logs_pipelined(self, start_block, end_block):
+        """
+        Runs the fetch and decode stages in their own threads, connected by bounded
+        queues, while this thread stays the only writer and commits chunks in order.
+        """
+        fetched = queue.Queue(maxsize=self.pipeline_depth)
+        decoded = queue.Queue(maxsize=self.pipeline_depth)
+        stop = threading.Event()
+        errors = []
+
+        def put(chunks_queue, item):
+            while not stop.is_set():
+                try:
+                    chunks_queue.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+        def get(chunks_queue):
+            while not stop.is_set():
+                try:
+                    return chunks_queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+            return None
+
+        def fetcher():
+            try:
+                for from_block in range(start_block, end_block + 1, self.chunk_size):
+                    if stop.is_set() or self.stop_event.is_set():
+                        return
+                    to_block = min(end_block, from_block + self.chunk_size - 1)
+                    put(fetched, self.fetch_stage(from_block, to_block))
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                put(fetched, None)
+
+        def decoder():
+            try:
+                while True:
+                    chunk = get(fetched)
+                    if chunk is None:
+                        return
+                    put(decoded, self.decode_stage(chunk))
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                put(decoded, None)
+
+        threads = [
+            threading.Thread(target=fetcher, daemon=True),
+            threading.Thread(target=decoder, daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                chunk = get(decoded)
+                if chunk is None:
+                    break
+                print(
+                    f"Processing chunk: from_block={chunk['from_block']}, to_block={chunk['to_block']}"
+                )
+                self.write_stage(chunk)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        if len(errors) != 0:
+            raise errors[0]
+
+    def close(self):
+        if self.log_fetcher is not None:
+            self.log_fetcher.close()
+        if self.decode_pool is not None:
+            self.decode_pool.shutdown()
+
+    def parse_all_logs(self, tries=5, delay=1, backoff=2):
+        """
+        Runs try_parse_all_logs with retries like the other entry points, but the
+        backoff waits on the stop event, so that a daemon stop is honored right away.
+        """
+        for attempt in range(tries):
+            try:
+                return self.try_parse_all_logs()
+            except Exception as e:
+                if attempt + 1 == tries:
+                    raise
+                print(f"parse_all_logs failed, retrying in {delay}s: {e}")
+            if self.stop_event.wait(delay + random.uniform(0, 0.5)):
+                return
+            delay *= backoff
+
+    def try_parse_all_logs(self):
         print("Starting parse_all_logs...")
+        if self.follow_head:
+            self.reorg_guard.check()
+        self.cache_finalized_block = None
         start_block = self.get_start_block()
         end_block = self.get_end_block()
+        self.end_block = end_block
 
         print(f"End block: {end_block}. Start block: {start_block}.")
 
         if start_block > end_block:
-            print(
-                "Start block is greater than the finalized block. Nothing to process."
-            )
+            print("Start block is greater than the end block. Nothing to process.")
             return
 
-        while True:
+        if self.address_kinds is None:
+            all_modules = self.storage.get_all_modules()
+            if self.debug:
+                print(f"  Found {len(all_modules)} existing modules to parse.")
+            self.address_kinds = self.get_address_kinds(all_modules)
+
+        try:
+            self.parse_range(start_block, end_block)
+        except Exception:
+            # The in-memory addresses may be ahead of the DB, reload them on retry
+            self.address_kinds = None
+            self.storage.rollback()
+            raise
+
+    def parse_range(self, start_block, end_block):
+        if self.pipeline_depth > 0:
+            self.parse_logs_pipelined(start_block, end_block)
+            print("All blocks processed.")
+            return
+
+        while not self.stop_event.is_set():
             from_block = self.get_start_block()
             to_block = min(end_block, from_block + self.chunk_size - 1)
 
@@ -548,6 +984,41 @@ class Events:
 
             self.parse_logs(from_block, to_block)
 
+    def wait_for_new_blocks(self, last_block_number):
+        """
+        Polls eth_blockNumber until the head moves past last_block_number or the
+        daemon is stopped. Returns the latest block number seen.
+        """
+        while not self.stop_event.wait(self.poll_interval):
+            try:
+                block_number = self.w3_wrapper.get_block_number()
+            except Exception as e:
+                print(f"  Failed to get the block number: {e}")
+                continue
+            if last_block_number is None or block_number > last_block_number:
+                return block_number
+        return last_block_number
+
+    def run_daemon(self):
+        def handle_signal(signum, frame):
+            print(f"Received signal {signum}, stopping after the current chunk...")
+            self.stop_event.set()
+
+        signal.signal(signal.SIGTERM, handle_signal)
+        signal.signal(signal.SIGINT, handle_signal)
+
+        last_block_number = None
+        print(f"Starting events daemon, poll interval {self.poll_interval}s...")
+        while not self.stop_event.is_set():
+            try:
+                self.parse_all_logs()
+            except Exception as e:
+                print(f"parse_all_logs failed, retrying after the next block: {e}")
+            if self.debug:
+                print(f"RPC pool stats: {self.w3_wrapper.rpc_pool.get_stats()}")
+            last_block_number = self.wait_for_new_blocks(last_block_number)
+        print("Events daemon stopped.")
+
 
 if __name__ == "__main__":
     config = Config()
@@ -555,5 +1026,10 @@ if __name__ == "__main__":
     w3_wrapper = Web3Wrapper(config, storage)
     events = Events(config, w3_wrapper, storage)
 
-    events.parse_all_logs()
+    if config.get_events_daemon():
+        events.run_daemon()
+    else:
+        events.parse_all_logs()
+    events.close()
+    print(f"RPC pool stats: {w3_wrapper.rpc_pool.get_stats()}")
     storage.close()
@@ -51,10 +51,13 @@ class Points:
         if last_prices_timestamp is None:
             print("[Points] No prices processed yet. Exiting.")
             exit(0)
-        last_prices_block = self.storage.get_block_number_by_timestamp(
+        last_prices_block = self.w3_wrapper.get_block_number_by_timestamp(
             last_prices_timestamp
         )
         end_block = min(last_prices_block, last_events_block)
+        if self.config.get_follow_head():
+            # Events and blocks may follow the head, but the state is never rolled back
+            end_block = min(end_block, self.w3_wrapper.get_finalized_block())
         if self.debug:
             print(f"[Points] end_block for points calculation={end_block}")
 
@@ -80,7 +83,7 @@ class Points:
                 f"[Points] Fetching delegation-related stakes for network={network_points_data['network']}, "
                 f"identifier={network_points_data['identifier']}"
             )
-        stakes = self.storage.get_stakes(
+        stakes = self.storage.get_effective_stakes(
             network_points_data["network"], network_points_data["identifier"]
         )
 
@@ -332,6 +335,21 @@ class Points:
         #    (We update the state after the points to use the "previous" state data for points calculation)
         self.state.process_block(block_number)
 
+    def get_boundary_block_numbers(self, from_block, to_block, end_block):
+        """
+        Sparse blocks mode: the blocks of the range after which the points rates can
+        change (state logs and prices), the snapshot blocks and the end block. The
+        points of the blocks in between are accrued at once over their time span,
+        which only differs from the per-block sums by the rounding down of each term.
+        """
+        block_numbers = set(
+            self.storage.get_state_change_block_numbers(from_block, to_block)
+        )
+        block_numbers.update(range(-(-from_block // 200) * 200, to_block + 1, 200))
+        if to_block == end_block:
+            block_numbers.add(end_block)
+        return sorted(block_numbers)
+
     @retry(
         tries=5,
         delay=1,
@@ -350,14 +368,31 @@ class Points:
             )
             return
 
+        self.state.ensure_effective_stakes()
+
         previous_block_number = start_block if zero_block else start_block - 1
         print(
             f"[Points] Beginning main loop from block={start_block} to block={end_block}"
         )
 
-        for block_number in range(start_block, end_block + 1):
-            self.parse_points(previous_block_number, block_number)
-            previous_block_number = block_number
+        batch_size = self.w3_wrapper.blocks_batch_size
+        for batch_start_block in range(start_block, end_block + 1, batch_size):
+            batch_end_block = min(end_block, batch_start_block + batch_size - 1)
+            if self.w3_wrapper.sparse_blocks:
+                block_numbers = self.get_boundary_block_numbers(
+                    batch_start_block, batch_end_block, end_block
+                )
+                self.w3_wrapper.ensure_blocks([previous_block_number] + block_numbers)
+            else:
+                block_numbers = range(batch_start_block, batch_end_block + 1)
+            for block_number in block_numbers:
+                self.parse_points(previous_block_number, block_number)
+                previous_block_number = block_number
+
+        if self.debug:
+            print(
+                f"[Points] Block cache stats: {self.w3_wrapper.block_cache.get_stats()}"
+            )
 
 
 if __name__ == "__main__":
@@ -367,4 +402,5 @@ if __name__ == "__main__":
     points = Points(config, w3_wrapper, storage)
 
     points.parse_all_points()
+    print(f"RPC pool stats: {w3_wrapper.rpc_pool.get_stats()}")
     storage.close()
@@ -1,5 +1,5 @@
-import requests
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from retry import retry
 
 from common.config import Config
@@ -16,6 +16,10 @@ class Prices:
         self.name = self.config.get_prices_module_name()
         self.chunk_range = 1 * 24 * 60 * 60
         self.provider = "coinmarketcap"
+        self.timestamp_index_margin = 60 * 60
+        self.max_workers = self.config.get_prices_max_workers()
+        self.alchemy_quotes = {}
+        self.alchemy_quotes_range = None
         self.debug = self.config.get_debug()
 
     def get_start_timestamp(self):
@@ -53,41 +57,113 @@ class Prices:
                 quote_data_list, key=lambda quote_data: quote_data["timestamp"]
             )
 
-    def process_price_data(self, quote_data, collateral, provider):
-        if self.debug:
-            print(f"Processing price data for collateral: {collateral}")
-
+    def parse_quote_data(self, quote_data, provider):
         if provider == "coinmarketcap":
             time = quote_data["quote"]["USD"]["timestamp"]
-            timestamp = int(
-                datetime.fromisoformat(time.replace("Z", "+00:00")).timestamp()
-            )
             price_float = float(quote_data["quote"]["USD"]["price"])
-            price = int(price_float * 10**24)
         elif provider == "alchemy":
             time = quote_data["timestamp"]
-            timestamp = int(
-                datetime.fromisoformat(time.replace("Z", "+00:00")).timestamp()
-            )
             price_float = float(quote_data["value"])
-            price = int(price_float * 10**24)
-
-        block_number = self.storage.get_block_number_by_timestamp(timestamp)
-
+        timestamp = int(datetime.fromisoformat(time.replace("Z", "+00:00")).timestamp())
+        return timestamp, int(price_float * 10**24)
+
+    def process_price_data(self, quote_data_list, collaterals, provider):
+        """
+        Parses the sorted quotes of a response, maps their timestamps to blocks in one
+        pass and upserts the prices of the given collaterals with one statement.
+        Returns the last quote timestamp, or None if nothing was processed.
+        """
+        if len(quote_data_list) == 0 or len(collaterals) == 0:
+            return None
         if self.debug:
             print(
-                f"  Saving price to storage: block_number={block_number}, price={price}"
+                f"Processing {len(quote_data_list)} quotes for collaterals: {collaterals}"
             )
 
-        self.storage.save_price(
-            {
-                "collateral": collateral,
-                "block_number": block_number,
-                "price": price,
-            }
+        timestamps, prices = zip(
+            *[
+                self.parse_quote_data(quote_data, provider)
+                for quote_data in quote_data_list
+            ]
+        )
+        block_numbers = self.w3_wrapper.get_block_numbers_by_timestamps(timestamps)
+
+        if self.debug:
+            print(f"  Saving {len(prices) * len(collaterals)} prices to storage")
+
+        self.storage.save_prices(
+            [
+                {
+                    "collateral": collateral,
+                    "block_number": block_number,
+                    "price": price,
+                }
+                for collateral in collaterals
+                for block_number, price in zip(block_numbers, prices)
+            ]
         )
 
-        return timestamp
+        return timestamps[-1]
+
+    @retry(
+        tries=5,
+        delay=1,
+        backoff=2,
+        jitter=(0, 0.5),
+        exceptions=(Exception,),
+    )
+    def fetch_alchemy_quotes(self, symbol, time_start, time_end):
+        api_url = f"https://{self.config.get_alchemy_prices_api_url()}/v1/{self.config.get_alchemy_api_key()}/tokens/historical"
+        json = {
+            "symbol": symbol,
+            "startTime": time_start,
+            "endTime": time_end,
+            "interval": "5m",
+        }
+        response = self.w3_wrapper.transport.post(api_url, json=json)
+        Helpers.raise_for_status_with_log(response)
+        return response.json()["data"]
+
+    def fetch_all_alchemy_quotes(self, collaterals_data, time_start, time_end):
+        """
+        Fetches the quotes of the collaterals concurrently, each one retried on its
+        own. The quotes fetched are kept for the time range, so that when some
+        collaterals still fail, the retry of the range only requests those.
+        """
+        if self.alchemy_quotes_range != (time_start, time_end):
+            self.alchemy_quotes = {}
+            self.alchemy_quotes_range = (time_start, time_end)
+
+        errors = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                collateral: executor.submit(
+                    self.fetch_alchemy_quotes,
+                    collaterals_data[collateral]["symbol"],
+                    time_start,
+                    time_end,
+                )
+                for collateral in collaterals_data
+                if collateral not in self.alchemy_quotes
+            }
+            for collateral, future in futures.items():
+                try:
+                    self.alchemy_quotes[collateral] = future.result()
+                except Exception as e:
+                    errors[collateral] = e
+
+        if len(errors) != 0:
+            for collateral, error in errors.items():
+                print(
+                    f"    ERROR: Failed to fetch quotes for collateral={collateral}: {error}"
+                )
+            raise Exception(
+                f"Failed to fetch quotes for {len(errors)} of {len(collaterals_data)} collaterals for the time range {time_start} - {time_end}"
+            )
+        return {
+            collateral: self.alchemy_quotes[collateral]
+            for collateral in collaterals_data
+        }
 
     def parse_prices(
         self, collaterals_data, time_start, time_end, provider="coinmarketcap"
@@ -97,6 +173,12 @@ class Prices:
                 f"Starting parse_prices with time_start={time_start}, time_end={time_end}"
             )
 
+        # Quote timestamps are rounded by the providers, so the window has a margin
+        self.w3_wrapper.load_timestamp_index(
+            time_start - self.timestamp_index_margin,
+            time_end + self.timestamp_index_margin,
+        )
+
         if len(collaterals_data) == 0:
             pass
         elif provider == "coinmarketcap":
@@ -118,7 +200,9 @@ class Prices:
             }
             api_url = f"https://{self.config.get_coinmarketcap_api_url()}/v3/cryptocurrency/quotes/historical"
 
-            response = requests.get(api_url, params=params, headers=headers)
+            response = self.w3_wrapper.transport.get(
+                api_url, params=params, headers=headers
+            )
             Helpers.raise_for_status_with_log(response)
 
             data = response.json()
@@ -127,21 +211,21 @@ class Prices:
                 quote_data_list = self.sort_quote_data_list(
                     data["data"][cmcID]["quotes"], provider
                 )
-                last_processed_timestamp = None
 
                 if self.debug:
                     print(
                         f"  Processing data for cmcID={cmcID}, quotes count={len(quote_data_list)}"
                     )
 
-                for quote_data in quote_data_list:
-                    for collateral in collaterals_data:
-                        if collaterals_data[collateral]["cmcID"] == int(cmcID):
-                            last_processed_timestamp = self.process_price_data(
-                                quote_data,
-                                collateral,
-                                provider,
-                            )
+                last_processed_timestamp = self.process_price_data(
+                    quote_data_list,
+                    [
+                        collateral
+                        for collateral in collaterals_data
+                        if collaterals_data[collateral]["cmcID"] == int(cmcID)
+                    ],
+                    provider,
+                )
 
                 if last_processed_timestamp is None:
                     for collateral in collaterals_data:
@@ -165,34 +249,27 @@ class Prices:
                     )
 
         elif provider == "alchemy":
-            api_url = f"https://{self.config.get_alchemy_prices_api_url()}/v1/{self.config.get_alchemy_api_key()}/tokens/historical"
-            for collateral in collaterals_data:
-                json = {
-                    "symbol": collaterals_data[collateral]["symbol"],
-                    "startTime": time_start,
-                    "endTime": time_end,
-                    "interval": "5m",
-                }
+            # The requests run concurrently, the results are written in order below
+            quotes = self.fetch_all_alchemy_quotes(
+                collaterals_data, time_start, time_end
+            )
 
+            for collateral in collaterals_data:
                 if self.debug:
                     print(f"    Collateral: {collateral}")
 
-                response = requests.post(api_url, json=json)
-                Helpers.raise_for_status_with_log(response)
-
-                data = response.json()
-                quote_data_list = self.sort_quote_data_list(data["data"], provider)
-                last_processed_timestamp = None
+                quote_data_list = self.sort_quote_data_list(
+                    quotes[collateral], provider
+                )
 
                 if self.debug:
                     print(
                         f"    Received {len(quote_data_list)} quotes for collateral: {collateral}"
                     )
 
-                for quote_data in quote_data_list:
-                    last_processed_timestamp = self.process_price_data(
-                        quote_data, collateral, provider
-                    )
+                last_processed_timestamp = self.process_price_data(
+                    quote_data_list, [collateral], provider
+                )
                 if last_processed_timestamp is None:
                     if self.config.get_price(collateral, time_start) is not None:
                         print(
@@ -267,4 +344,5 @@ if __name__ == "__main__":
     prices = Prices(config, w3_wrapper, storage)
 
     prices.parse_all_prices()
+    print(f"RPC pool stats: {w3_wrapper.rpc_pool.get_stats()}")
     storage.close()
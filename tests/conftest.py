@@ -0,0 +1,60 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+# The ABIs are loaded relative to the working directory, like the scripts do
+os.chdir(ROOT)
+
+
+@pytest.fixture
+def config(monkeypatch, tmp_path):
+    from common.config import Config
+
+    monkeypatch.setenv("CHAIN", "holesky")
+    monkeypatch.setenv("RPC", "http://127.0.0.1:8545")
+    monkeypatch.setenv("DEBUG", "false")
+    monkeypatch.setenv("LOGS_CACHE_DIR", str(tmp_path / "logs"))
+    monkeypatch.setenv("LOGS_MAX_IN_FLIGHT", "4")
+    monkeypatch.setenv("RPC_CU_PER_SECOND", "0")
+    # An empty bucket file keeps the scheduler state in the process
+    monkeypatch.setenv("RPC_BUCKET_FILE", "")
+    return Config()
+
+
+@pytest.fixture
+def storage(config):
+    """
+    A Storage on a fresh <chain>_test database. Skipped unless PGSQL_* point to a
+    reachable PostgreSQL server.
+    """
+    import psycopg2
+
+    from common.storage import Storage
+
+    data = config.get_storage_data(test=True)
+    if not data["host"]:
+        pytest.skip("PGSQL_HOST is not set")
+    try:
+        connection = psycopg2.connect(
+            dbname="postgres",
+            user=data["user"],
+            password=data["password"],
+            host=data["host"],
+            port=data["port"],
+        )
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"PostgreSQL is not reachable: {e}")
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP DATABASE IF EXISTS {data['dbname']}")
+        cursor.execute(f"CREATE DATABASE {data['dbname']}")
+
+    storage = Storage(config, test=True, init=True)
+    yield storage
+    storage.close()
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP DATABASE IF EXISTS {data['dbname']}")
+    connection.close()
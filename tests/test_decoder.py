@@ -0,0 +1,132 @@
+import json
+import random
+
+import pytest
+from eth_abi import encode
+from eth_utils import event_signature_to_log_topic
+from hexbytes import HexBytes
+from web3 import Web3
+from web3._utils.method_formatters import log_entry_formatter
+from web3.datastructures import AttributeDict
+
+from common.constants import ABIS
+from common.decoder import LogDecoder, collapse_type, decode_batch, worker_decoders
+
+
+EVENTS = [
+    ("vault_factory", "AddEntity"),
+    ("operator_network_opt_in_service", "OptIn"),
+    ("operator_network_opt_in_service", "OptOut"),
+    ("operator_vault_opt_in_service", "OptIn"),
+    ("operator_vault_opt_in_service", "OptOut"),
+    ("vault", "Deposit"),
+    ("vault", "Withdraw"),
+    ("vault", "OnSlash"),
+    ("vault", "Transfer"),
+    ("delegator", "SetMaxNetworkLimit"),
+    ("network_restake_delegator", "SetNetworkLimit"),
+    ("network_restake_delegator", "SetOperatorNetworkShares"),
+    ("full_restake_delegator", "SetOperatorNetworkLimit"),
+]
+
+
+def get_abi_event(abi_name, event_name):
+    return next(
+        item
+        for item in json.loads(ABIS[abi_name])
+        if item["type"] == "event" and item["name"] == event_name
+    )
+
+
+def random_value(abi_type, rng):
+    if abi_type == "address":
+        return Web3.to_checksum_address(rng.randbytes(20))
+    if abi_type == "bytes32":
+        return rng.randbytes(32)
+    if abi_type.startswith("uint"):
+        return rng.randrange(2 ** int(abi_type[len("uint") :]))
+    raise NotImplementedError(abi_type)
+
+
+def make_raw_log(abi_name, event_name, rng):
+    abi_event = get_abi_event(abi_name, event_name)
+    types = [collapse_type(abi_input) for abi_input in abi_event["inputs"]]
+    values = [random_value(abi_type, rng) for abi_type in types]
+
+    topics = [
+        HexBytes(event_signature_to_log_topic(f"{event_name}({','.join(types)})"))
+    ]
+    data_types, data_values = [], []
+    for abi_input, abi_type, value in zip(abi_event["inputs"], types, values):
+        if abi_input["indexed"]:
+            topics.append(HexBytes(encode([abi_type], [value])))
+        else:
+            data_types.append(abi_type)
+            data_values.append(value)
+
+    # Formatted like the fetchers format the eth_getLogs results
+    return AttributeDict(
+        log_entry_formatter(
+            {
+                "address": "0x" + rng.randbytes(20).hex(),
+                "blockNumber": hex(rng.randrange(10**7)),
+                "logIndex": hex(rng.randrange(1000)),
+                "transactionIndex": hex(rng.randrange(100)),
+                "transactionHash": "0x" + rng.randbytes(32).hex(),
+                "blockHash": "0x" + rng.randbytes(32).hex(),
+                "data": "0x" + encode(data_types, data_values).hex(),
+                "topics": [Web3.to_hex(topic) for topic in topics],
+                "removed": False,
+            }
+        )
+    )
+
+
+@pytest.mark.parametrize("abi_name, event_name", EVENTS)
+def test_decode_log_matches_process_log(abi_name, event_name):
+    rng = random.Random(f"{abi_name}.{event_name}")
+    decoder = LogDecoder([(abi_name, event_name)])
+    event = Web3().eth.contract(abi=ABIS[abi_name]).events[event_name]()
+
+    for _ in range(20):
+        raw_log = make_raw_log(abi_name, event_name, rng)
+        decoded = decoder.decode_log(raw_log)
+        processed = event.process_log(raw_log)
+
+        assert decoded["args"] == dict(processed["args"])
+        for key in ["event", "address", "blockNumber", "logIndex", "transactionHash"]:
+            assert decoded[key] == processed[key]
+
+
+def test_decode_logs_dispatches_on_topic():
+    rng = random.Random(0)
+    events = [("vault", "Deposit"), ("vault", "Withdraw"), ("vault", "Transfer")]
+    raw_logs = [make_raw_log(*events[i % len(events)], rng) for i in range(30)]
+
+    decoded_logs = LogDecoder(events).decode_logs(raw_logs)
+
+    assert [log["event"] for log in decoded_logs] == [
+        events[i % len(events)][1] for i in range(30)
+    ]
+
+
+def test_decode_log_rejects_unknown_events():
+    decoder = LogDecoder([("vault", "Deposit")])
+    raw_log = make_raw_log("vault", "Withdraw", random.Random(0))
+
+    with pytest.raises(ValueError):
+        decoder.decode_log(raw_log)
+    with pytest.raises(ValueError):
+        decoder.decode_log({**raw_log, "topics": []})
+
+
+def test_decode_batch_matches_decoder():
+    rng = random.Random(1)
+    events = (("vault", "Deposit"), ("vault", "Transfer"))
+    raw_logs = [make_raw_log(*events[i % 2], rng) for i in range(10)]
+
+    assert decode_batch(events, raw_logs) == LogDecoder(events).decode_logs(raw_logs)
+    # The worker decoder is built once per event specs
+    worker_decoder = worker_decoders[events]
+    decode_batch(events, raw_logs)
+    assert worker_decoders[events] is worker_decoder
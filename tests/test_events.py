@@ -0,0 +1,90 @@
+from types import SimpleNamespace
+
+from w3multicall.multicall import W3Multicall
+
+import update_events
+from update_events import Events
+
+
+VAULT = "0x" + "1" * 40
+DELEGATOR = "0x" + "2" * 40
+COLLATERAL = "0x" + "3" * 40
+OPERATOR = "0x" + "4" * 40
+NETWORK = "0x" + "5" * 40
+
+FINALIZED_BLOCK = 1000
+CREATION_BLOCK = 1100
+
+
+class Chain:
+    """
+    Contract calls by address, answered only from the contract's creation block on,
+    like a multicall decodes the empty result of an address without code.
+    """
+
+    contracts = {
+        VAULT: {
+            "delegator()(address)": DELEGATOR,
+            "collateral()(address)": COLLATERAL,
+            "epochDurationInit()(uint48)": 1,
+            "epochDuration()(uint48)": 604800,
+        },
+        DELEGATOR: {
+            "TYPE()(uint64)": 3,
+            "operator()(address)": OPERATOR,
+            "network()(address)": NETWORK,
+        },
+    }
+
+    def __init__(self):
+        self.blocks = []
+
+    def call(self, call, block_number):
+        if block_number < CREATION_BLOCK:
+            return None
+        return self.contracts[call.address][call.signature]
+
+
+def make_multicall(chain):
+    class Multicall:
+        Call = W3Multicall.Call
+
+        def __init__(self, w3):
+            self.calls = []
+
+        def add(self, call):
+            self.calls.append(call)
+
+        def call(self, block_number):
+            chain.blocks.append(block_number)
+            return [chain.call(call, block_number) for call in self.calls]
+
+    return Multicall
+
+
+def test_collect_global_vars_of_a_vault_above_finalized(monkeypatch):
+    chain = Chain()
+    monkeypatch.setattr(update_events, "W3Multicall", make_multicall(chain))
+    events = Events.__new__(Events)
+    events.debug = False
+    events.w3_wrapper = SimpleNamespace(
+        w3=None, get_finalized_block=lambda: FINALIZED_BLOCK
+    )
+
+    var_sets = events.collect_global_vars(
+        [{"args": {"entity": VAULT}}], CREATION_BLOCK + 10
+    )
+
+    assert chain.blocks == [CREATION_BLOCK + 10] * 3
+    assert var_sets == [
+        {
+            "vault": VAULT,
+            "delegator": DELEGATOR,
+            "delegator_type": 3,
+            "collateral": COLLATERAL,
+            "epochDurationInit": 1,
+            "epochDuration": 604800,
+            "operator": OPERATOR,
+            "network": NETWORK,
+        }
+    ]
@@ -0,0 +1,171 @@
+import os
+
+from hexbytes import HexBytes
+from web3.datastructures import AttributeDict
+
+from common.logcache import LogCache
+
+
+TOPICS = [[HexBytes("0x" + "11" * 32), HexBytes("0x" + "22" * 32)]]
+OTHER_TOPICS = [HexBytes("0x" + "33" * 32)]
+ADDRESSES = ["0x" + f"{i:040x}" for i in range(1, 6)]
+
+
+def make_logs(addresses, from_block, to_block):
+    return [
+        AttributeDict(
+            {
+                "address": address,
+                "blockNumber": block_number,
+                "logIndex": log_index,
+                "transactionHash": HexBytes(block_number.to_bytes(32, "big")),
+                "blockHash": HexBytes(block_number.to_bytes(32, "big")),
+                "data": HexBytes(log_index.to_bytes(32, "big")),
+                "topics": [TOPICS[0][log_index % 2]],
+            }
+        )
+        for block_number in range(from_block, to_block + 1)
+        for log_index, address in enumerate(addresses)
+    ]
+
+
+def get_keys(logs):
+    return [(log["address"], log["blockNumber"], log["logIndex"]) for log in logs]
+
+
+def test_round_trip(config):
+    log_cache = LogCache(config)
+    logs = make_logs(ADDRESSES[:2], 100, 199)
+    log_cache.put(ADDRESSES[:2], TOPICS, 100, 199, logs)
+
+    cached_logs = list(log_cache.get(ADDRESSES[:2], TOPICS, 100, 199))
+    assert cached_logs == logs
+    # Sub-ranges and address subsets are filtered out of the segment
+    assert get_keys(log_cache.get([ADDRESSES[1].upper()], TOPICS, 150, 160)) == (
+        get_keys(make_logs(ADDRESSES[:2], 150, 160)[1::2])
+    )
+
+
+def get_parts(parts):
+    return sorted(
+        (entry["from_block"], from_block, to_block, sorted(address_set))
+        for entry, address_set, from_block, to_block in parts
+    )
+
+
+def test_find_segments_per_address(config):
+    log_cache = LogCache(config)
+    log_cache.put(ADDRESSES[:3], TOPICS, 100, 299, [])
+    log_cache.put(ADDRESSES[2:4], TOPICS, 0, 999, [])
+    log_cache.put(ADDRESSES, TOPICS, 200, 299, [])
+    log_cache.put(ADDRESSES, OTHER_TOPICS, 0, 999, [])
+
+    parts, gaps = log_cache.find_segments(ADDRESSES, TOPICS, 100, 250)
+    # Each address is read from the segment reaching the furthest
+    assert get_parts(parts) == [
+        (0, 100, 250, ADDRESSES[2:4]),
+        (100, 100, 250, ADDRESSES[:2]),
+        (200, 200, 250, ADDRESSES[4:]),
+    ]
+    assert gaps == [(ADDRESSES[4:], 100, 199)]
+
+    parts, gaps = log_cache.find_segments(ADDRESSES, TOPICS, 50, 250)
+    assert gaps == [(ADDRESSES[:2], 50, 99), (ADDRESSES[4:], 50, 199)]
+
+    assert log_cache.get(ADDRESSES, TOPICS, 100, 250) is None
+    # Address-less requests are only served by address-less segments
+    assert log_cache.find_segments(None, TOPICS, 200, 299) == ([], [(None, 200, 299)])
+
+
+def test_adjacent_segments_are_stitched(config):
+    log_cache = LogCache(config)
+    log_cache.put(ADDRESSES[:2], TOPICS, 0, 99, make_logs(ADDRESSES[:2], 0, 99))
+    log_cache.put(ADDRESSES[:2], TOPICS, 100, 199, make_logs(ADDRESSES[:2], 100, 199))
+    log_cache.put(ADDRESSES[:1], TOPICS, 150, 299, make_logs(ADDRESSES[:1], 150, 299))
+
+    parts, gaps = log_cache.find_segments(ADDRESSES[:2], TOPICS, 0, 199)
+    assert get_parts(parts) == [
+        (0, 0, 99, ADDRESSES[:2]),
+        (100, 100, 199, ADDRESSES[:2]),
+    ]
+    assert gaps == []
+    assert get_keys(log_cache.get(ADDRESSES[:2], TOPICS, 50, 149)) == get_keys(
+        make_logs(ADDRESSES[:2], 50, 149)
+    )
+
+    # Only the blocks no segment covers are left to fetch, per address
+    parts, gaps = log_cache.find_segments(ADDRESSES[:3], TOPICS, 50, 349)
+    assert get_parts(parts) == [
+        (0, 50, 99, ADDRESSES[:2]),
+        (100, 100, 199, ADDRESSES[:2]),
+        (150, 200, 299, ADDRESSES[:1]),
+    ]
+    assert gaps == [
+        (ADDRESSES[2:3], 50, 349),
+        (ADDRESSES[1:2], 200, 349),
+        (ADDRESSES[:1], 300, 349),
+    ]
+
+
+def test_address_less_segment_covers_any_address(config):
+    log_cache = LogCache(config)
+    logs = make_logs(ADDRESSES, 0, 9)
+    log_cache.put(None, TOPICS, 0, 9, logs)
+
+    parts, gaps = log_cache.find_segments(ADDRESSES[:2], TOPICS, 2, 5)
+    assert len(parts) == 1 and gaps == []
+    assert get_keys(log_cache.get(ADDRESSES[:2], TOPICS, 2, 5)) == get_keys(
+        [log for log in logs if 2 <= log["blockNumber"] <= 5 and log["logIndex"] < 2]
+    )
+    assert list(log_cache.get(None, TOPICS, 0, 9)) == logs
+
+
+def test_read_segments_merges_in_block_order(config):
+    log_cache = LogCache(config)
+    log_cache.put(ADDRESSES[:1], TOPICS, 0, 99, make_logs(ADDRESSES[:1], 0, 99))
+    log_cache.put(ADDRESSES[1:2], TOPICS, 0, 99, make_logs(ADDRESSES[:2], 0, 99)[1::2])
+
+    logs = list(log_cache.get(ADDRESSES[:2], TOPICS, 10, 19))
+    assert get_keys(logs) == get_keys(make_logs(ADDRESSES[:2], 10, 19))
+
+
+def test_index_is_reloaded(config):
+    log_cache = LogCache(config)
+    log_cache.put(ADDRESSES[:2], TOPICS, 0, 99, make_logs(ADDRESSES[:2], 0, 99))
+    # A partially written last line is skipped
+    with open(log_cache.index_path, "a") as index_file:
+        index_file.write('{"file": "trunc')
+
+    reloaded = LogCache(config)
+    assert reloaded.segments_count == 1
+    assert get_keys(reloaded.get(ADDRESSES[:2], TOPICS, 0, 99)) == get_keys(
+        make_logs(ADDRESSES[:2], 0, 99)
+    )
+
+
+def test_put_stream_passes_logs_through(config):
+    log_cache = LogCache(config)
+    logs = make_logs(ADDRESSES[:2], 0, 9)
+
+    assert list(log_cache.put_stream(ADDRESSES[:2], TOPICS, 0, 9, iter(logs))) == logs
+    assert log_cache.get(ADDRESSES[:2], TOPICS, 0, 9) is not None
+
+
+def test_incomplete_streams_are_not_cached(config):
+    log_cache = LogCache(config)
+    logs = make_logs(ADDRESSES[:2], 0, 9)
+
+    stream = log_cache.put_stream(
+        ADDRESSES[:2], TOPICS, 0, 9, iter(logs), is_complete=lambda: False
+    )
+    assert list(stream) == logs
+    # An abandoned stream is not indexed either
+    stream = log_cache.put_stream(ADDRESSES[:2], TOPICS, 0, 9, iter(logs))
+    next(stream)
+    stream.close()
+
+    assert log_cache.get(ADDRESSES[:2], TOPICS, 0, 9) is None
+    assert not any(
+        file_name.endswith(".jsonl.gz")
+        for file_name in os.listdir(log_cache.segments_path)
+    )
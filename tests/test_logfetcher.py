@@ -0,0 +1,166 @@
+import asyncio
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from common.logfetcher import (
+    LogFetcher,
+    RateLimitError,
+    TooManyResultsError,
+    classify_error,
+)
+
+
+class Scheduler:
+    def __init__(self):
+        self.penalties = []
+
+    def penalize(self, retry_after=None):
+        self.penalties.append(retry_after)
+
+
+class FakeLogFetcher(LogFetcher):
+    """
+    Answers eth_getLogs from a list of logs out of order, with random latencies,
+    a result cap and injected rate limits.
+    """
+
+    def __init__(self, config, logs, max_results=50, rate_limit_rate=0, seed=0):
+        super().__init__(config, SimpleNamespace(scheduler=Scheduler()))
+        self.logs = logs
+        self.max_results = max_results
+        self.rate_limit_rate = rate_limit_rate
+        self.rng = random.Random(seed)
+        self.requested = []
+        self.rate_limited = []
+
+    async def request_logs(self, addresses, topics, from_block, to_block, priority):
+        self.requested.append((from_block, to_block))
+        await asyncio.sleep(self.rng.random() * 0.01)
+        if self.rng.random() < self.rate_limit_rate:
+            self.rate_limited.append((from_block, to_block))
+            raise RateLimitError("HTTP 429", 0.01)
+        logs = [
+            log for log in self.logs if from_block <= log["blockNumber"] <= to_block
+        ]
+        if len(logs) > self.max_results:
+            raise TooManyResultsError("query returned more than 50 results")
+        self.rng.shuffle(logs)
+        return logs
+
+
+def make_logs(count, seed=0):
+    rng = random.Random(seed)
+    return [
+        {"blockNumber": block_number, "logIndex": log_index}
+        for block_number in sorted(rng.sample(range(10000), count))
+        for log_index in range(rng.randint(1, 3))
+    ]
+
+
+@pytest.fixture
+def make_fetcher(config):
+    fetchers = []
+
+    def make_fetcher(*args, **kwargs):
+        fetcher = FakeLogFetcher(config, *args, **kwargs)
+        fetcher.initial_chunk_size = 500
+        fetchers.append(fetcher)
+        return fetcher
+
+    yield make_fetcher
+    for fetcher in fetchers:
+        fetcher.close()
+
+
+def test_logs_are_yielded_in_block_order(make_fetcher):
+    logs = make_logs(1000)
+    fetcher = make_fetcher(logs)
+
+    assert list(fetcher.get_logs(None, [], 0, 9999)) == logs
+    summary = fetcher.get_metrics_summary()
+    assert summary["logs"] == len(logs)
+    # Oversized chunks were split
+    assert summary["errors"] > 0
+    assert min(to_block - from_block for from_block, to_block in fetcher.requested) < (
+        fetcher.initial_chunk_size // 2
+    )
+
+
+def test_rate_limits_are_retried_unsplit(make_fetcher):
+    logs = make_logs(300, seed=1)
+    fetcher = make_fetcher(logs, max_results=10000, rate_limit_rate=0.3)
+
+    assert list(fetcher.get_logs(None, [], 0, 9999)) == logs
+    assert len(fetcher.scheduler.penalties) > 0
+    assert fetcher.get_metrics_summary()["rate_limited"] == len(
+        fetcher.scheduler.penalties
+    )
+    # The rate limited ranges are requested again as they were
+    for block_range in set(fetcher.rate_limited):
+        assert fetcher.requested.count(block_range) > fetcher.rate_limited.count(
+            block_range
+        )
+
+
+def test_buffered_chunks_are_bounded(make_fetcher):
+    fetcher = make_fetcher(make_logs(1000, seed=2), max_results=10000)
+    fetcher.initial_chunk_size = 10
+
+    logs = fetcher.get_logs(None, [], 0, 9999)
+    next(logs)
+    # The consumer stalls: only up to max_buffered chunks get ahead of it
+    asyncio.run_coroutine_threadsafe(asyncio.sleep(0.5), fetcher.loop).result()
+    assert len(fetcher.requested) <= 3 * fetcher.max_buffered
+    logs.close()
+
+
+def test_errors_are_raised_to_the_consumer(make_fetcher):
+    fetcher = make_fetcher(make_logs(100, seed=3))
+    fetcher.max_attempts = 1
+
+    async def request_logs(addresses, topics, from_block, to_block, priority):
+        raise Exception("provider down")
+
+    fetcher.request_logs = request_logs
+    with pytest.raises(Exception, match="provider down"):
+        list(fetcher.get_logs(None, [], 0, 999))
+
+
+def test_backoff_does_not_stall_other_chunks(make_fetcher):
+    logs = make_logs(300, seed=4)
+    fetcher = make_fetcher(logs, max_results=10000)
+    fetcher.initial_chunk_size = 1000
+    request_logs = fetcher.request_logs
+    failed = []
+
+    async def failing_request_logs(addresses, topics, from_block, to_block, priority):
+        if from_block == 0 and len(failed) == 0:
+            failed.append(len(fetcher.requested))
+            raise Exception("header not found")
+        return await request_logs(addresses, topics, from_block, to_block, priority)
+
+    fetcher.request_logs = failing_request_logs
+    assert list(fetcher.get_logs(None, [], 0, 9999)) == logs
+    # The other chunks were requested while the first one waited to be retried
+    retry_index = fetcher.requested.index((0, 999))
+    assert retry_index > failed[0] + fetcher.max_in_flight
+
+
+def test_classify_error():
+    assert isinstance(
+        classify_error({"code": -32005, "message": "query returned more than 10000"}),
+        TooManyResultsError,
+    )
+    assert isinstance(
+        classify_error({"code": -32005, "message": "project ID request rate exceeded"}),
+        RateLimitError,
+    )
+    assert isinstance(
+        classify_error({"code": -32000, "message": "Rate limit exceeded: block range"}),
+        RateLimitError,
+    )
+    assert type(classify_error({"code": -32000, "message": "header not found"})) is (
+        Exception
+    )
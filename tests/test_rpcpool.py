@@ -0,0 +1,136 @@
+import json
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from common.logfetcher import LogFetcher
+from common.rpcpool import RpcPool
+from fake_rpc import FixtureReplayer, make_handler
+
+
+def make_log(block_number, log_index):
+    return {
+        "address": "0x" + "1" * 40,
+        "blockNumber": hex(block_number),
+        "logIndex": hex(log_index),
+        "transactionIndex": "0x0",
+        "transactionHash": "0x" + f"{block_number:064x}",
+        "blockHash": "0x" + f"{block_number:064x}",
+        "data": "0x",
+        "topics": ["0x" + "11" * 32],
+        "removed": False,
+    }
+
+
+LOGS = [make_log(block_number, 0) for block_number in range(0, 1000, 10)]
+
+GET_LOGS = {
+    "jsonrpc": "2.0",
+    "id": 1,
+    "method": "eth_getLogs",
+    "params": [{"fromBlock": "0x0", "toBlock": "0x3e7"}],
+}
+
+
+class SlowReplayer(FixtureReplayer):
+    """
+    A replayer answering after a fixed delay, or failing every request with HTTP 500.
+    """
+
+    def __init__(self, config, fixture_path, delay=0, down=False):
+        super().__init__(config, fixture_path)
+        self.delay = delay
+        self.down = down
+        self.requests = 0
+
+    def handle(self, body):
+        self.requests += 1
+        time.sleep(self.delay)
+        if self.down:
+            return 500, b"Internal Server Error"
+        return super().handle(body)
+
+
+@pytest.fixture
+def make_server(config, tmp_path):
+    fixture_path = tmp_path / "fixtures.jsonl"
+    fixture_path.write_text(
+        json.dumps({"method": "eth_getLogs", "params": [{}], "result": LOGS}) + "\n"
+    )
+    servers = []
+
+    def make_server(**kwargs):
+        backend = SlowReplayer(config, str(fixture_path), **kwargs)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(backend))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}", backend
+
+    yield make_server
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def get_closed_url():
+    with socket.socket() as closed_socket:
+        closed_socket.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{closed_socket.getsockname()[1]}"
+
+
+def test_failover_and_health_scores(config, make_server):
+    down_url, down = make_server(down=True)
+    up_url, up = make_server()
+    pool = RpcPool(config, endpoints=[down_url, get_closed_url(), up_url])
+    pool.backoff = 0.01
+
+    for _ in range(3):
+        assert pool.request(GET_LOGS)["result"] == LOGS
+    # The failing endpoints are tried once each, then scored behind the healthy one
+    assert down.requests == 1
+    assert up.requests == 3
+    assert [endpoint.url for endpoint in pool.get_endpoints()][0] == up_url
+    stats = {endpoint["url"]: endpoint for endpoint in pool.get_stats()["endpoints"]}
+    assert stats[down_url]["errors"] == 1 and stats[up_url]["errors"] == 0
+
+
+def test_slow_requests_are_hedged(config, make_server):
+    slow_url, slow = make_server(delay=1)
+    fast_url, fast = make_server()
+    pool = RpcPool(config, endpoints=[slow_url, fast_url])
+    pool.default_hedge_timeout = 0.1
+
+    start = time.monotonic()
+    assert pool.request(GET_LOGS, hedge=True)["result"] == LOGS
+    assert time.monotonic() - start < 1
+    assert pool.hedges == 1
+    assert fast.requests == 1
+    # Without hedging, the request waits for the slow endpoint
+    assert pool.request(GET_LOGS)["result"] == LOGS
+    assert pool.hedges == 1
+
+
+def test_async_fetcher_goes_through_the_pool(config, make_server):
+    down_url, down = make_server(down=True)
+    slow_url, slow = make_server(delay=1)
+    fast_url, fast = make_server()
+    pool = RpcPool(config, endpoints=[down_url, slow_url, fast_url])
+    pool.default_hedge_timeout = 0.1
+    fetcher = LogFetcher(config, pool)
+    fetcher.initial_chunk_size = 1000
+
+    try:
+        logs = list(fetcher.get_logs(None, [], 0, 999))
+    finally:
+        fetcher.close()
+
+    assert [log["blockNumber"] for log in logs] == list(range(0, 1000, 10))
+    # Failed over from the down endpoint, then hedged from the slow one
+    assert down.requests == 1 and fast.requests == 1
+    assert pool.hedges == 1
+    stats = {endpoint["url"]: endpoint for endpoint in pool.get_stats()["endpoints"]}
+    assert stats[down_url]["errors"] == 1
+    assert stats[fast_url]["requests"] == 1 and stats[fast_url]["errors"] == 0
@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+
+import pytest
+
+from common.scheduler import DEFAULT_METHOD_COST, METHOD_COSTS, RpcScheduler
+
+
+@pytest.fixture
+def throttled_config(config, monkeypatch):
+    monkeypatch.setenv("RPC_CU_PER_SECOND", "1000")
+    return config
+
+
+def test_get_cost():
+    request = {"jsonrpc": "2.0", "id": 1, "method": "eth_getLogs", "params": []}
+    batch = [
+        {**request, "method": "eth_getBlockByNumber"},
+        {**request, "method": "eth_unknown"},
+    ]
+
+    assert RpcScheduler.get_cost(request) == METHOD_COSTS["eth_getLogs"]
+    assert RpcScheduler.get_cost(json.dumps(batch).encode()) == (
+        METHOD_COSTS["eth_getBlockByNumber"] + DEFAULT_METHOD_COST
+    )
+
+
+def test_take_refills_at_the_rate(throttled_config):
+    scheduler = RpcScheduler(throttled_config)
+
+    assert scheduler.take(600) == 0
+    assert scheduler.take(300) == 0
+    delay = scheduler.take(500)
+    assert 0.3 < delay <= 0.4
+    time.sleep(delay)
+    assert scheduler.take(500) == 0
+    # Costs above the capacity go through on a full bucket
+    time.sleep(1)
+    assert scheduler.take(5000) == 0
+
+
+def test_acquire_waits_for_tokens(throttled_config):
+    scheduler = RpcScheduler(throttled_config)
+
+    start = time.monotonic()
+    for _ in range(3):
+        scheduler.acquire(500)
+    assert 0.4 < time.monotonic() - start < 1
+    assert scheduler.get_stats()["throttled_requests"] >= 1
+
+
+def test_penalize_pauses_unthrottled_requests(config):
+    scheduler = RpcScheduler(config)
+
+    scheduler.acquire(METHOD_COSTS["eth_getLogs"])
+    scheduler.penalize(0.2)
+    start = time.monotonic()
+    scheduler.acquire(METHOD_COSTS["eth_getLogs"])
+    assert time.monotonic() - start >= 0.15
+
+
+def test_head_priority_goes_first(throttled_config):
+    scheduler = RpcScheduler(throttled_config)
+    scheduler.take(1000)
+    served = []
+
+    def acquire(priority):
+        scheduler.acquire(500, priority)
+        served.append(priority)
+
+    backfill = threading.Thread(target=acquire, args=("backfill",))
+    backfill.start()
+    time.sleep(0.1)
+    head = threading.Thread(target=acquire, args=("head",))
+    head.start()
+    backfill.join()
+    head.join()
+
+    assert served == ["head", "backfill"]
+
+
+def test_shared_bucket(throttled_config, monkeypatch, tmp_path):
+    monkeypatch.setenv("RPC_BUCKET_FILE", str(tmp_path / "bucket"))
+    first, second = RpcScheduler(throttled_config), RpcScheduler(throttled_config)
+
+    assert first.get_stats()["shared"]
+    assert first.take(1000) == 0
+    assert second.take(500) > 0.4
+
+    second.penalize(5)
+    assert 4 < first.get_pause() <= 5
+
+
+def test_queue_stats_are_part_of_the_pool_stats(throttled_config):
+    from common.rpcpool import RpcPool
+
+    pool = RpcPool(throttled_config)
+    pool.scheduler.take(1000)
+    threads = [
+        threading.Thread(target=pool.scheduler.acquire, args=(100,)) for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = pool.get_stats()["scheduler"]
+    assert stats["queue_depth"] == 0
+    assert stats["max_queue_depth"] > 1
+    assert stats["throttle_time"] > 0 and stats["throttled_requests"] == 4
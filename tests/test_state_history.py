@@ -0,0 +1,132 @@
+import pytest
+
+from common.storage import STATE_HISTORY_TABLES
+
+
+VAULT = "0x" + "1" * 40
+DELEGATOR = "0x" + "2" * 40
+NETWORK = "0x" + "3" * 40
+OPERATOR = "0x" + "4" * 40
+COLLATERAL = "0x" + "5" * 40
+
+
+@pytest.fixture
+def history_storage(storage):
+    storage.state_history = True
+    return storage
+
+
+def get_vault_history(storage):
+    storage.cursor.execute(
+        """
+        SELECT activeStake, valid_from_block, valid_to_block
+        FROM VaultGlobalStateHistory
+        ORDER BY valid_from_block
+        """
+    )
+    return [(int(row[0]), row[1], row[2]) for row in storage.cursor.fetchall()]
+
+
+def save_vault_stake(storage, active_stake, block_number):
+    storage.save_vault_global_state(
+        {"vault": VAULT, "activeShares": active_stake, "activeStake": active_stake},
+        block_number,
+    )
+
+
+def test_history_tables_are_created(storage):
+    storage.cursor.execute(
+        "SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'"
+    )
+    tables = set(row[0] for row in storage.cursor.fetchall())
+
+    for table in STATE_HISTORY_TABLES:
+        assert f"{table}history".lower() in tables
+
+
+def test_save_state_history_versions_rows(history_storage):
+    save_vault_stake(history_storage, 100, 10)
+    save_vault_stake(history_storage, 30, 15)
+    # A second change in the same block replaces the version of the block
+    save_vault_stake(history_storage, 20, 15)
+    save_vault_stake(history_storage, 50, 20)
+
+    assert get_vault_history(history_storage) == [
+        (100, 10, 14),
+        (20, 15, 19),
+        (50, 20, None),
+    ]
+    assert history_storage.get_vault_global_state(VAULT)["activeStake"] == 50
+
+
+def test_history_is_only_written_when_enabled(history_storage):
+    history_storage.state_history = False
+    save_vault_stake(history_storage, 100, 10)
+    history_storage.state_history = True
+    # Saves without a block (e.g. refills from the chain) are not versioned
+    save_vault_stake(history_storage, 100, None)
+
+    assert get_vault_history(history_storage) == []
+
+
+def test_get_stake_inputs_at(history_storage):
+    storage = history_storage
+    storage.save_collateral(
+        {
+            "collateral": COLLATERAL,
+            "decimals": 18,
+            "name": "Collateral",
+            "symbol": "COL",
+            "cmcID": 1,
+        }
+    )
+    storage.save_global_vars(
+        [
+            {
+                "vault": VAULT,
+                "delegator": DELEGATOR,
+                "delegator_type": 0,
+                "collateral": COLLATERAL,
+                "epochDurationInit": 0,
+                "epochDuration": 10,
+                "operator": None,
+                "network": None,
+            }
+        ]
+    )
+    network_state = {"delegator": DELEGATOR, "network": NETWORK, "identifier": 0}
+    save_vault_stake(storage, 100, 10)
+    storage.save_delegator_network_state({**network_state, "maxNetworkLimit": 50}, 11)
+    storage.save_delegator0_network_state(
+        {**network_state, "networkLimit": 50, "totalOperatorNetworkShares": 10}, 11
+    )
+    storage.save_delegator0_operator_network_state(
+        {**network_state, "operator": OPERATOR, "operatorNetworkShares": 10}, 11
+    )
+    storage.save_operator_network_opt_in_service_state(
+        {"operator": OPERATOR, "network": NETWORK, "status": True}, 12
+    )
+    storage.save_operator_vault_opt_in_service_state(
+        {"operator": OPERATOR, "vault": VAULT, "status": True}, 12
+    )
+    save_vault_stake(storage, 20, 15)
+    storage.commit()
+
+    def get_stakes_at(block_number):
+        return [
+            (stake_inputs["activeStake"], stake_inputs["stake"])
+            for stake_inputs in storage.get_stake_inputs_at(NETWORK, 0, block_number)
+        ]
+
+    # Before the vault has any state
+    assert get_stakes_at(9) == []
+    # Not opted in yet
+    assert get_stakes_at(11) == [(100, 0)]
+    # Limited by the network limit
+    assert get_stakes_at(12) == [(100, 50)]
+    assert get_stakes_at(14) == [(100, 50)]
+    assert get_stakes_at(15) == [(20, 20)]
+    # The current state matches the live tables
+    assert [stake_data["stake"] for stake_data in storage.get_stakes(NETWORK, 0)] == [
+        stake for _, stake in get_stakes_at(10**9)
+    ]
@@ -0,0 +1,119 @@
+import random
+
+from common.timestamps import SLOT_TIME, TimestampIndex, TimestampStore
+
+
+class BlocksStorage:
+    """
+    The BlocksData queries of Storage over a list of (number, timestamp) rows.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get_blocks_timestamps(self, from_block, to_block):
+        return [row for row in self.rows if from_block <= row[0] <= to_block]
+
+    def get_blocks_by_timestamp_range(self, from_timestamp, to_timestamp):
+        before = [row for row in self.rows if row[1] < from_timestamp]
+        return before[-1:] + [
+            row for row in self.rows if from_timestamp <= row[1] <= to_timestamp
+        ]
+
+
+def make_rows(count, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    timestamp = 1_000_000
+    for number in range(count):
+        # Missed slots, and a few blocks absent from the store
+        timestamp += SLOT_TIME * (2 if rng.random() < 0.05 else 1)
+        if rng.random() < 0.01:
+            continue
+        rows.append((number, timestamp))
+    return rows
+
+
+def get_last_block_number(rows, timestamp):
+    block_numbers = [
+        number for number, row_timestamp in rows if row_timestamp <= timestamp
+    ]
+    return block_numbers[-1] if block_numbers else None
+
+
+def test_runs_and_exceptions_encoding(tmp_path):
+    store = TimestampStore(str(tmp_path / "timestamps.bin"))
+    store.extend([(0, 100), (1, 112), (2, 124), (3, 200), (5, 300), (6, 312)])
+
+    assert list(store.run_blocks) == [0, 5]
+    assert list(store.run_timestamps) == [100, 300]
+    assert list(store.run_counts) == [3, 2]
+    assert list(store.exception_blocks) == [3]
+    assert list(store.exception_timestamps) == [200]
+    assert store.last_block == 6
+
+
+def test_run_continues_across_extends(tmp_path):
+    store = TimestampStore(str(tmp_path / "timestamps.bin"))
+    store.extend([(0, 100)])
+    store.extend([(1, 112)])
+    store.extend([(2, 124), (3, 136)])
+
+    assert list(store.run_blocks) == [0]
+    assert list(store.run_counts) == [4]
+    assert len(store.exception_blocks) == 0
+
+
+def test_lookups_match_rows(tmp_path):
+    rows = make_rows(5000)
+    store = TimestampStore(str(tmp_path / "timestamps.bin"))
+    for i in range(0, len(rows), 700):
+        store.extend(rows[i : i + 700])
+
+    timestamps = dict(rows)
+    for number in range(-1, 5001):
+        assert store.get_timestamp(number) == timestamps.get(number)
+    for timestamp in range(rows[0][1] - SLOT_TIME, rows[-1][1] + SLOT_TIME, 5):
+        assert store.get_block_number_by_timestamp(timestamp) == (
+            get_last_block_number(rows, timestamp)
+        )
+    assert store.get_last_timestamp() == rows[-1][1]
+    # Mostly runs, so far smaller than the rows
+    assert len(store.run_blocks) + len(store.exception_blocks) < len(rows) // 5
+
+
+def test_reopened_store_and_sync(tmp_path):
+    rows = make_rows(3000, seed=1)
+    path = str(tmp_path / "timestamps.bin")
+    store = TimestampStore(path)
+    store.sync(BlocksStorage(rows), 1999)
+    store.unmap()
+
+    reopened = TimestampStore(path)
+    assert reopened.last_block == max(number for number, _ in rows if number <= 1999)
+    assert reopened.get_timestamp(2500) is None
+    reopened.sync(BlocksStorage(rows), 2999)
+    for number, timestamp in rows:
+        assert reopened.get_timestamp(number) == timestamp
+
+
+def test_empty_store(tmp_path):
+    store = TimestampStore(str(tmp_path / "timestamps.bin"))
+
+    assert store.get_timestamp(0) is None
+    assert store.get_block_number_by_timestamp(10**9) is None
+    assert store.get_last_timestamp() is None
+
+
+def test_timestamp_index_matches_rows():
+    rows = make_rows(2000, seed=2)
+    from_timestamp, to_timestamp = rows[500][1] + 5, rows[1500][1]
+    index = TimestampIndex(BlocksStorage(rows), from_timestamp, to_timestamp)
+
+    timestamps = list(range(from_timestamp, to_timestamp + 1, 7))
+    expected = [get_last_block_number(rows, timestamp) for timestamp in timestamps]
+    assert [
+        index.get_block_number_by_timestamp(timestamp) for timestamp in timestamps
+    ] == expected
+    assert index.get_block_numbers_by_timestamps(timestamps) == expected
+    assert index.covers(from_timestamp) and not index.covers(to_timestamp + 1)
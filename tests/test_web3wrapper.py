@@ -0,0 +1,100 @@
+import random
+
+from common.blockcache import BlockCache
+from common.timestamps import SLOT_TIME
+from common.web3wrapper import Web3Wrapper
+
+
+def make_chain(count, seed=0):
+    rng = random.Random(seed)
+    timestamps = {}
+    timestamp = 1_000_000
+    for number in range(count):
+        # Missed slots
+        timestamp += SLOT_TIME * (rng.choice([2, 3]) if rng.random() < 0.1 else 1)
+        timestamps[number] = timestamp
+    return timestamps
+
+
+class BlocksStorage:
+    """
+    The BlocksData queries of Storage over the stored subset of a chain.
+    """
+
+    def __init__(self, chain, block_numbers):
+        self.blocks = {number: chain[number] for number in block_numbers}
+
+    def get_block_number_by_timestamp(self, timestamp):
+        return max(
+            (number for number, t in self.blocks.items() if t <= timestamp),
+            default=None,
+        )
+
+    def get_first_block_number_after_timestamp(self, timestamp):
+        return min(
+            (number for number, t in self.blocks.items() if t > timestamp),
+            default=None,
+        )
+
+    def get_blocks_data(self, from_block, to_block):
+        return [
+            {"number": number, "timestamp": timestamp, "hash": None}
+            for number, timestamp in sorted(self.blocks.items())
+            if from_block <= number <= to_block
+        ]
+
+    def save_blocks_data(self, blocks):
+        for block_data in blocks:
+            self.blocks[block_data["number"]] = block_data["timestamp"]
+
+
+class RpcPool:
+    def __init__(self, chain):
+        self.chain = chain
+        self.batches = []
+
+    def request(self, payload, hedge=False, priority=None):
+        block_numbers = [int(request["params"][0], 16) for request in payload]
+        self.batches.append(block_numbers)
+        return [
+            {
+                "result": {
+                    "number": hex(number),
+                    "timestamp": hex(self.chain[number]),
+                    "hash": "0x" + f"{number:064x}",
+                }
+            }
+            for number in block_numbers
+        ]
+
+
+def test_sparse_searches_fetch_probes_in_batches(config):
+    chain = make_chain(20000)
+    # The last processed block is always stored
+    storage = BlocksStorage(chain, [*range(0, 20000, 5000), 19999])
+    w3_wrapper = Web3Wrapper.__new__(Web3Wrapper)
+    w3_wrapper.config = config
+    w3_wrapper.storage = storage
+    w3_wrapper.rpc_pool = RpcPool(chain)
+    w3_wrapper.block_cache = BlockCache(config, storage)
+    w3_wrapper.timestamp_store = None
+    w3_wrapper.sparse_blocks = True
+    w3_wrapper.blocks_batch_size = 1000
+
+    rng = random.Random(1)
+    timestamps = sorted(rng.randrange(chain[0], chain[15000]) for _ in range(100)) + [
+        chain[19999] + 1
+    ]
+
+    assert w3_wrapper.get_block_numbers_by_timestamps(timestamps) == [
+        max(number for number, t in chain.items() if t <= timestamp)
+        for timestamp in timestamps
+    ]
+    # One batch per round of probes, each round probing many blocks
+    probes = sum(len(batch) for batch in w3_wrapper.rpc_pool.batches)
+    assert len(w3_wrapper.rpc_pool.batches) < 15
+    assert probes > 3 * len(w3_wrapper.rpc_pool.batches)
+    # The probed headers are stored
+    assert set(storage.blocks) >= set(
+        number for batch in w3_wrapper.rpc_pool.batches for number in batch
+    )